@@ -0,0 +1,227 @@
+import math
+import threading
+import faiss
+import numpy as np
+
+from config import get_config
+
+INDEX_TYPES = ("flat", "hnsw", "ivf_flat", "ivf_pq", "ivf_sq8")
+
+
+def _settings() -> dict:
+    cfg = get_config()['VECTOR_INDEX']
+    index_type = cfg['index_type'].strip().lower()
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"Unknown VECTOR_INDEX.index_type {index_type!r}, expected one of {', '.join(INDEX_TYPES)}")
+    return {
+        "index_type": index_type,
+        "nlist": int(cfg['nlist']),
+        "nprobe": int(cfg['nprobe']),
+        "hnsw_m": int(cfg['hnsw_m']),
+        "ef_construction": int(cfg['ef_construction']),
+        "ef_search": int(cfg['ef_search']),
+        "pq_m": int(cfg['pq_m']),
+        "pq_nbits": int(cfg['pq_nbits']),
+        "min_train_factor": int(cfg['min_train_factor']),
+        "rebuild_fraction": float(cfg['rebuild_fraction']),
+    }
+
+
+class AnnIndex:
+    """Inner-product vector index keyed by video id.
+
+    Flat and HNSW indexes are wrapped in an IndexIDMap2, IVF indexes store
+    the ids in their inverted lists directly. IVF indexes are only used
+    once there are enough vectors to train them, until then a flat index is
+    used. HNSW graphs cannot delete vectors, so for them updates go to a
+    small flat delta index and the stale graph entries are filtered out at
+    search time until the next rebuild.
+    """
+
+    def __init__(self, dim: int, settings: dict | None = None):
+        self.dim = dim
+        self.settings = settings or _settings()
+        self.index_type = "flat"
+        self._lock = threading.Lock()
+        self._ids: set[int] = set()
+        self._inner = faiss.IndexFlatIP(dim)
+        self._main = faiss.IndexIDMap2(self._inner)
+        # Only used for index types without remove_ids support
+        self._delta = faiss.IndexIDMap2(faiss.IndexFlatIP(dim))
+        self._delta_ids: set[int] = set()
+        self._shadowed: set[int] = set()
+
+    # -- construction -----------------------------------------------------
+
+    def _nlist(self, n: int) -> int:
+        if self.settings["nlist"] > 0:
+            return self.settings["nlist"]
+        return int(min(max(4 * math.sqrt(n), 16), 65536))
+
+    def _pq_m(self) -> int:
+        # PQ cuts vectors into pq_m equal parts, so it has to divide the dimension
+        wanted = self.settings["pq_m"] or max(self.dim // 4, 1)
+        if self.dim % wanted == 0:
+            return wanted
+        pq_m = next(m for m in range(min(wanted, self.dim), 0, -1) if self.dim % m == 0)
+        print(f"VECTOR_INDEX.pq_m={wanted} does not divide the vector dimension {self.dim}, using {pq_m}")
+        return pq_m
+
+    def _create_inner(self, n: int) -> tuple[str, faiss.Index]:
+        s = self.settings
+        index_type = s["index_type"]
+        if index_type == "hnsw":
+            inner = faiss.IndexHNSWFlat(self.dim, s["hnsw_m"], faiss.METRIC_INNER_PRODUCT)
+            inner.hnsw.efConstruction = s["ef_construction"]
+            inner.hnsw.efSearch = s["ef_search"]
+            return index_type, inner
+        if index_type.startswith("ivf"):
+            nlist = self._nlist(n)
+            if n < nlist * s["min_train_factor"]:
+                print(f"Only {n} vectors, need {nlist * s['min_train_factor']} to train {index_type} (nlist={nlist}), using flat index")
+                return "flat", faiss.IndexFlatIP(self.dim)
+            quantizer = faiss.IndexFlatIP(self.dim)
+            if index_type == "ivf_flat":
+                inner = faiss.IndexIVFFlat(quantizer, self.dim, nlist, faiss.METRIC_INNER_PRODUCT)
+            elif index_type == "ivf_sq8":
+                inner = faiss.IndexIVFScalarQuantizer(quantizer, self.dim, nlist, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT)
+            else:
+                inner = faiss.IndexIVFPQ(quantizer, self.dim, nlist, self._pq_m(), s["pq_nbits"], faiss.METRIC_INNER_PRODUCT)
+            inner.nprobe = min(s["nprobe"], nlist)
+            return index_type, inner
+        return "flat", faiss.IndexFlatIP(self.dim)
+
+    def build(self, ids: list[int], vectors: np.ndarray):
+        """Replace the contents of the index, training it if required."""
+        index_type, inner = self._create_inner(len(ids))
+        if not inner.is_trained:
+            nlist = inner.nlist
+            sample = vectors
+            max_train = nlist * 256
+            if len(vectors) > max_train:
+                sample = vectors[np.random.default_rng(0).choice(len(vectors), max_train, replace=False)]
+            print(f"Training {index_type} index (nlist={nlist}) on {len(sample)} vectors")
+            inner.train(np.ascontiguousarray(sample, dtype='float32'))
+        # IVF lists store ids themselves, the other types need the id map
+        main = inner if index_type.startswith("ivf") else faiss.IndexIDMap2(inner)
+        if ids:
+            main.add_with_ids(np.ascontiguousarray(vectors, dtype='float32'), np.asarray(ids, dtype='int64'))
+
+        with self._lock:
+            self.index_type = index_type
+            self._inner = inner
+            self._main = main
+            self._ids = set(ids)
+            self._delta.reset()
+            self._delta_ids = set()
+            self._shadowed = set()
+
+    # -- updates ----------------------------------------------------------
+
+    @property
+    def _removable(self) -> bool:
+        return self.index_type != "hnsw"
+
+    def upsert(self, ids: list[int], vectors: np.ndarray):
+        if not ids:
+            return
+        with self._lock:
+            self._remove_locked(ids)
+            id_array = np.asarray(ids, dtype='int64')
+            vectors = np.ascontiguousarray(vectors, dtype='float32')
+            if self._removable:
+                self._main.add_with_ids(vectors, id_array)
+            else:
+                self._delta.add_with_ids(vectors, id_array)
+                self._delta_ids.update(ids)
+            self._ids.update(ids)
+
+    def remove(self, ids: list[int]):
+        with self._lock:
+            self._remove_locked(ids)
+
+    def _remove_locked(self, ids: list[int]):
+        present = [vid for vid in ids if vid in self._ids]
+        if not present:
+            return
+        if self._removable:
+            self._main.remove_ids(faiss.IDSelectorBatch(np.asarray(present, dtype='int64')))
+        else:
+            in_delta = [vid for vid in present if vid in self._delta_ids]
+            if in_delta:
+                self._delta.remove_ids(faiss.IDSelectorBatch(np.asarray(in_delta, dtype='int64')))
+                self._delta_ids.difference_update(in_delta)
+            # Whatever the graph holds for these ids is stale from now on
+            self._shadowed.update(vid for vid in present if vid not in in_delta)
+        self._ids.difference_update(present)
+
+    def needs_rebuild(self) -> bool:
+        """True when a rebuild from the embedding store would pay off."""
+        n = len(self._ids)
+        configured = self.settings["index_type"]
+        if configured != self.index_type and configured.startswith("ivf"):
+            return n >= self._nlist(n) * self.settings["min_train_factor"]
+        if not self._removable:
+            pending = len(self._delta_ids) + len(self._shadowed)
+            return pending > max(1000, n * self.settings["rebuild_fraction"])
+        return False
+
+    # -- queries ----------------------------------------------------------
+
+    def __contains__(self, video_id: int) -> bool:
+        return video_id in self._ids
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def ids(self) -> set[int]:
+        with self._lock:
+            return set(self._ids)
+
+    def indexed(self, video_ids: set[int]) -> set[int]:
+        """The given ids that have a vector in the index."""
+        with self._lock:
+            return video_ids & self._ids
+
+    def _search_params(self, sel, probe_scale: int):
+        if self.index_type == "hnsw":
+            return faiss.SearchParametersHNSW(sel=sel, efSearch=self.settings["ef_search"] * probe_scale)
+        if self.index_type.startswith("ivf"):
+            return faiss.SearchParametersIVF(sel=sel, nprobe=min(self._inner.nprobe * probe_scale, self._inner.nlist))
+        return faiss.SearchParameters(sel=sel)
+
+    def search(self, queries: np.ndarray, k: int, allowed_ids: np.ndarray | None = None, probe_scale: int = 1) -> tuple[np.ndarray, np.ndarray]:
+        """Return (scores, video ids) like faiss, padded with -1 ids.
+
+        `allowed_ids` restricts the search to those ids inside FAISS, so a
+        selective filter does not starve the result list. `probe_scale`
+        multiplies nprobe/efSearch for callers that need to dig deeper.
+        """
+        queries = np.ascontiguousarray(queries, dtype='float32')
+        if queries.ndim == 1:
+            queries = queries.reshape(1, -1)
+        params = None
+        sel = None
+        if allowed_ids is not None or probe_scale > 1:
+            if allowed_ids is not None:
+                sel = faiss.IDSelectorBatch(np.ascontiguousarray(allowed_ids, dtype='int64'))
+            params = self._search_params(sel, probe_scale)
+        with self._lock:
+            if not self._shadowed and not self._delta_ids:
+                return self._main.search(queries, k, params=params)
+            # Over-fetch so filtering stale graph entries still leaves k results
+            D, I = self._main.search(queries, k + min(len(self._shadowed), 4 * k), params=params)
+            if self._shadowed:
+                D = D.copy()
+                D[np.isin(I, np.fromiter(self._shadowed, dtype='int64', count=len(self._shadowed)))] = -np.inf
+            if self._delta_ids:
+                delta_params = faiss.SearchParameters(sel=sel) if sel is not None else None
+                dD, dI = self._delta.search(queries, k, params=delta_params)
+                D = np.concatenate([D, dD], axis=1)
+                I = np.concatenate([I, dI], axis=1)
+        D[I == -1] = -np.inf
+        order = np.argsort(-D, axis=1)[:, :k]
+        D = np.take_along_axis(D, order, axis=1)
+        I = np.take_along_axis(I, order, axis=1)
+        I[np.isneginf(D)] = -1
+        return D, I
@@ -0,0 +1,102 @@
+import time
+from typing import Iterable
+from sqlalchemy import bindparam, update
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.orm import Session
+from config import get_config
+
+
+class BatchWriter:
+    """Buffers row writes and flushes them in batches, one transaction each.
+
+    Rows are grouped into executemany statements per table, kind of write
+    and set of columns; `upsert` becomes INSERT ... ON CONFLICT on the
+    primary key. A flush happens once `batch_size` rows are pending or
+    `flush_interval` seconds passed since the last one, so long running
+    tasks show progress, and when the writer is used as a context manager,
+    on exit. Tables are written in the order they were first used, so
+    parents queued before their children are inserted first.
+    """
+
+    def __init__(self, db: Session, batch_size: int | None = None, flush_interval: float | None = None):
+        cfg = get_config()['BATCH_WRITES']
+        self.db = db
+        self.batch_size = batch_size or int(cfg['batch_size'])
+        self.flush_interval = flush_interval if flush_interval is not None else float(cfg['flush_interval'])
+        self._pending: dict[tuple, list[dict]] = {}
+        self._count = 0
+        self._last_flush = time.monotonic()
+        self.written = 0
+
+    def insert(self, model, row: dict):
+        self._add(("insert", model, tuple(sorted(row)), ()), row)
+
+    def upsert(self, model, row: dict, update_columns: Iterable[str] | None = None):
+        """Insert a row, or update `update_columns` (default: all given non key columns) if its key exists.
+
+        An empty `update_columns` leaves existing rows alone.
+        """
+        keys = [column.name for column in model.__table__.primary_key]
+        if update_columns is None:
+            update_columns = [name for name in row if name not in keys]
+        self._add(("upsert", model, tuple(sorted(row)), tuple(update_columns)), row)
+
+    def update(self, model, row: dict):
+        """Update an existing row, found by the primary key values in `row`."""
+        self._add(("update", model, tuple(sorted(row)), ()), row)
+
+    def _add(self, group: tuple, row: dict):
+        self._pending.setdefault(group, []).append(row)
+        self._count += 1
+        if self._count >= self.batch_size or time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def _statement(self, kind: str, model, update_columns: tuple):
+        table = model.__table__
+        keys = [column.name for column in table.primary_key]
+        if kind == "insert":
+            return insert(table)
+        if kind == "upsert":
+            stmt = insert(table)
+            if not update_columns:
+                return stmt.on_conflict_do_nothing(index_elements=keys)
+            return stmt.on_conflict_do_update(index_elements=keys, set_={name: stmt.excluded[name] for name in update_columns})
+        # executemany UPDATE, key columns are bound as b_<name> to keep them apart from the SET values
+        stmt = update(table).where(*(table.c[name] == bindparam(f"b_{name}") for name in keys))
+        return stmt
+
+    def flush(self):
+        """Write the pending rows.
+
+        If that fails the rows are dropped and the session rolled back before
+        the error is raised, so one bad batch doesn't fail every later flush.
+        """
+        pending, count = self._pending, self._count
+        self._pending = {}
+        self._count = 0
+        self._last_flush = time.monotonic()
+        if not pending:
+            return
+        try:
+            for (kind, model, columns, update_columns), rows in pending.items():
+                stmt = self._statement(kind, model, update_columns)
+                if kind == "update":
+                    keys = {column.name for column in model.__table__.primary_key}
+                    stmt = stmt.values({name: bindparam(name) for name in columns if name not in keys})
+                    rows = [{(f"b_{k}" if k in keys else k): v for k, v in row.items()} for row in rows]
+                self.db.execute(stmt, rows)
+            self.db.commit()
+        except Exception:
+            self.db.rollback()
+            raise
+        self.written += count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.flush()
+        else:
+            self._pending = {}
+            self._count = 0
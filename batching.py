@@ -0,0 +1,87 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, Generic, TypeVar
+
+T = TypeVar('T')
+R = TypeVar('R')
+
+
+class _Request(Generic[T]):
+    __slots__ = ("items", "future")
+
+    def __init__(self, items: list[T]):
+        self.items = items
+        self.future: Future = Future()
+
+
+class MicroBatcher(Generic[T, R]):
+    """Coalesces concurrent calls into one batched call of `fn`.
+
+    Callers block in `submit` while a single worker thread runs `fn` over
+    the items of every request that arrived in the meantime and scatters
+    the results back. A request that finds the worker idle runs right away;
+    only while requests are piling up does the worker wait up to
+    `max_wait_ms` to fill a batch, so a lone request pays no extra latency.
+    """
+
+    def __init__(self, name: str, fn: Callable[[list[T]], list[R]], max_batch: int, max_wait_ms: float):
+        self.name = name
+        self.fn = fn
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self._queue: queue.Queue[_Request[T]] = queue.Queue()
+        self._worker: threading.Thread | None = None
+        self._lock = threading.Lock()
+        self._under_load = False
+        self.batches = 0
+        self.requests = 0
+
+    def submit(self, items: list[T]) -> list[R]:
+        if not items:
+            return []
+        self._ensure_worker()
+        request = _Request(items)
+        self._queue.put(request)
+        return request.future.result()
+
+    def _ensure_worker(self):
+        with self._lock:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name=f"batcher-{self.name}", daemon=True)
+                self._worker.start()
+
+    def _collect(self) -> list[_Request[T]]:
+        batch = [self._queue.get()]
+        size = len(batch[0].items)
+        deadline = time.monotonic() + (self.max_wait if self._under_load else 0)
+        while size < self.max_batch:
+            timeout = deadline - time.monotonic()
+            try:
+                request = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            batch.append(request)
+            size += len(request.items)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            self._under_load = len(batch) > 1 or not self._queue.empty()
+            items = [item for request in batch for item in request.items]
+            try:
+                results = self.fn(items)
+                if len(results) != len(items):
+                    raise RuntimeError(f"{self.name}: batch function returned {len(results)} results for {len(items)} items")
+            except BaseException as e:
+                for request in batch:
+                    request.future.set_exception(e)
+                continue
+            self.batches += 1
+            self.requests += len(batch)
+            offset = 0
+            for request in batch:
+                request.future.set_result(results[offset:offset + len(request.items)])
+                offset += len(request.items)
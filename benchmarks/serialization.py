@@ -0,0 +1,97 @@
+"""Per-row cost of the ORM and the row based response paths.
+
+Builds a throwaway SQLite database with synthetic videos and times
+/videos (whole catalog) and /videos/search (one page of ids) both ways:
+
+    python benchmarks/serialization.py --videos 20000
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import create_engine, insert
+from sqlalchemy.orm import selectinload, sessionmaker
+
+from models import Base, Thumbnail, Video, VideoSchema, VideoTagSet
+from video_rows import dumps, load_video_rows, row_to_dict, select_video_rows
+
+WORDS = ["beach", "city", "night", "forest", "studio", "outdoor", "kitchen", "pool", "car", "office"]
+
+
+def populate(session, count: int):
+    rng = random.Random(0)
+    videos, thumbnails, tag_sets = [], [], []
+    for i in range(count):
+        videos.append({
+            "id": i + 1, "path": f"/media/folder{i % 50}/video {i}.mp4", "searchpath": f"folder{i % 50}/video {i}.mp4",
+            "filename": f"video {i}.mp4", "size": rng.randint(10**7, 10**9), "duration": rng.uniform(60, 3600),
+            "codec": "h264", "width": 1920, "height": 1080,
+            "filename_metadata": {"actors": rng.sample(WORDS, 2), "series": "series", "tags": rng.sample(WORDS, 3)},
+            "torrent_tags": rng.sample(WORDS, 4),
+        })
+        thumbnails += [{"video_id": i + 1, "path": f"static/thumbnails/{i + 1}_{n}.jpg", "timestamp": n * 10.0} for n in range(5)]
+        tag_sets.append({"video_id": i + 1, "tags": rng.sample(WORDS, 5), "prompt": "prompt"})
+    session.execute(insert(Video), videos)
+    session.execute(insert(Thumbnail), thumbnails)
+    session.execute(insert(VideoTagSet), tag_sets)
+    session.commit()
+
+
+def orm_list(session, ids=None) -> bytes:
+    query = session.query(Video).options(selectinload(Video.thumbnails), selectinload(Video.tag_sets))
+    if ids is not None:
+        query = query.filter(Video.id.in_(ids))
+    videos = query.all()
+    body = json.dumps([VideoSchema.model_validate(video, from_attributes=True).model_dump(mode="json") for video in videos]).encode()
+    session.expunge_all()
+    return body
+
+
+def rows_list(session, ids=None) -> bytes:
+    if ids is not None:
+        return dumps(load_video_rows(session, ids))
+    return dumps([row_to_dict(row) for row in session.execute(select_video_rows())])
+
+
+def timed(fn, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--videos", type=int, default=20000)
+    parser.add_argument("--page", type=int, default=50, help="ids per search response")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = create_engine(f"sqlite:///{os.path.join(tmp, 'bench.db')}")
+        Base.metadata.create_all(engine)
+        session = sessionmaker(bind=engine)()
+        populate(session, args.videos)
+
+        ids = random.Random(1).sample(range(1, args.videos + 1), args.page)
+        cases = [
+            ("/videos", args.videos, lambda: orm_list(session), lambda: rows_list(session)),
+            ("/videos/search", args.page, lambda: orm_list(session, ids), lambda: rows_list(session, ids)),
+        ]
+        for name, rows, orm_fn, rows_fn in cases:
+            orm_time = timed(orm_fn, args.repeat)
+            rows_time = timed(rows_fn, args.repeat)
+            print(f"{name:16} {rows:6} rows  orm {orm_time * 1e6 / rows:8.1f} us/row  rows {rows_time * 1e6 / rows:8.1f} us/row  {orm_time / rows_time:5.1f}x")
+        session.close()
+
+
+if __name__ == "__main__":
+    main()
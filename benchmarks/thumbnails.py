@@ -0,0 +1,73 @@
+"""Wall time per video of one ffmpeg process per thumbnail against one process for all of them.
+
+Uses the given videos, or renders a synthetic one when none are given:
+
+    python benchmarks/thumbnails.py /media/some/video.mp4 /media/other.mkv --count 5
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ffmpeg
+
+from thumbnails import render_thumbnails, thumbnail_timestamps
+
+
+def make_video(directory: str, duration: float) -> str:
+    path = os.path.join(directory, "synthetic.mp4")
+    (
+        ffmpeg.input(f"testsrc2=size=1920x1080:rate=30:duration={duration}", f="lavfi")
+        .output(path, vcodec="libx264", g=250, preset="ultrafast")
+        .overwrite_output()
+        .run(capture_stdout=True, capture_stderr=True)
+    )
+    return path
+
+
+def single_process_accurate(path: str, timestamps: list[float], outputs: list[str], width, height):
+    # One input per timestamp with an accurate seek, each stopped shortly after its timestamp.
+    # Slower than a process per thumbnail on one core, kept to measure it on bigger machines
+    streams = [
+        ffmpeg.input(path, ss=timestamp, t=1)
+        .filter('scale', width, height, force_original_aspect_ratio='decrease')
+        .output(output, vframes=1)
+        for timestamp, output in zip(timestamps, outputs)
+    ]
+    ffmpeg.merge_outputs(*streams).overwrite_output().run(capture_stdout=True, capture_stderr=True)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("videos", nargs="*")
+    parser.add_argument("--count", type=int, default=3)
+    parser.add_argument("--size", type=int, default=480)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--duration", type=float, default=600, help="Length of the synthetic video")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        videos = args.videos or [make_video(directory, args.duration)]
+        durations = {path: float(ffmpeg.probe(path)["format"]["duration"]) for path in videos}
+        outputs = [os.path.join(directory, f"thumb_{i}.jpg") for i in range(args.count)]
+
+        methods = {
+            "process per thumbnail": lambda path, ts: render_thumbnails(path, ts, outputs, args.size, args.size, snap_to_keyframe=False),
+            "single process": lambda path, ts: single_process_accurate(path, ts, outputs, args.size, args.size),
+            "single process, keyframes": lambda path, ts: render_thumbnails(path, ts, outputs, args.size, args.size, snap_to_keyframe=True),
+        }
+        for name, method in methods.items():
+            best = float("inf")
+            for _ in range(args.repeat):
+                started = time.perf_counter()
+                for path in videos:
+                    method(path, thumbnail_timestamps(durations[path], args.count))
+                best = min(best, time.perf_counter() - started)
+            print(f"{name:28s} {best / len(videos) * 1000:8.1f} ms/video")
+
+
+if __name__ == "__main__":
+    main()
@@ -21,7 +21,17 @@ config['THUMBNAILS'] = {
     'thumbnail_dir': 'static/thumbnails',
     'thumbnail_count': '3',
     'thumbnail_width': '480',
-    'thumbnail_height': '480'
+    'thumbnail_height': '480',
+    'snap_to_keyframe': 'false'  # Nearest keyframe to each timestamp, all from one ffmpeg process; false = exact frames, a process each
+}
+
+config['THUMBNAIL_VARIANTS'] = {
+    'cache_dir': 'data/thumbnail_cache',
+    'cache_size_mb': '1024',  # Resized thumbnails kept on disk
+    'widths': '120,160,240,320,480',  # Requested widths are rounded up to one of these
+    'jpeg_quality': '80',
+    'webp_quality': '75',
+    'avif_quality': '55'
 }
 
 config['PREVIEWS'] = {
@@ -34,6 +44,106 @@ config['PREVIEWS'] = {
     'preview_fps': '24'
 }
 
+config['SPRITES'] = {
+    'sprite_dir': 'static/sprites',
+    'interval': '10',  # Seconds between tiles, longer for videos that would need more than columns * max_rows tiles
+    'columns': '10',
+    'max_rows': '10',
+    'tile_width': '160',
+    'format': 'jpg',  # jpg or webp
+    'jpeg_qscale': '5',  # 2 (best) to 31
+    'quality': '70',  # webp quality
+    'keyframes_only': 'true'  # Decode only keyframes, much faster; tiles show the keyframe before their time
+}
+
+config['EMBEDDINGS'] = {
+    'store_dir': 'data/embeddings',
+    'sync_batch_size': '1024'  # Documents encoded between commits
+}
+
+config['MODELS'] = {
+    'device': 'auto',  # auto, cuda, cuda:N or cpu
+    'cpu_backend': 'fp32',  # fp32 or int8 (dynamic quantization) when running on CPU
+    'idle_timeout': '900'  # Seconds before an unused model is unloaded, 0 = never
+}
+
+config['RERANKER'] = {
+    'model': 'BAAI/bge-reranker-v2-m3',
+    'cascade_model': 'cross-encoder/ms-marco-MiniLM-L6-v2',  # Empty to disable the first stage
+    'cascade_keep': '20',  # Candidates passed from the first stage to the large model
+    'batch_size': '16',
+    'cache_size': '50000',  # (query, document) scores kept in memory
+    'budget_ms': '0'  # Default per-request search latency budget, 0 = none
+}
+
+config['SIMILARITY'] = {
+    'neighbors': '50',  # Precomputed neighbours per video for /videos/{id}/similar
+    'block_size': '256'  # Rows per matrix multiplication block
+}
+
+config['MICROBATCH'] = {
+    'max_wait_ms': '3',  # How long a busy model waits to fill a batch
+    'embedding_max_batch': '64',  # Query texts per embedding forward pass
+    'rerank_max_batch': '64'  # (query, document) pairs per reranker forward pass
+}
+
+config['VECTOR_INDEX'] = {
+    'index_type': 'flat',  # flat, hnsw, ivf_flat, ivf_pq, ivf_sq8
+    'nlist': '0',  # IVF cells, 0 = 4*sqrt(number of vectors)
+    'nprobe': '16',  # IVF cells visited per query
+    'hnsw_m': '32',
+    'ef_construction': '200',
+    'ef_search': '64',
+    'pq_m': '0',  # PQ sub-quantizers (bytes per vector), must divide the vector dimension; 0 = dimension / 4
+    'pq_nbits': '8',
+    'min_train_factor': '39',  # Train IVF indexes once there are nlist * factor vectors
+    'rebuild_fraction': '0.1',  # Rebuild HNSW once this fraction of vectors changed
+    'exact_filter_limit': '20000'  # Filters matching fewer videos are scored exactly from the embedding store
+}
+
+config['STREAMING'] = {
+    'handle_cache_size': '64',  # Open video files kept for the stream endpoints
+    'revalidate_interval': '5',  # Seconds a cached file is trusted before it is stat()ed again
+    'idle_timeout': '300'  # Seconds before an unused file is closed
+}
+
+config['HLS'] = {
+    'cache_dir': 'data/hls_cache',
+    'cache_size_mb': '10240',  # Remuxed/transcoded segments kept on disk
+    'segment_seconds': '6',  # Target segment length, segments always start on a keyframe
+    'prefetch_segments': '2',  # Segments generated ahead of the one requested
+    'workers': '2',  # Concurrent ffmpeg processes for prefetching
+    'copy_video_codecs': 'h264',  # Remuxed as they are, anything else is transcoded to H.264
+    'copy_audio_codecs': 'aac,mp3',  # Remuxed as they are, anything else is transcoded to AAC
+    'preset': 'veryfast',
+    'crf': '23'
+}
+
+config['FINGERPRINTS'] = {
+    'backfill_batch': '200'  # Videos from before fingerprints fingerprinted per task run, other tasks run in between
+}
+
+config['METADATA'] = {
+    'workers': '8',  # Concurrent ffprobe processes, 0 = one per CPU
+    'device_concurrency': '4',  # Probes at a time per disk
+    'rotational_device_concurrency': '1',  # Probes at a time per spinning disk
+    'native_probe': 'true'  # Read MP4/MKV headers directly, ffprobe only for other files
+}
+
+config['BATCH_WRITES'] = {
+    'batch_size': '500',  # Rows written per transaction by the scanner and metadata tasks
+    'flush_interval': '2'  # Seconds after which pending rows are written anyway
+}
+
+config['WATCHER'] = {
+    'enabled': 'true',  # Watch the media folders and ingest changes without a /scan
+    'mode': 'auto',  # auto (inotify, polling on network mounts), inotify or polling
+    'debounce_seconds': '2',  # Quiet time after the last event for a path
+    'settle_seconds': '5',  # How long a file's size and mtime must stay unchanged before it is ingested
+    'poll_interval': '60',  # Seconds between incremental scans of network mounts
+    'network_filesystems': 'nfs,nfs4,cifs,smb3,smbfs,fuse.sshfs,9p,afs,ceph,glusterfs'
+}
+
 # Create config file if it doesn't exist
 config_path = Path('data/config.ini')
 if not config_path.exists():
@@ -43,8 +153,10 @@ if not config_path.exists():
 
 def get_config():
     """Load and return the configuration"""
-    # Read the persisted config file to get user changes
+    # Start from the defaults so sections added after the config file was
+    # first written are still available, then apply the user's changes
     user_config = ConfigParser()
+    user_config.read_dict(config)
     user_config.read(config_path)
     return user_config
 
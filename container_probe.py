@@ -0,0 +1,285 @@
+import os
+import struct
+from typing import BinaryIO, Iterator
+
+MP4_CODECS = {
+    b"avc1": "h264", b"avc3": "h264",
+    b"hvc1": "hevc", b"hev1": "hevc", b"dvh1": "hevc", b"dvhe": "hevc",
+    b"av01": "av1",
+    b"vp08": "vp8", b"vp09": "vp9",
+    b"mjpa": "mjpeg", b"mjpb": "mjpeg", b"jpeg": "mjpeg",
+    b"s263": "h263", b"h263": "h263",
+    b"apch": "prores", b"apcn": "prores", b"apcs": "prores", b"apco": "prores", b"ap4h": "prores", b"ap4x": "prores",
+}
+# mp4v can be MPEG-4 part 2 or MPEG-1/2 depending on the esds, ffprobe decides those
+
+MATROSKA_CODECS = {
+    "V_MPEG4/ISO/AVC": "h264",
+    "V_MPEGH/ISO/HEVC": "hevc",
+    "V_AV1": "av1",
+    "V_VP8": "vp8",
+    "V_VP9": "vp9",
+    "V_MPEG4/ISO/SP": "mpeg4", "V_MPEG4/ISO/ASP": "mpeg4", "V_MPEG4/ISO/AP": "mpeg4",
+    "V_MPEG1": "mpeg1video",
+    "V_MPEG2": "mpeg2video",
+    "V_THEORA": "theora",
+    "V_PRORES": "prores",
+    "V_MJPEG": "mjpeg",
+}
+# V_MS/VFW/FOURCC hides the codec in a BITMAPINFOHEADER, left to ffprobe
+
+
+class _Unsupported(Exception):
+    pass
+
+
+def _read_exact(f: BinaryIO, size: int) -> bytes:
+    data = f.read(size)
+    if len(data) != size:
+        raise _Unsupported("truncated")
+    return data
+
+
+# MP4 / QuickTime
+
+def _boxes(f: BinaryIO, start: int, end: int) -> Iterator[tuple[bytes, int, int]]:
+    """(type, payload start, box end) of the boxes between two offsets, reading only their headers."""
+    position = start
+    while position + 8 <= end:
+        f.seek(position)
+        size, box_type = struct.unpack(">I4s", _read_exact(f, 8))
+        header = 8
+        if size == 1:
+            size = struct.unpack(">Q", _read_exact(f, 8))[0]
+            header = 16
+        elif size == 0:
+            size = end - position  # Runs to the end of the file
+        if size < header or position + size > end:
+            raise _Unsupported("bad box size")
+        yield box_type, position + header, position + size
+        position += size
+
+
+def _child(f: BinaryIO, start: int, end: int, box_type: bytes) -> tuple[int, int] | None:
+    for child_type, payload, child_end in _boxes(f, start, end):
+        if child_type == box_type:
+            return payload, child_end
+    return None
+
+
+def _duration_box(f: BinaryIO, payload: int) -> tuple[int, int]:
+    """(timescale, duration) of an mvhd or mdhd box."""
+    f.seek(payload)
+    version = _read_exact(f, 4)[0]
+    if version == 1:
+        return struct.unpack(">16xIQ", _read_exact(f, 28))
+    return struct.unpack(">8xII", _read_exact(f, 16))
+
+
+def _probe_mp4(f: BinaryIO, file_size: int) -> dict:
+    # moov may come before or after mdat, the media data itself is skipped over
+    moov = _child(f, 0, file_size, b"moov")
+    if moov is None:
+        raise _Unsupported("no moov")
+    mvhd = _child(f, *moov, b"mvhd")
+    if mvhd is None:
+        raise _Unsupported("no mvhd")
+    timescale, duration = _duration_box(f, mvhd[0])
+    if not timescale or not duration:
+        raise _Unsupported("no duration, fragmented file?")
+
+    for box_type, payload, end in _boxes(f, *moov):
+        if box_type != b"trak":
+            continue
+        mdia = _child(f, payload, end, b"mdia")
+        hdlr = mdia and _child(f, *mdia, b"hdlr")
+        if not hdlr:
+            continue
+        f.seek(hdlr[0] + 8)
+        if _read_exact(f, 4) != b"vide":
+            continue
+        minf = _child(f, *mdia, b"minf")
+        stbl = minf and _child(f, *minf, b"stbl")
+        stsd = stbl and _child(f, *stbl, b"stsd")
+        if not stsd:
+            raise _Unsupported("video track without stsd")
+        # First sample entry: size, format, 6 reserved, data reference index, then the VisualSampleEntry fields
+        f.seek(stsd[0] + 8)
+        entry = _read_exact(f, 36)
+        codec = MP4_CODECS.get(entry[4:8])
+        if codec is None:
+            raise _Unsupported(f"codec {entry[4:8]!r}")
+        width, height = struct.unpack(">HH", entry[32:36])
+        return {"duration": duration / timescale, "codec": codec, "width": width, "height": height}
+    raise _Unsupported("no video track")
+
+
+# Matroska / WebM
+
+EBML_HEADER = 0x1A45DFA3
+SEGMENT = 0x18538067
+SEEK_HEAD, SEEK, SEEK_ID, SEEK_POSITION = 0x114D9B74, 0x4DBB, 0x53AB, 0x53AC
+INFO, TIMECODE_SCALE, DURATION = 0x1549A966, 0x2AD7B1, 0x4489
+TRACKS, TRACK_ENTRY, TRACK_TYPE, CODEC_ID = 0x1654AE6B, 0xAE, 0x83, 0x86
+VIDEO, PIXEL_WIDTH, PIXEL_HEIGHT = 0xE0, 0xB0, 0xBA
+CLUSTER = 0x1F43B675
+DOC_TYPE = 0x4282
+
+
+def _vint(f: BinaryIO, keep_marker: bool) -> tuple[int, int]:
+    """(value, length) of an EBML variable length integer; element sizes with all value bits set are unknown (-1)."""
+    first = _read_exact(f, 1)[0]
+    if not first:
+        raise _Unsupported("bad vint")
+    length = 9 - first.bit_length()
+    value = first if keep_marker else first & (0xFF >> length)
+    for byte in _read_exact(f, length - 1):
+        value = (value << 8) | byte
+    if not keep_marker and value == (1 << (7 * length)) - 1:
+        value = -1
+    return value, length
+
+
+def _elements(f: BinaryIO, start: int, end: int) -> Iterator[tuple[int, int, int]]:
+    """(id, data start, data end) of the elements between two offsets, reading only their headers."""
+    position = start
+    while position < end:
+        f.seek(position)
+        element_id, id_length = _vint(f, keep_marker=True)
+        size, size_length = _vint(f, keep_marker=False)
+        data = position + id_length + size_length
+        if size < 0:
+            # Live recordings leave the Segment and Cluster sizes open, they run to the end
+            if element_id not in (SEGMENT, CLUSTER):
+                raise _Unsupported("unknown size element")
+            size = end - data
+        yield element_id, data, min(data + size, end)
+        position = data + size
+
+
+def _read_uint(f: BinaryIO, start: int, end: int) -> int:
+    f.seek(start)
+    return int.from_bytes(_read_exact(f, end - start), "big")
+
+
+def _read_float(f: BinaryIO, start: int, end: int) -> float:
+    f.seek(start)
+    data = _read_exact(f, end - start)
+    if len(data) == 4:
+        return struct.unpack(">f", data)[0]
+    if len(data) == 8:
+        return struct.unpack(">d", data)[0]
+    raise _Unsupported("bad float")
+
+
+def _read_string(f: BinaryIO, start: int, end: int) -> str:
+    f.seek(start)
+    return _read_exact(f, end - start).rstrip(b"\0").decode("ascii", "replace")
+
+
+def _matroska_info(f: BinaryIO, start: int, end: int) -> float:
+    scale, duration = 1_000_000, None
+    for element_id, data, data_end in _elements(f, start, end):
+        if element_id == TIMECODE_SCALE:
+            scale = _read_uint(f, data, data_end)
+        elif element_id == DURATION:
+            duration = _read_float(f, data, data_end)
+    if not duration:
+        raise _Unsupported("no duration")
+    return duration * scale / 1e9
+
+
+def _matroska_tracks(f: BinaryIO, start: int, end: int) -> dict:
+    for element_id, data, data_end in _elements(f, start, end):
+        if element_id != TRACK_ENTRY:
+            continue
+        track_type = codec_id = video = None
+        for child_id, child, child_end in _elements(f, data, data_end):
+            if child_id == TRACK_TYPE:
+                track_type = _read_uint(f, child, child_end)
+            elif child_id == CODEC_ID:
+                codec_id = _read_string(f, child, child_end)
+            elif child_id == VIDEO:
+                video = (child, child_end)
+        if track_type != 1:
+            continue
+        codec = MATROSKA_CODECS.get(codec_id)
+        if codec is None or video is None:
+            raise _Unsupported(f"codec {codec_id}")
+        width = height = None
+        for child_id, child, child_end in _elements(f, *video):
+            if child_id == PIXEL_WIDTH:
+                width = _read_uint(f, child, child_end)
+            elif child_id == PIXEL_HEIGHT:
+                height = _read_uint(f, child, child_end)
+        if not width or not height:
+            raise _Unsupported("no dimensions")
+        return {"codec": codec, "width": width, "height": height}
+    raise _Unsupported("no video track")
+
+
+def _probe_matroska(f: BinaryIO, file_size: int) -> dict:
+    elements = _elements(f, 0, file_size)
+    element_id, data, data_end = next(elements)
+    if element_id != EBML_HEADER:
+        raise _Unsupported("not EBML")
+    doc_types = [_read_string(f, child, child_end) for child_id, child, child_end in _elements(f, data, data_end) if child_id == DOC_TYPE]
+    if doc_types not in (["matroska"], ["webm"]):
+        raise _Unsupported(f"doc type {doc_types}")
+    element_id, segment, segment_end = next(elements)
+    if element_id != SEGMENT:
+        raise _Unsupported("no segment")
+
+    found: dict[int, tuple[int, int]] = {}
+    seek_positions: dict[int, int] = {}
+    for element_id, data, data_end in _elements(f, segment, segment_end):
+        if element_id in (INFO, TRACKS):
+            found[element_id] = (data, data_end)
+        elif element_id == SEEK_HEAD:
+            for seek_id, seek, seek_end in _elements(f, data, data_end):
+                if seek_id != SEEK:
+                    continue
+                target = position = None
+                for child_id, child, child_end in _elements(f, seek, seek_end):
+                    if child_id == SEEK_ID:
+                        f.seek(child)
+                        target = _vint(f, keep_marker=True)[0]
+                    elif child_id == SEEK_POSITION:
+                        position = _read_uint(f, child, child_end)
+                if target is not None and position is not None:
+                    seek_positions[target] = segment + position
+        elif element_id == CLUSTER:
+            break  # Media data from here on; whatever is still missing is found through the SeekHead
+        if INFO in found and TRACKS in found:
+            break
+
+    for element_id in (INFO, TRACKS):
+        if element_id not in found and element_id in seek_positions:
+            for found_id, data, data_end in _elements(f, seek_positions[element_id], segment_end):
+                if found_id == element_id:
+                    found[element_id] = (data, data_end)
+                break
+    if INFO not in found or TRACKS not in found:
+        raise _Unsupported("no Info or Tracks")
+    return {"duration": _matroska_info(f, *found[INFO]), **_matroska_tracks(f, *found[TRACKS])}
+
+
+def probe_container(path: str) -> dict | None:
+    """duration, codec, width and height of an MP4/MOV or Matroska/WebM file, None if it cannot tell.
+
+    Seeks from box to box (or element to element) and reads only the few
+    headers holding those values, a handful of small reads instead of an
+    ffprobe process. Codec names are ffprobe's `codec_name`; anything
+    unexpected returns None and is left to ffprobe.
+    """
+    try:
+        with open(path, "rb", buffering=4096) as f:
+            file_size = os.fstat(f.fileno()).st_size
+            head = f.read(12)
+            if head[:4] == b"\x1a\x45\xdf\xa3":
+                return _probe_matroska(f, file_size)
+            if head[4:8] in (b"ftyp", b"moov", b"mdat", b"free", b"wide", b"skip"):
+                return _probe_mp4(f, file_size)
+    except (_Unsupported, OSError, struct.error, StopIteration):
+        pass
+    return None
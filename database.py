@@ -1,10 +1,32 @@
-from sqlalchemy import create_engine, Engine
+from sqlalchemy import create_engine, inspect, text, Engine
 from sqlalchemy.orm import sessionmaker, Session
 from models import Base
 from typing import Generator
 from config import get_config
+from lexical_index import ensure_fts_table
 import os
 
+def add_missing_columns(engine: Engine):
+    """Add model columns that an existing database does not have yet.
+
+    create_all only creates missing tables, this covers columns added to
+    existing ones. New columns must be nullable or have a server default.
+    """
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                column_type = column.type.compile(dialect=engine.dialect)
+                print(f"Adding column {table.name}.{column.name}")
+                conn.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+            for index in table.indexes:
+                index.create(conn, checkfirst=True)
+
 def init_db() -> Engine:
     """Initialize database connection and create tables"""
     config = get_config()
@@ -17,6 +39,8 @@ def init_db() -> Engine:
     
     engine = create_engine(db_url)
     Base.metadata.create_all(engine)
+    add_missing_columns(engine)
+    ensure_fts_table(engine)
     return engine
 
 def get_session_factory(engine: Engine) -> sessionmaker:
@@ -0,0 +1,101 @@
+import hashlib
+import os
+import threading
+import uuid
+from collections import OrderedDict
+from typing import Callable
+
+
+class DiskCache:
+    """Size-bounded directory of generated files, least recently used evicted first.
+
+    Files are named by a hash of their key. `get_or_create` runs the
+    producer at most once per key at a time; concurrent callers for the same
+    key wait for it and share the result. The recency order survives
+    restarts approximately, through the files' modification times.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._entries: OrderedDict[str, int] = OrderedDict()  # path -> size, oldest first
+        self._total = 0
+        self._lock = threading.Lock()
+        self._key_locks: dict[str, list] = {}
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+
+    def _load(self):
+        files = []
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                path = os.path.join(root, name)
+                if '.tmp-' in name:
+                    os.remove(path)  # Left behind by an interrupted producer
+                    continue
+                st = os.stat(path)
+                files.append((st.st_mtime, path, st.st_size))
+        for _, path, size in sorted(files):
+            self._entries[path] = size
+            self._total += size
+        with self._lock:
+            self._evict()
+
+    def path_for(self, key: str) -> str:
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, digest[:2], digest + os.path.splitext(key)[1])
+
+    def get(self, key: str) -> str | None:
+        path = self.path_for(key)
+        with self._lock:
+            if path not in self._entries:
+                return None
+            self._entries.move_to_end(path)
+        return path
+
+    def get_or_create(self, key: str, create: Callable[[str], None]) -> str:
+        """Path of the cached file, calling `create(tmp_path)` to write it on a miss."""
+        cached = self.get(key)
+        if cached is not None:
+            return cached
+        path = self.path_for(key)
+        with self._lock:
+            # [lock, callers holding or waiting for it]; dropped once the last one is done
+            key_lock = self._key_locks.setdefault(path, [threading.Lock(), 0])
+            key_lock[1] += 1
+        try:
+            with key_lock[0]:
+                if self.get(key) is not None:
+                    return path
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                tmp_path = f"{path}.tmp-{uuid.uuid4().hex}{os.path.splitext(path)[1]}"
+                try:
+                    create(tmp_path)
+                    os.replace(tmp_path, path)
+                except BaseException:
+                    if os.path.exists(tmp_path):
+                        os.remove(tmp_path)
+                    raise
+                size = os.path.getsize(path)
+                with self._lock:
+                    self._total += size - self._entries.pop(path, 0)
+                    self._entries[path] = size
+                    self._evict(keep=path)
+                return path
+        finally:
+            with self._lock:
+                key_lock[1] -= 1
+                if not key_lock[1]:
+                    del self._key_locks[path]
+
+    def _evict(self, keep: str | None = None):
+        while self._total > self.max_bytes and self._entries:
+            path, size = next(iter(self._entries.items()))
+            if path == keep:
+                break
+            del self._entries[path]
+            self._total -= size
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,124 @@
+import hashlib
+import os
+import numpy as np
+from sqlalchemy.orm import Session
+
+from config import get_config
+from models import VideoEmbedding
+
+
+def text_hash(model_name: str, text: str) -> str:
+    """Hash of the exact input a vector was encoded from (model + text)."""
+    return hashlib.sha1(f"{model_name}\n{text}".encode('utf-8')).hexdigest()
+
+
+class EmbeddingStore:
+    """Memory-mapped float32 matrix of document embeddings.
+
+    Row assignment and the hash of the text each row was encoded from are
+    kept in the `video_embeddings` table, so unchanged documents never have
+    to go through the model again.
+    """
+
+    def __init__(self, path: str, dim: int):
+        self.path = path
+        self.dim = dim
+        self._vectors: np.memmap | None = None
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if not os.path.exists(path):
+            open(path, 'wb').close()
+        self._open()
+
+    def _open(self):
+        rows = os.path.getsize(self.path) // (self.dim * 4)
+        if rows == 0:
+            self._vectors = None
+        else:
+            self._vectors = np.memmap(self.path, dtype='float32', mode='r+', shape=(rows, self.dim))
+
+    @property
+    def capacity(self) -> int:
+        return 0 if self._vectors is None else self._vectors.shape[0]
+
+    def _grow(self, rows: int):
+        if rows <= self.capacity:
+            return
+        # Grow geometrically so appending one video at a time stays cheap
+        new_rows = max(rows, self.capacity * 2, 1024)
+        if self._vectors is not None:
+            self._vectors.flush()
+            self._vectors = None
+        os.truncate(self.path, new_rows * self.dim * 4)
+        self._open()
+
+    def read(self, rows: list[int]) -> np.ndarray:
+        if not rows:
+            return np.empty((0, self.dim), dtype='float32')
+        return np.asarray(self._vectors[np.asarray(rows, dtype='int64')], dtype='float32')
+
+    def write(self, rows: list[int], vectors: np.ndarray):
+        if not rows:
+            return
+        self._grow(max(rows) + 1)
+        self._vectors[np.asarray(rows, dtype='int64')] = vectors
+        self._vectors.flush()
+
+    def sync(self, db: Session, documents: dict[int, str], model_name: str, encode) -> tuple[dict[int, int], list[int]]:
+        """Make sure every document has an up to date vector in the store.
+
+        `documents` maps video id -> text to embed, `encode` turns a list of
+        texts into a float32 matrix. Only new documents and documents whose
+        text changed are encoded. Returns a video id -> row mapping and the
+        ids that were (re-)encoded.
+        """
+        entries = {}
+        video_ids = list(documents.keys())
+        for start in range(0, len(video_ids), 900):  # Stay below SQLite's bound parameter limit
+            chunk = video_ids[start:start + 900]
+            for e in db.query(VideoEmbedding).filter(VideoEmbedding.video_id.in_(chunk)):
+                entries[e.video_id] = e
+        hashes = {vid: text_hash(model_name, text) for vid, text in documents.items()}
+        stale = [vid for vid, h in hashes.items() if vid not in entries or entries[vid].text_hash != h]
+
+        if stale:
+            used_rows = {row for (row,) in db.query(VideoEmbedding.row)}
+            next_row = 0
+            batch_size = int(get_config()['EMBEDDINGS']['sync_batch_size'])
+            print(f"Encoding {len(stale)} of {len(documents)} documents ({len(documents) - len(stale)} cached)")
+            for start in range(0, len(stale), batch_size):
+                chunk = stale[start:start + batch_size]
+                vectors = encode([documents[vid] for vid in chunk])
+                rows = []
+                for vid in chunk:
+                    entry = entries.get(vid)
+                    if entry is None:
+                        # Reuse rows freed by removed videos before appending
+                        while next_row in used_rows:
+                            next_row += 1
+                        used_rows.add(next_row)
+                        entry = VideoEmbedding(video_id=vid, row=next_row, text_hash=hashes[vid])
+                        db.add(entry)
+                        entries[vid] = entry
+                    else:
+                        entry.text_hash = hashes[vid]
+                    rows.append(entry.row)
+                self.write(rows, vectors)
+                db.commit()
+
+        return {vid: entries[vid].row for vid in documents}, stale
+
+    def remove(self, db: Session, video_ids: list[int]):
+        """Forget the vectors of removed videos, their rows are reused later."""
+        if video_ids:
+            db.query(VideoEmbedding).filter(VideoEmbedding.video_id.in_(video_ids)).delete(synchronize_session=False)
+            db.commit()
+
+
+_store: EmbeddingStore | None = None
+
+def get_embedding_store(dim: int) -> EmbeddingStore:
+    global _store
+    if _store is None or _store.dim != dim:
+        store_dir = get_config()['EMBEDDINGS']['store_dir']
+        _store = EmbeddingStore(os.path.join(store_dir, f"vectors_{dim}.f32"), dim)
+    return _store
@@ -0,0 +1,155 @@
+import json
+import logging
+import math
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+import ffmpeg
+from config import get_config
+from disk_cache import DiskCache
+
+logger = logging.getLogger(__name__)
+
+_config = get_config()['HLS']
+segment_cache = DiskCache(_config['cache_dir'], int(_config['cache_size_mb']) * 1024 * 1024)
+_prefetch_executor = ThreadPoolExecutor(max_workers=int(_config['workers']), thread_name_prefix="hls-prefetch")
+
+
+def _codecs(name: str) -> set[str]:
+    return {codec.strip() for codec in _config[name].split(',') if codec.strip()}
+
+
+def probe_keyframes(path: str) -> list[float]:
+    """Presentation times of the video keyframes, read from packet flags without decoding."""
+    result = subprocess.run(
+        ["ffprobe", "-v", "error", "-select_streams", "v:0", "-show_entries", "packet=pts_time,flags", "-of", "csv=p=0", path],
+        capture_output=True, text=True, check=True,
+    )
+    keyframes = []
+    for line in result.stdout.splitlines():
+        pts_time, _, flags = line.partition(',')
+        if 'K' in flags and pts_time not in ('', 'N/A'):
+            keyframes.append(float(pts_time))
+    return sorted(keyframes)
+
+
+def plan_segments(keyframes: list[float], duration: float, target: float) -> list[tuple[float, float]]:
+    """Cut points at the first keyframe at least `target` seconds after the previous cut."""
+    starts = [0.0]
+    for keyframe in keyframes:
+        if keyframe - starts[-1] >= target and duration - keyframe > 0.5:
+            starts.append(keyframe)
+    return [(start, end) for start, end in zip(starts, starts[1:] + [duration])]
+
+
+def _build_plan(path: str) -> dict:
+    probe = ffmpeg.probe(path)
+    video_stream = next((s for s in probe['streams'] if s['codec_type'] == 'video'), None)
+    audio_stream = next((s for s in probe['streams'] if s['codec_type'] == 'audio'), None)
+    if video_stream is None:
+        raise ValueError(f"{path} has no video stream")
+    duration = float(probe['format']['duration'])
+    target = float(_config['segment_seconds'])
+
+    video_copy = video_stream['codec_name'] in _codecs('copy_video_codecs')
+    keyframes = []
+    if video_copy:
+        # Packet times include the container's start offset, -ss positions do not
+        start_time = float(probe['format'].get('start_time') or 0)
+        keyframes = [keyframe - start_time for keyframe in probe_keyframes(path)]
+    if video_copy and not keyframes:
+        video_copy = False  # Without keyframe positions a copied segment cannot start cleanly
+    if video_copy:
+        segments = plan_segments(keyframes, duration, target)
+    else:
+        # The encoder starts every segment with a keyframe, so cut at fixed intervals
+        count = max(math.ceil(duration / target), 1)
+        segments = [(i * target, min((i + 1) * target, duration)) for i in range(count)]
+    return {
+        "duration": duration,
+        "segments": segments,
+        "video_copy": video_copy,
+        "audio_copy": audio_stream is None or audio_stream['codec_name'] in _codecs('copy_audio_codecs'),
+    }
+
+
+def _cache_prefix(video_id: int, version: int) -> str:
+    return f"hls/{video_id}/{version}"
+
+
+def get_plan(video_id: int, path: str, version: int) -> dict:
+    """Segment plan of a video file; `version` (the file's mtime) keys the cache."""
+    def create(tmp_path: str):
+        with open(tmp_path, 'w') as f:
+            json.dump(_build_plan(path), f)
+
+    with open(segment_cache.get_or_create(f"{_cache_prefix(video_id, version)}/plan.json", create)) as f:
+        return json.load(f)
+
+
+def playlist(video_id: int, path: str, version: int) -> str:
+    plan = get_plan(video_id, path, version)
+    segments = plan["segments"]
+    lines = [
+        "#EXTM3U",
+        "#EXT-X-VERSION:3",
+        f"#EXT-X-TARGETDURATION:{max(math.ceil(end - start) for start, end in segments)}",
+        "#EXT-X-MEDIA-SEQUENCE:0",
+        "#EXT-X-PLAYLIST-TYPE:VOD",
+    ]
+    for index, (start, end) in enumerate(segments):
+        lines.append(f"#EXTINF:{end - start:.3f},")
+        lines.append(f"{version}/{index}.ts")
+    lines.append("#EXT-X-ENDLIST")
+    return "\n".join(lines) + "\n"
+
+
+def _write_segment(path: str, plan: dict, index: int, tmp_path: str):
+    start, end = plan["segments"][index]
+    options = {
+        "format": "mpegts",
+        "output_ts_offset": start,  # Segments keep the source timeline
+        "muxdelay": 0,
+        "acodec": "copy" if plan["audio_copy"] else "aac",
+    }
+    if plan["video_copy"]:
+        options["vcodec"] = "copy"
+    else:
+        options.update(vcodec="libx264", preset=_config['preset'], crf=_config['crf'], pix_fmt="yuv420p")
+    if not plan["audio_copy"]:
+        options["audio_bitrate"] = "160k"
+    try:
+        (
+            ffmpeg
+            .input(path, ss=start, t=end - start)
+            .output(tmp_path, **options)
+            .overwrite_output()
+            .run(capture_stdout=True, capture_stderr=True)
+        )
+    except ffmpeg.Error as e:
+        logger.error(f"HLS segment {index} of {path} failed: {e.stderr.decode(errors='replace')}")
+        raise
+
+
+def get_segment(video_id: int, path: str, version: int, index: int, prefetch: bool = True) -> str:
+    """Path of a cached segment, remuxing or transcoding it first if needed."""
+    plan = get_plan(video_id, path, version)
+    if not 0 <= index < len(plan["segments"]):
+        raise IndexError(index)
+    segment = segment_cache.get_or_create(
+        f"{_cache_prefix(video_id, version)}/{index}.ts",
+        lambda tmp_path: _write_segment(path, plan, index, tmp_path),
+    )
+    if prefetch:
+        # Playback moves forward, have the next segments ready before they are asked for
+        last = min(index + int(_config['prefetch_segments']), len(plan["segments"]) - 1)
+        for following in range(index + 1, last + 1):
+            if segment_cache.get(f"{_cache_prefix(video_id, version)}/{following}.ts") is None:
+                _prefetch_executor.submit(_prefetch, video_id, path, version, following)
+    return segment
+
+
+def _prefetch(video_id: int, path: str, version: int, index: int):
+    try:
+        get_segment(video_id, path, version, index, prefetch=False)
+    except Exception as e:
+        logger.warning(f"Prefetching HLS segment {index} of {path} failed: {e}")
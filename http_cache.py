@@ -0,0 +1,84 @@
+import hashlib
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from fastapi import Request, Response
+from fastapi.staticfiles import StaticFiles
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+from models import CatalogState, Video
+
+
+def bump_catalog_version(db: Session):
+    """Invalidate every cached catalog response."""
+    now = datetime.utcnow()
+    updated = db.query(CatalogState).filter(CatalogState.id == 1).update(
+        {CatalogState.version: CatalogState.version + 1, CatalogState.updated_at: now},
+        synchronize_session=False,
+    )
+    if not updated:
+        db.add(CatalogState(id=1, version=1, updated_at=now))
+    db.commit()
+
+
+def catalog_version(db: Session) -> tuple[int, datetime | None]:
+    row = db.execute(select(CatalogState.version, CatalogState.updated_at).where(CatalogState.id == 1)).first()
+    return (row.version, row.updated_at) if row else (0, None)
+
+
+def video_stamp(db: Session, video_id: int) -> datetime | None:
+    """When the video's response last changed, None if there is no such video."""
+    row = db.execute(select(Video.updated_at, Video.created_at).where(Video.id == video_id)).first()
+    if row is None:
+        return None
+    # Rows from before the column existed have no updated_at
+    return row.updated_at or row.created_at or datetime(1970, 1, 1)
+
+
+def make_etag(*parts, weak: bool = True) -> str:
+    digest = hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()[:20]
+    return f'W/"{digest}"' if weak else f'"{digest}"'
+
+
+def _http_date(value: datetime) -> str:
+    return format_datetime(value.replace(tzinfo=timezone.utc, microsecond=0), usegmt=True)
+
+
+def _is_fresh(request: Request, etag: str, last_modified: datetime | None) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        # Weak comparison, If-Modified-Since is ignored when If-None-Match is present
+        tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        return "*" in tags or etag.removeprefix("W/") in tags
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since and last_modified is not None:
+        try:
+            since = parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        if since.tzinfo is None:
+            since = since.replace(tzinfo=timezone.utc)
+        return last_modified.replace(tzinfo=timezone.utc, microsecond=0) <= since
+    return False
+
+
+def conditional(request: Request, etag: str, last_modified: datetime | None = None, cache_control: str = "no-cache") -> tuple[dict, Response | None]:
+    """Validator headers for a response, plus a 304 response if the client's copy is current."""
+    headers = {"ETag": etag, "Cache-Control": cache_control}
+    if last_modified is not None:
+        headers["Last-Modified"] = _http_date(last_modified)
+    if _is_fresh(request, etag, last_modified):
+        return headers, Response(status_code=304, headers=headers)
+    return headers, None
+
+
+class RevalidatedStaticFiles(StaticFiles):
+    """StaticFiles that clients cache briefly and then revalidate with the ETag.
+
+    Thumbnails, previews and sprites keep their names when they are
+    regenerated, so they cannot be cached as immutable.
+    """
+
+    def file_response(self, *args, **kwargs) -> Response:
+        response = super().file_response(*args, **kwargs)
+        response.headers["Cache-Control"] = "public, max-age=300"
+        return response
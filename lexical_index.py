@@ -0,0 +1,85 @@
+import hashlib
+import json
+import re
+from sqlalchemy import Engine, text
+from sqlalchemy.orm import Session
+
+# rowid is the video id, doc_hash lets a sync skip unchanged documents
+FTS_TABLE_DDL = """
+CREATE VIRTUAL TABLE IF NOT EXISTS video_fts USING fts5(
+    document,
+    doc_hash UNINDEXED,
+    tokenize = 'unicode61 remove_diacritics 2',
+    prefix = '2 3'
+)
+"""
+
+
+def ensure_fts_table(engine: Engine):
+    """Create the FTS5 table if the database does not have it yet."""
+    if engine.dialect.name != 'sqlite':
+        return
+    with engine.begin() as conn:
+        conn.execute(text(FTS_TABLE_DDL))
+
+
+def document_hash(document: str) -> str:
+    return hashlib.sha1(document.encode('utf-8')).hexdigest()
+
+
+def upsert_documents(db: Session, documents: dict[int, str]):
+    """Write the search documents of the given videos (video id -> text)."""
+    if not documents:
+        return
+    params = [{"id": vid, "document": doc, "doc_hash": document_hash(doc)} for vid, doc in documents.items()]
+    db.execute(text("DELETE FROM video_fts WHERE rowid = :id"), params)
+    db.execute(text("INSERT INTO video_fts (rowid, document, doc_hash) VALUES (:id, :document, :doc_hash)"), params)
+    db.commit()
+
+
+def remove_documents(db: Session, video_ids: list[int]):
+    if not video_ids:
+        return
+    db.execute(text("DELETE FROM video_fts WHERE rowid = :id"), [{"id": vid} for vid in video_ids])
+    db.commit()
+
+
+def sync_documents(db: Session, documents: dict[int, str]) -> int:
+    """Bring the whole table in line with `documents`, returns the number of rows written."""
+    indexed = dict(db.execute(text("SELECT rowid, doc_hash FROM video_fts")).all())
+    changed = {vid: doc for vid, doc in documents.items() if indexed.get(vid) != document_hash(doc)}
+    upsert_documents(db, changed)
+    remove_documents(db, [vid for vid in indexed if vid not in documents])
+    return len(changed)
+
+
+def build_match_expression(terms: list[str]) -> str | None:
+    """Turn free text terms into an FTS5 MATCH expression.
+
+    Every term becomes a quoted phrase, so punctuation in scene codes and
+    filenames (ABC-123, some.movie.name) matches adjacent tokens instead of
+    being parsed as FTS5 syntax. Documents matching any term qualify, bm25
+    ranks documents matching more of them higher.
+    """
+    phrases = []
+    for term in terms:
+        tokens = re.findall(r"\w+", term)
+        if tokens:
+            phrases.append('"' + ' '.join(tokens) + '"')
+    if not phrases:
+        return None
+    return ' OR '.join(phrases)
+
+
+def search_bm25(db: Session, terms: list[str], limit: int, allowed_ids: set[int] | None = None) -> list[int]:
+    """Return video ids ordered by BM25 relevance."""
+    match = build_match_expression(terms)
+    if match is None:
+        return []
+    sql = "SELECT rowid FROM video_fts WHERE video_fts MATCH :match"
+    params = {"match": match, "limit": limit}
+    if allowed_ids is not None:
+        sql += " AND rowid IN (SELECT value FROM json_each(:allowed))"
+        params["allowed"] = json.dumps(list(allowed_ids))
+    sql += " ORDER BY bm25(video_fts) LIMIT :limit"
+    return [row[0] for row in db.execute(text(sql), params)]
@@ -0,0 +1,107 @@
+import base64
+import json
+from datetime import datetime
+from typing import Iterator, List
+from sqlalchemy import tuple_
+from sqlalchemy.orm import Session
+from models import Video
+from video_rows import FIELDS, row_to_dict, select_video_rows
+
+# Every sort column has an index; SQLite appends the rowid (Video.id) to
+# secondary indexes, so (column, id) keyset scans need no extra sort step
+SORT_KEYS = {
+    "id": Video.id,
+    "created_at": Video.created_at,
+    "filename": Video.filename,
+    "duration": Video.duration,
+    "size": Video.size,
+}
+
+
+def parse_fields(fields: str | None) -> List[str] | None:
+    """Split a `fields=` parameter, None means every field."""
+    if not fields:
+        return None
+    names = [name.strip() for name in fields.split(',') if name.strip()]
+    unknown = [name for name in names if name not in FIELDS]
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(unknown)}")
+    if "id" not in names:
+        names.insert(0, "id")
+    return names
+
+
+def encode_cursor(sort: str, value, video_id: int) -> str:
+    if isinstance(value, datetime):
+        value = value.isoformat()
+    raw = json.dumps([sort, value, video_id], separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(sort: str, cursor: str) -> tuple:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        cursor_sort, value, video_id = json.loads(raw)
+    except (ValueError, TypeError) as e:
+        raise ValueError("Invalid cursor") from e
+    if cursor_sort != sort:
+        raise ValueError("Cursor was issued for a different sort order")
+    if sort == "created_at" and value is not None:
+        value = datetime.fromisoformat(value)
+    return value, int(video_id)
+
+
+def _base_query(sort: str, descending: bool, fields: List[str] | None):
+    column = SORT_KEYS[sort]
+    query = select_video_rows(fields, extra=[column.label("_sort"), Video.id.label("_id")]).where(Video.duration > 1)
+    if sort != "id":
+        # NULLs would break the row-value comparison, they are never listed anyway
+        query = query.where(column != None)
+        order = (column.desc(), Video.id.desc()) if descending else (column, Video.id)
+    else:
+        order = (Video.id.desc(),) if descending else (Video.id,)
+    return query.order_by(*order)
+
+
+def _after(query, sort: str, descending: bool, value, video_id: int):
+    if sort == "id":
+        return query.where(Video.id < video_id if descending else Video.id > video_id)
+    key = tuple_(SORT_KEYS[sort], Video.id)
+    return query.where(key < (value, video_id) if descending else key > (value, video_id))
+
+
+def check_listing_params(sort: str, cursor: str | None) -> tuple | None:
+    """Validate sort and cursor, returns the decoded cursor if there is one."""
+    if sort not in SORT_KEYS:
+        raise ValueError(f"sort must be one of {', '.join(SORT_KEYS)}")
+    return decode_cursor(sort, cursor) if cursor else None
+
+
+def list_videos_page(db: Session, sort: str = "id", descending: bool = False, limit: int | None = None, cursor: str | None = None, fields: List[str] | None = None) -> tuple[List[dict], str | None]:
+    """One page of the catalog in keyset order, returns (response rows, next cursor).
+
+    Without a limit the rest of the catalog is returned and the cursor is None.
+    """
+    after = check_listing_params(sort, cursor)
+    query = _base_query(sort, descending, fields)
+    if after is not None:
+        query = _after(query, sort, descending, *after)
+    if limit is not None:
+        query = query.limit(limit + 1)
+    rows = db.execute(query).all()
+
+    next_cursor = None
+    if limit is not None and len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]._mapping
+        next_cursor = encode_cursor(sort, last["_sort"], last["_id"])
+    return [row_to_dict(row, fields) for row in rows], next_cursor
+
+
+def iter_video_pages(db: Session, sort: str = "id", descending: bool = False, cursor: str | None = None, fields: List[str] | None = None, batch_size: int = 500) -> Iterator[List[dict]]:
+    """Walk the catalog page by page, so only one batch is in memory at a time."""
+    while True:
+        rows, cursor = list_videos_page(db, sort, descending, batch_size, cursor, fields)
+        yield rows
+        if cursor is None:
+            return
@@ -1,18 +1,34 @@
 import asyncio
 import os
-from fastapi import FastAPI, HTTPException, Depends, Query, Request
-from fastapi.staticfiles import StaticFiles
+import subprocess
+import time
+from datetime import datetime
+from fastapi import FastAPI, HTTPException, Depends, Path, Query, Request, Response
+from fastapi.responses import FileResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 
 from typing import Callable, List
-from sqlalchemy.orm import Session, defer, joinedload
-from models import Task, TorrentFile, Video, VideoSchema, VideoTagSet
+from sqlalchemy import select
+from sqlalchemy.orm import Session, defer
+from models import Task, Thumbnail, Video, VideoSchema, VideoTagSet
 from database import SessionLocal, get_db
 from config import get_config, get_media_folders
-from range import range_requests_response
+from range import RangeFileResponse
+from stream_cache import stream_handles
+from watcher import media_watcher
+from scanner import duplicate_groups
+import ffmpeg
+import hls
+from thumbnail_variants import FORMATS, get_variant, supported_formats, variant_width
+from starlette.concurrency import run_in_threadpool
 from tasks import process_queue
-from query import ParsedQuery, parse_query_string, search_query
+from query import SEARCH_MODES, ParsedQuery, parse_query_string, search_query
 from vector_index import search_similar_from_video
+from model_manager import model_manager
+from similarity_graph import similar_videos
+from listing import SORT_KEYS, check_listing_params, iter_video_pages, list_videos_page, parse_fields
+from video_rows import FastJSONResponse, dumps, load_video_rows
+from http_cache import RevalidatedStaticFiles, bump_catalog_version, catalog_version, conditional, make_etag, video_stamp
 from pyinstrument import Profiler
 from pyinstrument.renderers.html import HTMLRenderer
 from pyinstrument.renderers.speedscope import SpeedscopeRenderer
@@ -29,36 +45,66 @@ app.add_middleware(
 )
 
 # Mount static files for thumbnails
-app.mount("/static", StaticFiles(directory="static"), name="static")
+app.mount("/static", RevalidatedStaticFiles(directory="static"), name="static")
 
 
 @app.get("/")
 def read_root():
     return {"message": "Video Backend API"}
 
+@app.get("/models")
+def get_models():
+    """Load state and memory use of the ML models"""
+    return {"models": model_manager.status(), "memory": model_manager.memory_summary()}
+
 @app.get("/videos", response_model=List[VideoSchema])
-def list_videos(db: Session = Depends(get_db)):
-    # profiler = Profiler()
-    # profiler.start()
-    
-    videos = (
-        db.query(Video)
-        .filter(Video.duration > 1)
-        .options(
-            joinedload(Video.thumbnails),
-            joinedload(Video.tag_sets)
-        )
-        .all()
-    )
-    # profiler.stop()
+def list_videos(
+    request: Request,
+    limit: int | None = Query(None, ge=1, description="Page size, all videos if omitted"),
+    cursor: str | None = Query(None, description="X-Next-Cursor of the previous page"),
+    sort: str = Query("id", description=f"One of {', '.join(SORT_KEYS)}"),
+    order: str = Query("asc", pattern="^(asc|desc)$"),
+    fields: str | None = Query(None, description="Comma separated fields to return, e.g. id,filename,thumbnail_paths"),
+    format: str | None = Query(None, description="json or ndjson"),
+    db: Session = Depends(get_db),
+):
+    descending = order == "desc"
+    ndjson = format == "ndjson" or (format is None and "application/x-ndjson" in request.headers.get("accept", ""))
+    version, changed_at = catalog_version(db)
+    headers, not_modified = conditional(request, make_etag("videos", version, ndjson, str(request.query_params)), changed_at)
+    if not_modified:
+        return not_modified
+    try:
+        selected = parse_fields(fields)
+        if ndjson:
+            # Bulk export: the whole catalog from the cursor on, one JSON object per line
+            check_listing_params(sort, cursor)
+            return StreamingResponse(_stream_videos(sort, descending, cursor, selected), media_type="application/x-ndjson", headers=headers)
+        rows, next_cursor = list_videos_page(db, sort, descending, limit, cursor, selected)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    if next_cursor:
+        headers["X-Next-Cursor"] = next_cursor
+    return FastJSONResponse(rows, headers=headers)
+
+def _stream_videos(sort: str, descending: bool, cursor: str | None, fields: List[str] | None):
+    # The request's session is closed before the body is streamed, use our own
+    db: Session = SessionLocal()
+    try:
+        for rows in iter_video_pages(db, sort, descending, cursor, fields):
+            yield b"".join(dumps(row) + b"\n" for row in rows)
+    finally:
+        db.close()
 
-    # # we dump the profiling into a file
-    # with open(f"profiler/profile2.speedscope.json", "w") as out:
-    #     out.write(profiler.output(renderer=SpeedscopeRenderer()))
-    return videos
+_default_budget_ms = int(get_config()['RERANKER']['budget_ms'])
 
 @app.get("/videos/search", response_model=List[VideoSchema])
-def search_videos(q: str = Query(..., description="Search query"), limit: int = 10, rerank: bool = True, db: Session = Depends(get_db)):
+def search_videos(q: str = Query(..., description="Search query"), limit: int = 10, rerank: bool = True, mode: str = Query("hybrid", description="hybrid, vector or keyword"), budget_ms: int | None = Query(None, description="Latency budget for reranking"), db: Session = Depends(get_db)):
+    if budget_ms is None:
+        budget_ms = _default_budget_ms
+    deadline = time.monotonic() + budget_ms / 1000 if budget_ms > 0 else None
+
     profiler = Profiler()
     profiler.start()
         
@@ -68,17 +114,48 @@ def search_videos(q: str = Query(..., description="Search query"), limit: int =
     path = parsed_query["filters"].get("path")
     vision = parsed_query["filters"].get("vision")
 
-    videos = search_query(db, terms=terms, tags=tags, path=path, vision=vision, limit=limit, rerank=rerank)
+    if mode not in SEARCH_MODES:
+        raise HTTPException(status_code=400, detail=f"mode must be one of {', '.join(SEARCH_MODES)}")
+
+    videos = search_query(db, terms=terms, tags=tags, path=path, vision=vision, limit=limit, rerank=rerank, mode=mode, deadline=deadline)
 
     profiler.stop()
     # we dump the profiling into a file
     with open(f"profiler/profile.speedscope.json", "w") as out:
         out.write(profiler.output(renderer=SpeedscopeRenderer()))
 
-    return videos
+    return FastJSONResponse(load_video_rows(db, [video.id for video in videos]))
+
+@app.get("/videos/duplicates", response_model=List[List[VideoSchema]])
+def list_duplicates(request: Request, fields: str | None = Query(None, description="Comma separated fields to return"), db: Session = Depends(get_db)):
+    """Groups of videos that are copies of the same file"""
+    version, changed_at = catalog_version(db)
+    headers, not_modified = conditional(request, make_etag("duplicates", version, fields), changed_at)
+    if not_modified:
+        return not_modified
+    try:
+        selected = parse_fields(fields)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return FastJSONResponse([load_video_rows(db, group, selected) for group in duplicate_groups(db)], headers=headers)
+
+# Neighbour lists are precomputed to this length
+_similar_limit = int(get_config()['SIMILARITY']['neighbors'])
 
 @app.get("/videos/{video_id}/similar", response_model=List[VideoSchema])
-def get_similar_videos_by_id(video_id: int, limit: int = 20, db: Session = Depends(get_db)):
+def get_similar_videos_by_id(video_id: int, request: Request, response: Response, limit: int = Query(min(20, _similar_limit), ge=1, le=_similar_limit), db: Session = Depends(get_db)):
+    # Neighbours only change when a task runs
+    version, changed_at = catalog_version(db)
+    headers, not_modified = conditional(request, make_etag("similar", version, video_id, limit), changed_at)
+    if not_modified:
+        return not_modified
+    response.headers.update(headers)
+
+    # Precomputed by the similarity_graph task, one indexed lookup
+    result = similar_videos(db, video_id, limit)
+    if result:
+        return result
+
     video = db.get(Video, video_id)
     if not video:
         raise HTTPException(status_code=404, detail="No video found for this video")
@@ -86,53 +163,123 @@ def get_similar_videos_by_id(video_id: int, limit: int = 20, db: Session = Depen
     return result
 
 @app.get("/videos/{video_id}", response_model=VideoSchema)
-def get_video_details(video_id: int, db: Session = Depends(get_db)):
+def get_video_details(video_id: int, request: Request, response: Response, db: Session = Depends(get_db)):
     """Get detailed metadata for a video"""
+    stamp = video_stamp(db, video_id)
+    if stamp is None:
+        raise HTTPException(status_code=404, detail="Video not found")
+    headers, not_modified = conditional(request, make_etag("video", video_id, stamp.isoformat()), stamp)
+    if not_modified:
+        return not_modified
+    response.headers.update(headers)
+
     video = db.query(Video).filter(Video.id == video_id).first()
     if not video:
         raise HTTPException(status_code=404, detail="Video not found")
     
     return video
 
-@app.get("/videos/{video_id}/stream.mp4")
-async def stream_video(
-    video_id: int,
-    request: Request,
-    db: Session = Depends(get_db)
-):
-    """Stream video file with HTTP Range support"""
-    video = db.query(Video).filter(Video.id == video_id).first()
-    if not video or not os.path.exists(video.path):
+@app.get("/videos/{video_id}/stream.{extension}")
+async def stream_video(video_id: int, extension: str, request: Request):
+    """Stream video file with HTTP Range support, any extension serves the file as it is"""
+    # Cached handles answer without touching the database or the filesystem
+    handle = stream_handles.acquire_cached(video_id) or await run_in_threadpool(stream_handles.acquire, video_id)
+    if handle is None:
         raise HTTPException(status_code=404, detail="Video not found")
+    try:
+        return RangeFileResponse(
+            request, handle.path, handle.content_type, stat_result=handle.stat_result,
+            fd=handle.fd, on_close=lambda: stream_handles.release(handle),
+        )
+    except BaseException:
+        stream_handles.release(handle)
+        raise
 
-    return range_requests_response(
-        request, file_path=video.path, content_type="video/mp4"
-    )
+def _hls_source(video_id: int) -> tuple[str, int]:
+    """Path of the video file and its version (mtime), part of every segment URL."""
+    handle = stream_handles.acquire(video_id)
+    if handle is None:
+        raise HTTPException(status_code=404, detail="Video not found")
+    stream_handles.release(handle)
+    return handle.path, handle.stat_result.st_mtime_ns
+
+@app.get("/videos/{video_id}/hls/index.m3u8")
+def hls_playlist(video_id: int):
+    """HLS playlist, segments are remuxed (or transcoded) on first request"""
+    path, version = _hls_source(video_id)
+    try:
+        content = hls.playlist(video_id, path, version)
+    except (ffmpeg.Error, subprocess.CalledProcessError, ValueError) as e:
+        raise HTTPException(status_code=422, detail=f"Video cannot be played as HLS: {e}")
+    return Response(content, media_type="application/vnd.apple.mpegurl", headers={"Cache-Control": "no-cache"})
 
-@app.get("/videos/{video_id}/stream.avi")
-async def stream_video(
+@app.get("/videos/{video_id}/hls/{version}/{index}.ts")
+def hls_segment(video_id: int, version: int, index: int, request: Request):
+    path, current = _hls_source(video_id)
+    if version != current:
+        raise HTTPException(status_code=404, detail="Video file changed, reload the playlist")
+    try:
+        segment = hls.get_segment(video_id, path, version, index)
+    except IndexError:
+        raise HTTPException(status_code=404, detail="Segment not found")
+    except (ffmpeg.Error, subprocess.CalledProcessError, ValueError) as e:
+        raise HTTPException(status_code=422, detail=f"Video cannot be played as HLS: {e}")
+    # The URL changes with the file, so a segment never changes under it
+    return RangeFileResponse(request, segment, "video/mp2t", headers={"Cache-Control": "public, max-age=31536000, immutable"})
+
+@app.get("/thumbnails/{video_id}/{index}")
+async def get_thumbnail(
     video_id: int,
     request: Request,
-    db: Session = Depends(get_db)
+    index: int = Path(..., ge=0, description="Thumbnail number, in time order"),
+    width: int | None = Query(None, ge=1, description="Wanted width, rounded up to a configured size; original size if omitted"),
+    format: str = Query("jpeg", description="jpeg, webp or avif"),
 ):
-    """Stream video file with HTTP Range support"""
-    video = db.query(Video).filter(Video.id == video_id).first()
-    if not video or not os.path.exists(video.path):
-        raise HTTPException(status_code=404, detail="Video not found")
+    """A video's thumbnail, resized and re-encoded on first request"""
+    if format not in supported_formats():
+        raise HTTPException(status_code=400, detail=f"format must be one of {', '.join(supported_formats())}")
+    path = await run_in_threadpool(_thumbnail_path, video_id, index)
+    try:
+        st = os.stat(path) if path else None
+    except OSError:
+        st = None
+    if st is None:
+        raise HTTPException(status_code=404, detail="Thumbnail not found")
 
-    return range_requests_response(
-        request, file_path=video.path, content_type="video/avi"
+    width = variant_width(width)
+    # The URL stays the same when the thumbnail is regenerated, so clients revalidate after a day
+    headers, not_modified = conditional(
+        request,
+        make_etag("thumbnail", path, st.st_mtime_ns, width, format, weak=False),
+        datetime.utcfromtimestamp(st.st_mtime),
+        cache_control="public, max-age=86400",
     )
+    if not_modified:
+        return not_modified
+    variant = await run_in_threadpool(get_variant, path, st.st_mtime_ns, width, format)
+    return FileResponse(variant, media_type=FORMATS[format][1], headers=headers)
+
+def _thumbnail_path(video_id: int, index: int) -> str | None:
+    db: Session = SessionLocal()
+    try:
+        return db.execute(
+            select(Thumbnail.path).where(Thumbnail.video_id == video_id).order_by(Thumbnail.timestamp, Thumbnail.id).offset(index).limit(1)
+        ).scalar()
+    finally:
+        db.close()
 
 @app.post("/scan")
-def trigger_scan(db: Session = Depends(get_db)):
+def trigger_scan(
+    full: bool = Query(False, description="List every directory, also catching files rewritten in place"),
+    db: Session = Depends(get_db),
+):
     """Trigger a new media scan"""
     media_folders = get_media_folders()
     # Create scan task
     task = Task(
         type='scan',
         status='pending',
-        payload=str(media_folders)
+        payload=str({'media_folders': media_folders, 'full': full})
     )
     db.add(task)
     db.commit()
@@ -142,27 +289,19 @@ def trigger_scan(db: Session = Depends(get_db)):
 
 @app.on_event("startup")
 async def startup_event():
+    from torrent_metadata import link_torrent_files
+    from search_document import update_search_documents
     db: Session = SessionLocal()
-    videos = db.query(Video).filter(Video.torrent_file_id == None).all()
-    for video in videos:
-        torrentfile_search = video.searchpath.replace("\\", "/")  # Ensure search path is in correct format
-        results = db.query(TorrentFile).filter(TorrentFile.path == torrentfile_search).all()
-        if results:
-            if len(results) > 1:
-                print(f"Warning: Multiple torrent files found for video {video.id}: {results}")
-            else:
-                video.torrent_file = results[0]
-                db.commit()
-                print(f"Updated video {video.id} with torrent file {results[0].id}")
-    
-    videos = db.query(Video).filter(Video.torrent_tags == None).all()
-    for video in videos:
-        if video.torrent_file and video.torrent_file.torrent and video.torrent_file.torrent.taglist:
-            video.torrent_tags = video.torrent_file.torrent.taglist
-            db.commit()
-            print(f"Updated video {video.id} with torrent tags {video.torrent_tags}")
+    update_search_documents(db, link_torrent_files(db))
+    bump_catalog_version(db)
     db.close()
     asyncio.create_task(process_queue())  # fire and forget background loop
+    if get_config()['WATCHER'].getboolean('enabled'):
+        media_watcher.start()
+
+@app.on_event("shutdown")
+def shutdown_event():
+    media_watcher.stop()
 
 if __name__ == "__main__":
     import uvicorn
@@ -1,9 +1,14 @@
 import os
+import time
+from collections import Counter, deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 import ffmpeg
 from datetime import datetime
 from database import SessionLocal
 from models import Video, Thumbnail, Task
 from config import get_config
+from batch_writer import BatchWriter
+from container_probe import probe_container
 import logging
 from sqlalchemy.orm import Session
 import json
@@ -11,59 +16,140 @@ import json
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+def _is_rotational(device: int) -> bool | None:
+    """Whether a block device is a spinning disk, None if unknown (network mounts, other platforms)."""
+    sys_dir = os.path.realpath(f"/sys/dev/block/{os.major(device)}:{os.minor(device)}")
+    # Partitions have no queue/ of their own, the disk they are on does
+    for queue_dir in (sys_dir, os.path.dirname(sys_dir)):
+        try:
+            with open(os.path.join(queue_dir, "queue", "rotational")) as f:
+                return f.read().strip() == "1"
+        except OSError:
+            continue
+    return None
+
+def _device_limit(device: int, cfg) -> int:
+    if _is_rotational(device):
+        limit = int(cfg['rotational_device_concurrency'])
+    else:
+        limit = int(cfg['device_concurrency'])
+    return max(limit, 1)  # 0 would never probe the device's files
+
 def extract_metadata(db: Session):
-    """Extract metadata for videos without complete info"""
+    """Extract metadata for videos without complete info
+
+    Probes run in a thread pool (ffprobe does the work in its own process),
+    with at most `device_concurrency` at a time per device, and fewer on
+    spinning disks so they are not made to seek between files.
+    """
+    cfg = get_config()['METADATA']
+    workers = int(cfg['workers']) or os.cpu_count() or 1
+    native = cfg.getboolean('native_probe')
     # Get videos needing metadata
-    videos = db.query(Video).filter(Video.duration == None).all()
-    
+    videos = db.query(Video.id, Video.path).filter(Video.duration == None).all()
+
+    queues: dict[int, deque] = {}
     for video in videos:
         try:
-            process_video_metadata(db, video)
-        except Exception as e:
-            logger.error(f"Failed to process {video.path}: {e}")
+            device = os.stat(video.path).st_dev
+        except OSError:
+            logger.warning(f"File not found: {video.path}")
             continue
+        queues.setdefault(device, deque()).append(video)
+    limits = {device: _device_limit(device, cfg) for device in queues}
+
+    started = time.monotonic()
+    probed = failed = 0
+    in_flight: dict[Future, tuple[int, object]] = {}
+    active = Counter()
+    with BatchWriter(db) as writer, ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ffprobe") as executor:
+        while queues or in_flight:
+            # Keep every device busy up to its limit, round robin so one big folder doesn't hold up the rest
+            for device in list(queues):
+                queue = queues[device]
+                while queue and active[device] < limits[device] and len(in_flight) < workers:
+                    video = queue.popleft()
+                    in_flight[executor.submit(probe_video, video.path, native)] = (device, video)
+                    active[device] += 1
+                if not queue:
+                    del queues[device]
+
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                device, video = in_flight.pop(future)
+                active[device] -= 1
+                try:
+                    record_metadata(writer, video.id, future.result())
+                    probed += 1
+                except Exception as e:
+                    logger.error(f"Failed to process {video.path}: {e}")
+                    failed += 1
+                if (probed + failed) % 500 == 0:
+                    _log_throughput(probed, failed, started)
+    _log_throughput(probed, failed, started)
+
+def _log_throughput(probed: int, failed: int, started: float):
+    elapsed = max(time.monotonic() - started, 1e-6)
+    logger.info(f"Processed metadata for {probed} videos ({failed} failed) in {elapsed:.1f}s, {(probed + failed) / elapsed:.1f} files/s")
+
+def probe_video(path: str, native: bool) -> dict | None:
+    """Video columns read from a file, None if it has no video stream
+
+    With `native`, MP4 and Matroska headers are read directly and ffprobe
+    only runs for files they don't describe.
+    """
+    if native:
+        values = probe_container(path)
+        if values is not None:
+            return {**values, "size": os.path.getsize(path)}
+    # Get video metadata
+    probe = ffmpeg.probe(path)
+    video_stream = next(
+        (stream for stream in probe['streams'] if stream['codec_type'] == 'video'),
+        None
+    )
+    if video_stream is None:
+        return None
+    return {
+        "duration": float(probe['format']['duration']),
+        "codec": video_stream['codec_name'],
+        "width": int(video_stream['width']),
+        "height": int(video_stream['height']),
+        "size": os.path.getsize(path),
+    }
+
+def record_metadata(writer: BatchWriter, video_id: int, values: dict | None):
+    """Queue the probed columns of a video and its preview, thumbnail and sprite tasks"""
+    if values is None:
+        return
+    # Update video metadata
+    writer.update(Video, {"id": video_id, **values})
+    for task_type in ('preview', 'thumbnail', 'sprites'):
+        writer.insert(Task, {
+            "type": task_type,
+            "status": 'pending',
+            "payload": str(video_id),
+            "created_at": datetime.utcnow(),
+        })
+
+def process_video_metadata(db: Session, video, writer: BatchWriter | None = None):
+    """Extract metadata for a video and queue its preview, thumbnails and sprites
+
+    `video` needs an id and a path. Writes go through `writer` and land with
+    its next flush; without one they are written before returning.
+    """
+    if writer is None:
+        with BatchWriter(db) as writer:
+            return process_video_metadata(db, video, writer)
 
-def process_video_metadata(db: Session, video: Video):
-    """Extract metadata and generate thumbnails for a video"""
     if not os.path.exists(video.path):
         logger.warning(f"File not found: {video.path}")
         return
-        
+
     try:
-        # Get video metadata
-        probe = ffmpeg.probe(video.path)
-        video_stream = next(
-            (stream for stream in probe['streams'] if stream['codec_type'] == 'video'),
-            None
-        )
-        
-        if video_stream:
-            # Update video metadata
-            video.duration = float(probe['format']['duration'])
-            video.codec = video_stream['codec_name']
-            video.width = int(video_stream['width'])
-            video.height = int(video_stream['height'])
-            video.size = os.path.getsize(video.path)
-            
-            db.commit()
-            logger.info(f"Processed metadata for {video.path}")
-
-            task = Task(
-                type='preview',
-                status='pending',
-                payload=str(video.id),
-                created_at=datetime.utcnow()
-            )
-            db.add(task)
-            task = Task(
-                type='thumbnail',
-                status='pending',
-                payload=str(video.id),
-                created_at=datetime.utcnow()
-            )
-            db.add(task)
-            db.commit()
-            
+        native = get_config()['METADATA'].getboolean('native_probe')
+        record_metadata(writer, video.id, probe_video(video.path, native))
+        logger.debug(f"Processed metadata for {video.path}")
     except Exception as e:
         logger.error(f"Error processing {video.path}: {e}")
         raise
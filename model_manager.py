@@ -0,0 +1,190 @@
+import gc
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable
+
+from config import get_config
+
+# loader(device, backend) -> model
+Loader = Callable[[str, str], Any]
+
+
+def _settings() -> dict:
+    cfg = get_config()['MODELS']
+    return {
+        "device": cfg['device'].strip().lower(),
+        "cpu_backend": cfg['cpu_backend'].strip().lower(),
+        "idle_timeout": float(cfg['idle_timeout']),
+    }
+
+
+def resolve_device(requested: str) -> str:
+    import torch
+    if requested == "auto":
+        return "cuda" if torch.cuda.is_available() else "cpu"
+    if requested.startswith("cuda") and not torch.cuda.is_available():
+        print("CUDA requested but not available, falling back to CPU")
+        return "cpu"
+    return requested
+
+
+def quantize_for_cpu(module):
+    """Dynamic int8 quantization of the Linear layers, for CPU inference."""
+    import torch
+    return torch.quantization.quantize_dynamic(module, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def _torch_module(model):
+    import torch
+    if isinstance(model, torch.nn.Module):
+        return model
+    inner = getattr(model, "model", None)
+    return inner if isinstance(inner, torch.nn.Module) else None
+
+
+def _memory_bytes(model) -> int | None:
+    module = _torch_module(model)
+    if module is None:
+        return None
+    total = 0
+    for tensor in list(module.parameters()) + list(module.buffers()):
+        total += tensor.numel() * tensor.element_size()
+    # Dynamically quantized Linear layers keep their weights outside parameters()
+    for sub in module.modules():
+        packed = getattr(sub, "_packed_params", None)
+        if packed is not None:
+            try:
+                weight, bias = packed._weight_bias()
+                total += weight.numel() * weight.element_size()
+                if bias is not None:
+                    total += bias.numel() * bias.element_size()
+            except Exception:
+                pass
+    return total
+
+
+class _Entry:
+    def __init__(self, name: str, loader: Loader):
+        self.name = name
+        self.loader = loader
+        self.model = None
+        self.device: str | None = None
+        self.backend: str | None = None
+        self.loaded_at: float | None = None
+        self.load_seconds: float | None = None
+        self.last_used: float | None = None
+        self.in_use = 0
+        self.lock = threading.Lock()
+
+
+class ModelManager:
+    """Loads models on first use and unloads them after a period of idleness."""
+
+    def __init__(self):
+        self._entries: dict[str, _Entry] = {}
+        self._reaper: threading.Thread | None = None
+        self._lock = threading.Lock()
+
+    def register(self, name: str, loader: Loader):
+        self._entries[name] = _Entry(name, loader)
+
+    def get(self, name: str):
+        entry = self._entries[name]
+        with entry.lock:
+            if entry.model is None:
+                settings = _settings()
+                device = resolve_device(settings["device"])
+                backend = "fp16" if device.startswith("cuda") else settings["cpu_backend"]
+                started = time.monotonic()
+                print(f"Loading model {name} on {device} ({backend})")
+                entry.model = entry.loader(device, backend)
+                entry.device = device
+                entry.backend = backend
+                entry.loaded_at = time.time()
+                entry.load_seconds = time.monotonic() - started
+                print(f"Loaded model {name} in {entry.load_seconds:.1f}s")
+            entry.last_used = time.monotonic()
+        self._start_reaper()
+        return entry.model
+
+    @contextmanager
+    def use(self, name: str):
+        """Hold a model for the duration of a call so it is not unloaded underneath it."""
+        entry = self._entries[name]
+        model = self.get(name)
+        with entry.lock:
+            entry.in_use += 1
+        try:
+            yield model
+        finally:
+            with entry.lock:
+                entry.in_use -= 1
+                entry.last_used = time.monotonic()
+
+    def unload(self, name: str) -> bool:
+        entry = self._entries[name]
+        with entry.lock:
+            if entry.model is None or entry.in_use:
+                return False
+            entry.model = None
+            entry.loaded_at = None
+        gc.collect()
+        try:
+            import torch
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+        except ImportError:
+            pass
+        print(f"Unloaded model {name}")
+        return True
+
+    def unload_idle(self, idle_timeout: float):
+        now = time.monotonic()
+        for entry in list(self._entries.values()):
+            if entry.model is not None and not entry.in_use and now - entry.last_used > idle_timeout:
+                self.unload(entry.name)
+
+    def _start_reaper(self):
+        with self._lock:
+            if self._reaper is not None:
+                return
+            self._reaper = threading.Thread(target=self._reap_forever, name="model-reaper", daemon=True)
+            self._reaper.start()
+
+    def _reap_forever(self):
+        while True:
+            idle_timeout = _settings()["idle_timeout"]
+            if idle_timeout > 0:
+                self.unload_idle(idle_timeout)
+                time.sleep(min(max(idle_timeout / 4, 5), 60))
+            else:
+                time.sleep(60)
+
+    def status(self) -> list[dict]:
+        now = time.monotonic()
+        result = []
+        for entry in self._entries.values():
+            loaded = entry.model is not None
+            result.append({
+                "name": entry.name,
+                "loaded": loaded,
+                "device": entry.device if loaded else None,
+                "backend": entry.backend if loaded else None,
+                "in_use": entry.in_use,
+                "load_seconds": entry.load_seconds,
+                "idle_seconds": now - entry.last_used if loaded and entry.last_used else None,
+                "memory_bytes": _memory_bytes(entry.model) if loaded else None,
+            })
+        return result
+
+    def memory_summary(self) -> dict:
+        import torch
+        summary = {"models_bytes": sum(m["memory_bytes"] or 0 for m in self.status())}
+        if torch.cuda.is_available():
+            summary["cuda_allocated_bytes"] = torch.cuda.memory_allocated()
+            summary["cuda_reserved_bytes"] = torch.cuda.memory_reserved()
+        return summary
+
+
+model_manager = ModelManager()
@@ -1,7 +1,7 @@
 import hashlib
 import os
 from pathlib import Path
-from sqlalchemy import create_engine, Column, Integer, String, Float, DateTime, ForeignKey
+from sqlalchemy import create_engine, Boolean, Column, Integer, String, Float, DateTime, ForeignKey
 from sqlalchemy.orm import declarative_base, relationship, Mapped
 from sqlalchemy import LargeBinary
 from datetime import datetime
@@ -35,6 +35,8 @@ class VideoSchema(BaseModel):
     height: int
     filename_metadata: Optional[dict] = None
     preview_path: Optional[str] = None
+    sprite_path: Optional[str] = None
+    sprite_vtt_path: Optional[str] = None
     thumbnail_paths: list[str] = []
     tags: list[str] = []
     torrent_tags: Optional[list[str]] = []
@@ -47,15 +49,17 @@ Base = declarative_base()
 def normalize_path(path: str) -> str:
         return os.path.normpath(os.path.abspath(path))
 
-def hash_path_to_int(path: str) -> int:
+def hash_path_to_int(path: str, attempt: int = 0) -> int:
     # Use SHA-256 and take the first 8 bytes to convert to int
+    if attempt:
+        path = f"{path}\0{attempt}"
     return int(hashlib.sha256(path.encode()).hexdigest()[:8], 16)
 
 class VideoTagSet(Base):
     __tablename__ = 'video_tag_sets'
 
     id = Column(Integer, primary_key=True)
-    video_id = Column(Integer, ForeignKey('videos.id'), nullable=False)
+    video_id = Column(Integer, ForeignKey('videos.id'), nullable=False, index=True)
     tags = Column(JSON)  # List of tags
     prompt = Column(String)  # The prompt used for generation
     created_at = Column(DateTime, default=datetime.utcnow)
@@ -67,20 +71,28 @@ class Video(Base):
     id = Column(Integer, primary_key=True)
     path = Column(String, unique=True, nullable=False)
     searchpath = Column(String)
-    filename = Column(String)
-    size = Column(Integer)  # in bytes
-    duration = Column(Float)  # in seconds
+    filename = Column(String, index=True)
+    size = Column(Integer, index=True)  # in bytes
+    mtime = Column(Integer)  # File modification time in ns, as of the last scan
+    fingerprint = Column(String, index=True)  # Size and sampled content hash, see fingerprint.py
+    fingerprint_failed = Column(Boolean)  # The file could not be read for its fingerprint, not retried until it changes
+    duration = Column(Float, index=True)  # in seconds
     codec = Column(String)
     width = Column(Integer)
     height = Column(Integer)
-    created_at = Column(DateTime, default=datetime.utcnow)
+    created_at = Column(DateTime, default=datetime.utcnow, index=True)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)  # Anything in the API response changed
     preview_path = Column(String)  # Path to the generated preview video
+    sprite_path = Column(String)  # Scrub preview tile sheet
+    sprite_vtt_path = Column(String)  # WebVTT cues mapping times to tiles of sprite_path
     filename_metadata = Column(JSON)  # Metadata extracted from filename
     thumbnails: Mapped[List["Thumbnail"]] = relationship("Thumbnail", back_populates="video")
     tag_sets: Mapped[List["VideoTagSet"]] = relationship("VideoTagSet", back_populates="video")
     torrent_file_id = Column(Integer, ForeignKey('torrent_files.id'))
     torrent_file: Mapped[Optional["TorrentFile"]] = relationship("TorrentFile", uselist=False)
     torrent_tags = Column(JSON, nullable=True)  # List of tags from the torrent file
+    search_document = Column(String)  # Materialized search text, see search_document.py
+    search_document_hash = Column(String)  # Hash of search_document
 
     @property
     def thumbnail_paths(self):
@@ -103,10 +115,14 @@ class Video(Base):
     #     return []
 
     @staticmethod
-    def id_for_path(path: str) -> int:
-        """Generate a unique ID for a given path."""
+    def id_for_path(path: str, attempt: int = 0) -> int:
+        """Generate a unique ID for a given path.
+
+        A video keeps its id when its file is moved, so the id of a path may
+        already be taken; increasing `attempt` gives the next candidate.
+        """
         normalized_path = normalize_path(path)
-        return hash_path_to_int(normalized_path)
+        return hash_path_to_int(normalized_path, attempt)
     
     @staticmethod
     def generate_search_path(fullpath: str) -> str | None:
@@ -120,6 +136,17 @@ class Video(Base):
             search_path = search_path[1:]
         return search_path
 
+    @staticmethod
+    def row_for_path(path: str, attempt: int = 0, **values) -> dict:
+        """Column values of a new video, for Core inserts that bypass __init__."""
+        normalized_path = normalize_path(path)
+        return {
+            "id": hash_path_to_int(normalized_path, attempt),
+            "path": normalized_path,
+            "searchpath": Video.generate_search_path(normalized_path),
+            **values,
+        }
+
     def __init__(self, **kwargs):
         path = kwargs.get("path")
         if not path:
@@ -137,7 +164,7 @@ class Thumbnail(Base):
     __tablename__ = 'thumbnails'
     
     id = Column(Integer, primary_key=True)
-    video_id = Column(Integer, ForeignKey('videos.id'))
+    video_id = Column(Integer, ForeignKey('videos.id'), index=True)
     path = Column(String)  # Static thumbnail path
     timestamp = Column(Float)  # in seconds
     
@@ -170,6 +197,37 @@ class TorrentFile(Base):
 
     torrent: Mapped["Torrent"] = relationship("Torrent", back_populates="files")
 
+class ScannedDirectory(Base):
+    __tablename__ = 'scanned_directories'
+
+    path = Column(String, primary_key=True)  # Normalized absolute path
+    mtime = Column(Integer, nullable=False)  # Directory modification time in ns when it was listed
+    subdirs = Column(JSON, nullable=False)  # Names of the subdirectories it had
+    scanned_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class VideoEmbedding(Base):
+    __tablename__ = 'video_embeddings'
+
+    video_id = Column(Integer, ForeignKey('videos.id'), primary_key=True)
+    row = Column(Integer, nullable=False, unique=True)  # Row in the on-disk embedding matrix
+    text_hash = Column(String, nullable=False)  # Hash of the document text the vector came from
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class VideoNeighbor(Base):
+    __tablename__ = 'video_neighbors'
+
+    video_id = Column(Integer, ForeignKey('videos.id'), primary_key=True)
+    rank = Column(Integer, primary_key=True)  # 0 = most similar
+    neighbor_id = Column(Integer, ForeignKey('videos.id'), nullable=False, index=True)
+    score = Column(Float, nullable=False)
+
+class CatalogState(Base):
+    __tablename__ = 'catalog_state'
+
+    id = Column(Integer, primary_key=True)  # Single row
+    version = Column(Integer, nullable=False, default=0)  # Bumped whenever a task may have changed the catalog
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
 class Task(Base):
     __tablename__ = 'tasks'
     
@@ -1,13 +1,24 @@
 import os
+import re
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, List, TypedDict
 from pyparsing import (
     MatchFirst, QuotedString, Word, dblQuotedString, Regex, oneOf, Suppress,
     Group, OneOrMore, removeQuotes, ParseResults
 )
 from sqlalchemy import func, literal_column, or_
-from sqlalchemy.orm import Session
+from sqlalchemy.orm import Session, load_only
+from database import SessionLocal
+from lexical_index import search_bm25
 from models import Torrent, TorrentFile, Video, VideoTagSet
-from vector_index import search_similar_from_string, search_similar_from_tags
+from vector_index import candidate_count, load_videos, rerank_videos, search_similar_from_tags, vector_candidate_ids
+
+SEARCH_MODES = ("hybrid", "vector", "keyword")
+
+# Scene codes (ABC-123) and bare filenames, BM25 finds these without the embedding model
+_KEYWORD_TERM = re.compile(r"^(?:[A-Za-z]{2,8}[-_]?\d{2,6}|\S+\.(?:mp4|m4v|wmv|mkv|avi|flv|mov|webm))$", re.IGNORECASE)
+
+_lexical_executor = ThreadPoolExecutor(max_workers=4)
 
 class ParsedQuery(TypedDict):
     terms: List[str]
@@ -39,19 +50,8 @@ def parse_query_string(query: str) -> ParsedQuery:
         filters.setdefault(f["key"], []).append(f["value"])
     return ParsedQuery(terms=terms, filters=filters)
 
-def search_query(db: Session, terms: List[str] = None, tags: List[str] = None, path: List[str] = None, vision: List[str] = None, limit: int = 20, rerank: bool = True) -> List[Video]:
-    use_vector = len(terms) > 0
-    if use_vector:
-        text = ' '.join(terms)
-        texts = text.split(',')
-        texts = [t.strip() for t in texts]
-        vector_results = search_similar_from_string(db, texts, k = limit, rerank_enabled=rerank)
-        video_id_ordered = [video.id for video in vector_results]
-        id_to_index = {vid: i for i, vid in enumerate(video_id_ordered)}
-        query = db.query(Video).filter(Video.id.in_(video_id_ordered))
-    else:
-        query = db.query(Video)
-
+def apply_filters(query, tags: List[str] = None, path: List[str] = None, vision: List[str] = None):
+    """Apply tag:, vision: and path: filters to a query over Video."""
     if tags:
         tag_count = len(tags)
 
@@ -84,13 +84,73 @@ def search_query(db: Session, terms: List[str] = None, tags: List[str] = None, p
         norm_path = os.path.normpath(path[0])
         query = query.filter(Video.searchpath.startswith(norm_path))
 
-    
-    videos = query.distinct().all()
+    return query
+
+def filtered_video_ids(db: Session, tags: List[str] = None, path: List[str] = None, vision: List[str] = None) -> set[int] | None:
+    """Resolve the filters to the set of matching video ids, None if there are no filters."""
+    if not (tags or path or vision):
+        return None
+    query = apply_filters(db.query(Video.id), tags=tags, path=path, vision=vision)
+    return {video_id for (video_id,) in query.distinct()}
+
+def is_keyword_query(terms: List[str]) -> bool:
+    return bool(terms) and all(_KEYWORD_TERM.match(term) for term in terms)
+
+def reciprocal_rank_fusion(rankings: List[List[int]], k: int = 60) -> List[int]:
+    """Merge ranked id lists, each id scores sum(1 / (k + rank))."""
+    scores: Dict[int, float] = {}
+    for ranking in rankings:
+        for rank, video_id in enumerate(ranking):
+            scores[video_id] = scores.get(video_id, 0.0) + 1.0 / (k + rank + 1)
+    return sorted(scores, key=scores.get, reverse=True)
+
+def _lexical_candidates(terms: List[str], limit: int, allowed_ids: set[int] | None) -> List[int]:
+    # Runs on its own session, parallel to the vector search on the request's session
+    db = SessionLocal()
+    try:
+        return search_bm25(db, terms, limit, allowed_ids)
+    finally:
+        db.close()
+
+def search_query(db: Session, terms: List[str] = None, tags: List[str] = None, path: List[str] = None, vision: List[str] = None, limit: int = 20, rerank: bool = True, mode: str = "hybrid", deadline: float | None = None) -> List[Video]:
+    use_vector = len(terms) > 0
+    if not use_vector:
+        return apply_filters(db.query(Video).options(load_only(Video.id)), tags=tags, path=path, vision=vision).distinct().all()
+    if mode not in SEARCH_MODES:
+        raise ValueError(f"Unknown search mode {mode!r}")
+
+    # Filters first, so vector search and the reranker only see videos that can be returned
+    allowed_ids = filtered_video_ids(db, tags=tags, path=path, vision=vision)
+    if allowed_ids is not None and not allowed_ids:
+        return []
+
+    text = ' '.join(terms)
+    texts = text.split(',')
+    texts = [t.strip() for t in texts]
+
+    if mode == "hybrid" and is_keyword_query(terms):
+        mode = "keyword"
+    candidate_k = candidate_count(limit, rerank)
+
+    # BM25 and FAISS run side by side
+    lexical = None
+    if mode != "vector":
+        lexical = _lexical_executor.submit(_lexical_candidates, terms, candidate_k, allowed_ids)
+    vector_ids = vector_candidate_ids(db, texts, candidate_k, allowed_ids) if mode != "keyword" else []
+    lexical_ids = lexical.result() if lexical else []
 
-    if use_vector:
-        videos.sort(key=lambda v: id_to_index.get(v.id, float('inf')))
+    if mode == "keyword":
+        if lexical_ids:
+            # Exact matches, neither the embedding model nor the reranker is needed
+            return load_videos(db, lexical_ids[:limit], eager=False)
+        vector_ids = vector_candidate_ids(db, texts, candidate_k, allowed_ids)
 
-    return videos
+    fused = reciprocal_rank_fusion([vector_ids, lexical_ids])[:candidate_k]
+    # Candidates only need their search document, the response is built from rows
+    videos = load_videos(db, fused, eager=False)
+    if rerank and videos:
+        videos = rerank_videos(', '.join(texts), videos, deadline, limit)
+    return videos[:limit]
     
 
 if __name__ == "__main__":
@@ -1,48 +1,191 @@
+import functools
+import hashlib
 import os
-from fastapi import HTTPException, Request, Response, status
+import secrets
+from email.utils import formatdate, parsedate_to_datetime
+from typing import Callable
+import anyio
+from fastapi import Request, Response, status
+from starlette.types import Receive, Scope, Send
 
+CHUNK_SIZE = 256 * 1024
+# More ranges than this (after merging) are answered with the whole file
+MAX_RANGES = 16
 
-default_range = 10*1024*1024 - 1
 
-def _get_range_header(range_header: str, file_size: int) -> tuple[int, int]:
-    def _invalid_range():
-        return HTTPException(
-            status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
-            detail=f"Invalid request range (Range:{range_header!r})",
-        )
+def parse_range_header(range_header: str, file_size: int) -> list[tuple[int, int]] | None:
+    """Requested byte ranges as sorted, merged, inclusive (start, end) pairs.
 
+    Returns None for a malformed header, which is then ignored, and an empty
+    list if none of the ranges overlaps the file.
+    """
+    unit, _, spec = range_header.partition("=")
+    if unit.strip().lower() != "bytes" or not spec.strip():
+        return None
+
+    ranges = []
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        first, sep, last = part.partition("-")
+        if not sep:
+            return None
+        try:
+            if first == "":
+                # bytes=-N, the last N bytes
+                length = int(last)
+                if length < 0:
+                    return None
+                if length > 0 and file_size > 0:
+                    ranges.append((max(file_size - length, 0), file_size - 1))
+                continue
+            start = int(first)
+            end = int(last) if last else None
+        except ValueError:
+            return None
+        if start < 0 or (end is not None and end < start):
+            return None
+        if start < file_size:
+            ranges.append((start, file_size - 1 if end is None else min(end, file_size - 1)))
+
+    merged: list[tuple[int, int]] = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def file_etag(stat_result: os.stat_result) -> str:
+    return '"' + hashlib.md5(f"{stat_result.st_mtime}-{stat_result.st_size}".encode()).hexdigest() + '"'
+
+
+def _if_range_matches(if_range: str | None, etag: str, stat_result: os.stat_result) -> bool:
+    """Whether a Range header may be honoured given the If-Range validator."""
+    if if_range is None:
+        return True
+    if_range = if_range.strip()
+    if if_range.startswith('"') or if_range.startswith('W/'):
+        # Only a strong ETag match counts
+        return if_range == etag
     try:
-        h = range_header.replace("bytes=", "").split("-")
-        start = int(h[0]) if h[0] != "" else 0
-        end = int(h[1]) if h[1] != "" else min(start + default_range, file_size - 1)
-    except ValueError:
-        raise _invalid_range()
+        return parsedate_to_datetime(if_range).timestamp() >= int(stat_result.st_mtime)
+    except (TypeError, ValueError):
+        return False
+
+
+class RangeFileResponse(Response):
+    """Streams a file, or the byte ranges a Range request asks for.
+
+    The file is sent in fixed size chunks read off the event loop, or handed
+    to the server in one zero-copy call when it supports the ASGI
+    `http.response.zerocopysend` extension, so memory per stream is constant
+    whatever the size of the range. Without a usable Range header the whole
+    file is sent with 200, a single range gets 206, several ranges a 206
+    multipart/byteranges body and unsatisfiable ranges 416.
+    """
+
+    def __init__(self, request: Request, file_path: str, content_type: str, stat_result: os.stat_result | None = None, headers: dict | None = None, fd: int | None = None, on_close: Callable[[], None] | None = None):
+        stat_result = stat_result or os.stat(file_path)
+        self.file_path = file_path
+        # An already open descriptor is read with os.pread, so other responses may share it
+        self.fd = fd
+        self.on_close = on_close
+        self.file_size = file_size = stat_result.st_size
+        self.background = None
+        # (part header, start, end) to send in order, then the closing delimiter
+        self.parts: list[tuple[bytes, int, int]] = []
+        self.trailer = b""
+
+        etag = file_etag(stat_result)
+        headers = dict(headers or {})
+        headers.update({
+            "Accept-Ranges": "bytes",
+            "ETag": etag,
+            "Last-Modified": formatdate(stat_result.st_mtime, usegmt=True),
+        })
 
-    if start > end or start < 0 or end > file_size - 1:
-        raise _invalid_range()
-    return start, end
+        ranges = None
+        range_header = request.headers.get("range")
+        if range_header is not None and _if_range_matches(request.headers.get("if-range"), etag, stat_result):
+            ranges = parse_range_header(range_header, file_size)
+            if ranges is not None and len(ranges) > MAX_RANGES:
+                ranges = None
 
+        self.media_type = content_type
+        if ranges is None:
+            self.status_code = status.HTTP_200_OK
+            if file_size:
+                self.parts = [(b"", 0, file_size - 1)]
+            headers["Content-Length"] = str(file_size)
+        elif not ranges:
+            self.status_code = status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE
+            headers["Content-Range"] = f"bytes */{file_size}"
+            headers["Content-Length"] = "0"
+        elif len(ranges) == 1:
+            start, end = ranges[0]
+            self.status_code = status.HTTP_206_PARTIAL_CONTENT
+            self.parts = [(b"", start, end)]
+            headers["Content-Range"] = f"bytes {start}-{end}/{file_size}"
+            headers["Content-Length"] = str(end - start + 1)
+        else:
+            boundary = secrets.token_hex(16)
+            self.status_code = status.HTTP_206_PARTIAL_CONTENT
+            self.media_type = f"multipart/byteranges; boundary={boundary}"
+            for i, (start, end) in enumerate(ranges):
+                delimiter = "" if i == 0 else "\r\n"
+                part_header = f"{delimiter}--{boundary}\r\nContent-Type: {content_type}\r\nContent-Range: bytes {start}-{end}/{file_size}\r\n\r\n"
+                self.parts.append((part_header.encode("latin-1"), start, end))
+            self.trailer = f"\r\n--{boundary}--\r\n".encode("latin-1")
+            length = len(self.trailer) + sum(len(header) + end - start + 1 for header, start, end in self.parts)
+            headers["Content-Length"] = str(length)
+        self.init_headers(headers)
 
-def range_requests_response(
-    request: Request, file_path: str, content_type: str
-):
-    """Returns StreamingResponse using Range Requests of a given file"""
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        try:
+            await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+            if scope["method"] == "HEAD" or not self.parts:
+                await send({"type": "http.response.body", "body": b"", "more_body": False})
+                return
+            await self._send_parts(send, "http.response.zerocopysend" in scope.get("extensions", {}))
+        finally:
+            if self.on_close is not None:
+                self.on_close()
 
-    file_size = os.stat(file_path).st_size
-    range_header = request.headers.get("range")
+    async def _send_parts(self, send: Send, zerocopy: bool):
+        if self.fd is not None:
+            file = open(self.fd, "rb", closefd=False)
+            read_at = functools.partial(os.pread, self.fd)
+        else:
+            file = await anyio.to_thread.run_sync(open, self.file_path, "rb")
 
-    start = 0
-    end = file_size - 1
+            def read_at(size: int, position: int) -> bytes:
+                file.seek(position)
+                return file.read(size)
+        try:
+            for part_header, start, end in self.parts:
+                if part_header:
+                    await send({"type": "http.response.body", "body": part_header, "more_body": True})
+                if zerocopy:
+                    await send({"type": "http.response.zerocopysend", "file": file, "offset": start, "count": end - start + 1, "more_body": True})
+                else:
+                    await self._send_chunks(send, read_at, start, end - start + 1)
+            await send({"type": "http.response.body", "body": self.trailer, "more_body": False})
+        finally:
+            await anyio.to_thread.run_sync(file.close)
 
-    if range_header is not None:
-        start, end = _get_range_header(range_header, file_size)
+    async def _send_chunks(self, send: Send, read_at: Callable[[int, int], bytes], offset: int, length: int):
+        while length > 0:
+            chunk = await anyio.to_thread.run_sync(read_at, min(CHUNK_SIZE, length), offset)
+            if not chunk:
+                raise OSError(f"{self.file_path} shrank while it was being sent")
+            await send({"type": "http.response.body", "body": chunk, "more_body": True})
+            offset += len(chunk)
+            length -= len(chunk)
 
-    with open(file_path, mode="rb") as video_file:
-        video_file.seek(start)
-        data = video_file.read(end - start + 1)
 
-        headers = {
-            'Content-Range': f'bytes {str(start)}-{str(end)}/{file_size}',
-            'Accept-Ranges': 'bytes'
-        }
-        return Response(data, status_code=206, headers=headers, media_type="video/mp4")
\ No newline at end of file
+def range_requests_response(request: Request, file_path: str, content_type: str) -> RangeFileResponse:
+    """Response for a file that honours Range and If-Range headers"""
+    return RangeFileResponse(request, file_path, content_type)
@@ -0,0 +1,110 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable
+
+from config import get_config
+
+ScoreFn = Callable[[list[tuple[str, str]]], list[float]]
+
+
+class ScoreCache:
+    """Thread-safe LRU of (model, query, document hash) -> score."""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._scores: OrderedDict[tuple[str, str, bytes], float] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(model: str, query: str, document: str) -> tuple[str, str, bytes]:
+        return model, query, hashlib.sha1(document.encode('utf-8')).digest()
+
+    def get(self, key) -> float | None:
+        with self._lock:
+            score = self._scores.get(key)
+            if score is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._scores.move_to_end(key)
+            return score
+
+    def put(self, key, score: float):
+        with self._lock:
+            self._scores[key] = score
+            self._scores.move_to_end(key)
+            while len(self._scores) > self.max_size:
+                self._scores.popitem(last=False)
+
+
+class CascadeReranker:
+    """Cross-encoder reranking with a score cache, an optional cheap first
+    stage and a deadline.
+
+    The first stage model scores every candidate and only the best
+    `cascade_keep` (or `k`, the number of results wanted, if more) go to
+    the large model. Both stages score in batches, most
+    promising candidates first, and stop when the deadline passes; whatever
+    was not scored by then keeps its incoming order behind the scored ones.
+    """
+
+    def __init__(self, model_name: str, score: ScoreFn, cascade_model_name: str | None = None, cascade_score: ScoreFn | None = None):
+        cfg = get_config()['RERANKER']
+        self.model_name = model_name
+        self.score = score
+        self.cascade_model_name = cascade_model_name
+        self.cascade_score = cascade_score if cascade_model_name else None
+        self.cascade_keep = int(cfg['cascade_keep'])
+        self.batch_size = int(cfg['batch_size'])
+        self.cache = ScoreCache(int(cfg['cache_size']))
+
+    def _score_stage(self, model: str, score_fn: ScoreFn, query: str, documents: list[str], deadline: float | None) -> tuple[list[tuple[str, float]], list[str]]:
+        """Score documents in order until the deadline, returns (scored, unscored)."""
+        scored: dict[int, float] = {}
+        pending = []
+        for i, doc in enumerate(documents):
+            cached = self.cache.get(ScoreCache.key(model, query, doc))
+            if cached is None:
+                pending.append(i)
+            else:
+                scored[i] = cached
+
+        for start in range(0, len(pending), self.batch_size):
+            if deadline is not None and time.monotonic() >= deadline:
+                break
+            batch = pending[start:start + self.batch_size]
+            scores = score_fn([(query, documents[i]) for i in batch])
+            if isinstance(scores, float):  # Single pair
+                scores = [scores]
+            for i, score in zip(batch, scores):
+                scored[i] = float(score)
+                self.cache.put(ScoreCache.key(model, query, documents[i]), float(score))
+
+        ranked = sorted(((documents[i], score) for i, score in scored.items()), key=lambda x: x[1], reverse=True)
+        unscored = [doc for i, doc in enumerate(documents) if i not in scored]
+        return ranked, unscored
+
+    def rerank(self, query: str, documents: list[str], deadline: float | None = None, k: int | None = None) -> list[tuple[str, float | None]]:
+        """Order documents by relevance; unscored documents get a score of None."""
+        started = time.monotonic()
+        tail: list[tuple[str, float | None]] = []
+        candidates = documents
+        keep = max(self.cascade_keep, k or 0)
+        if self.cascade_score is not None and len(documents) > keep:
+            stage1, unscored = self._score_stage(self.cascade_model_name, self.cascade_score, query, documents, deadline)
+            candidates = [doc for doc, _ in stage1[:keep]]
+            # If the deadline hit in stage one, the rest keeps its incoming order
+            room = max(keep - len(candidates), 0)
+            candidates += unscored[:room]
+            tail = stage1[keep:] + [(doc, None) for doc in unscored[room:]]
+
+        ranked, unscored = self._score_stage(self.model_name, self.score, query, candidates, deadline)
+        result = ranked + [(doc, None) for doc in unscored] + [(doc, None) for doc, _ in tail]
+
+        elapsed = (time.monotonic() - started) * 1000
+        print(f"Reranked {len(documents)} documents ({len(candidates)} by {self.model_name}, {len(unscored)} cut by deadline) in {elapsed:.0f} ms, cache {self.cache.hits} hits / {self.cache.misses} misses")
+        return result
@@ -1,58 +1,317 @@
 import os
+from datetime import datetime
 from pathlib import Path
+from typing import NamedTuple
+from sqlalchemy import and_, func, or_
 from sqlalchemy.orm import Session
-from models import Video, Task, VideoTagSet
+from batch_writer import BatchWriter
+from fingerprint import compute_fingerprint
+from models import ScannedDirectory, Thumbnail, Video, VideoNeighbor, VideoTagSet, normalize_path
 from config import get_supported_extensions
 import logging
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-def scan_media_folders(db: Session, media_folders: list[str]):
-    """Scan media folders for video files"""
-    extensions = get_supported_extensions()
-    
+
+class ScanResult(NamedTuple):
+    new: list[int]
+    changed: list[int]  # Same path, different size or mtime
+    deleted: list[int]
+    moved: list[int]  # Existing videos whose file turned up at another path
+
+
+class _NewFile(NamedTuple):
+    path: str
+    name: str
+    size: int
+    mtime: int
+
+
+class _KnownFile(NamedTuple):
+    id: int
+    size: int | None
+    mtime: int | None
+
+
+def _extension_set() -> set[str]:
+    return {ext.lower() for ext in get_supported_extensions()}
+
+
+def _under(path: str, root: str) -> bool:
+    return path == root or path.startswith(root.rstrip(os.sep) + os.sep)
+
+
+def _known_files(db: Session, root: str) -> dict[str, dict[str, _KnownFile]]:
+    """Videos under a folder, grouped by directory and file name."""
+    known: dict[str, dict[str, _KnownFile]] = {}
+    query = db.query(Video.id, Video.path, Video.size, Video.mtime).filter(Video.path.startswith(root.rstrip(os.sep) + os.sep, autoescape=True))
+    for video_id, path, size, mtime in query:
+        directory, name = os.path.split(path)
+        known.setdefault(directory, {})[name] = _KnownFile(video_id, size, mtime)
+    return known
+
+
+def _list_directory(path: str, extensions: set[str]) -> tuple[list[str], dict[str, tuple[int, int]]]:
+    """Subdirectory names and video files (name -> (size, mtime)) of one directory."""
+    subdirs = []
+    files = {}
+    with os.scandir(path) as entries:
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.name)
+                elif os.path.splitext(entry.name)[1].lower() in extensions and entry.is_file():
+                    st = entry.stat()
+                    files[entry.name] = (st.st_size, st.st_mtime_ns)
+            except OSError as e:
+                logger.warning(f"Cannot read {entry.path}: {e}")
+    return subdirs, files
+
+
+def _delete_videos(db: Session, video_ids: list[int]):
+    """Delete video rows and the rows that hang off them; search indexes are cleaned up by the caller."""
+    for start in range(0, len(video_ids), 900):
+        chunk = video_ids[start:start + 900]
+        db.query(Thumbnail).filter(Thumbnail.video_id.in_(chunk)).delete(synchronize_session=False)
+        db.query(VideoTagSet).filter(VideoTagSet.video_id.in_(chunk)).delete(synchronize_session=False)
+        db.query(VideoNeighbor).filter(or_(VideoNeighbor.video_id.in_(chunk), VideoNeighbor.neighbor_id.in_(chunk))).delete(synchronize_session=False)
+        db.query(Video).filter(Video.id.in_(chunk)).delete(synchronize_session=False)
+
+
+def _fingerprint(path: str, size: int) -> str | None:
     try:
-        for folder in media_folders:
-            folder_path = Path(folder)
-            if not folder_path.exists():
-                logger.warning(f"Folder not found: {folder}")
-                continue
-                
-            for ext in extensions:
-                for file_path in folder_path.rglob(f'*{ext}', case_sensitive=False):
-                    process_video_file(db, file_path)
-        
+        return compute_fingerprint(path, size)
+    except OSError as e:
+        logger.warning(f"Cannot fingerprint {path}: {e}")
+        return None
+
+
+def _changed_file(db: Session, writer: BatchWriter, video_id: int, path: str, size: int, mtime: int):
+    """Rewritten in place: metadata and thumbnails are extracted again"""
+    fingerprint = _fingerprint(path, size)
+    writer.update(Video, {"id": video_id, "size": size, "mtime": mtime, "fingerprint": fingerprint, "fingerprint_failed": fingerprint is None, "duration": None, "codec": None, "width": None, "height": None})
+    db.query(Thumbnail).filter(Thumbnail.video_id == video_id).delete(synchronize_session=False)
+
+
+def _add_files(db: Session, writer: BatchWriter, new_files: list[_NewFile], result: ScanResult):
+    """Insert new files, unless they are the file of a video in `result.deleted` that moved.
+
+    A moved video keeps its row, and with it its thumbnails, tag sets,
+    preview and embedding; only its path changes. It is taken out of
+    `result.deleted`.
+    """
+    missing: dict[str, list[int]] = {}
+    for start in range(0, len(result.deleted), 900):
+        query = db.query(Video.id, Video.fingerprint).filter(Video.id.in_(result.deleted[start:start + 900]), Video.fingerprint != None)
+        for video_id, fingerprint in query:
+            missing.setdefault(fingerprint, []).append(video_id)
+
+    rows = []
+    for new_file in new_files:
+        fingerprint = _fingerprint(new_file.path, new_file.size)
+        if fingerprint is None:
+            continue
+        if missing.get(fingerprint):
+            video_id = missing[fingerprint].pop()
+            writer.update(Video, {
+                "id": video_id,
+                "path": new_file.path,
+                "searchpath": Video.generate_search_path(new_file.path),
+                "filename": new_file.name,
+                "size": new_file.size,
+                "mtime": new_file.mtime,
+            })
+            result.deleted.remove(video_id)
+            result.moved.append(video_id)
+            logger.info(f"Moved video {video_id} to {new_file.path}")
+        else:
+            rows.append(Video.row_for_path(new_file.path, filename=new_file.name, size=new_file.size, mtime=new_file.mtime, fingerprint=fingerprint))
+
+    # Ids follow paths, except that a moved video keeps its id; another path may hash to the same id too
+    taken = set()
+    for start in range(0, len(rows), 900):
+        taken.update(video_id for video_id, in db.query(Video.id).filter(Video.id.in_([row["id"] for row in rows[start:start + 900]])))
+    for row in rows:
+        attempt = 0
+        while row["id"] in taken:
+            attempt += 1
+            row["id"] = Video.id_for_path(row["path"], attempt)
+        taken.add(row["id"])
+        writer.upsert(Video, row, update_columns=())
+        result.new.append(row["id"])
+        logger.info(f"Added new video: {row['path']}")
+
+
+def _needs_fingerprint():
+    return and_(Video.fingerprint == None, or_(Video.fingerprint_failed == None, Video.fingerprint_failed == False))
+
+
+def backfill_fingerprints(db: Session, after_id: int, limit: int) -> int | None:
+    """Fingerprint up to `limit` videos recorded before fingerprints were, so their moves can be recognised.
+
+    Goes through videos in id order from `after_id` on and returns the last
+    id handled, None once all are done. Files that cannot be read are
+    marked and left alone until a scan sees them change.
+    """
+    videos = db.query(Video.id, Video.path, Video.size).filter(_needs_fingerprint(), Video.id > after_id).order_by(Video.id).limit(limit).all()
+    with BatchWriter(db) as writer:
+        for video_id, path, size in videos:
+            if not os.path.exists(path):
+                continue  # Deleted, the next scan removes the video
+            fingerprint = _fingerprint(path, size)
+            writer.update(Video, {"id": video_id, "fingerprint": fingerprint, "fingerprint_failed": fingerprint is None})
+    logger.info(f"Fingerprinted {len(videos)} videos")
+    return videos[-1].id if len(videos) == limit else None
+
+
+def needs_fingerprint_backfill(db: Session) -> bool:
+    return db.query(Video.id).filter(_needs_fingerprint()).first() is not None
+
+
+def _scan_folder(db: Session, writer: BatchWriter, root: str, extensions: set[str], full: bool, result: ScanResult, new_files: list[_NewFile]):
+    query = db.query(ScannedDirectory.path, ScannedDirectory.mtime, ScannedDirectory.subdirs).filter(or_(ScannedDirectory.path == root, ScannedDirectory.path.startswith(root.rstrip(os.sep) + os.sep, autoescape=True)))
+    directories = {path: (mtime, subdirs) for path, mtime, subdirs in query}
+    known = _known_files(db, root)
+    listed = skipped = 0
+
+    stack = [root]
+    while stack:
+        path = stack.pop()
+        try:
+            # Taken before listing, so changes made while we list are seen next time
+            mtime = os.stat(path).st_mtime_ns
+        except OSError as e:
+            logger.warning(f"Cannot stat {path}: {e}")
+            continue
+
+        record = directories.get(path)
+        if record is not None and record[0] == mtime and not full:
+            # Same entries as last time; files inside may still be rewritten in place, a full scan catches those
+            skipped += 1
+            stack.extend(os.path.join(path, name) for name in record[1])
+            continue
+
+        try:
+            subdirs, files = _list_directory(path, extensions)
+        except OSError as e:
+            logger.warning(f"Cannot list {path}: {e}")
+            continue
+        listed += 1
+
+        known_here = known.pop(path, {})
+        for name, (size, file_mtime) in files.items():
+            existing = known_here.pop(name, None)
+            if existing is None:
+                new_files.append(_NewFile(os.path.join(path, name), name, size, file_mtime))
+            elif existing.mtime is None or existing.size is None:
+                writer.update(Video, {"id": existing.id, "size": size, "mtime": file_mtime})  # First scan since mtimes are recorded
+            elif (existing.size, existing.mtime) != (size, file_mtime):
+                _changed_file(db, writer, existing.id, os.path.join(path, name), size, file_mtime)
+                result.changed.append(existing.id)
+        result.deleted.extend(existing.id for existing in known_here.values())
+
+        if record is not None:
+            for name in set(record[1]) - set(subdirs):
+                gone = os.path.join(path, name)
+                for directory in [d for d in known if _under(d, gone)]:
+                    result.deleted.extend(existing.id for existing in known.pop(directory).values())
+                removed = [d for d in directories if _under(d, gone)]
+                for directory in removed:
+                    del directories[directory]
+                db.query(ScannedDirectory).filter(ScannedDirectory.path.in_(removed)).delete(synchronize_session=False)
+        directories[path] = (mtime, subdirs)
+        writer.upsert(ScannedDirectory, {"path": path, "mtime": mtime, "subdirs": subdirs, "scanned_at": datetime.utcnow()})
+        stack.extend(os.path.join(path, name) for name in subdirs)
+
+    logger.info(f"Scanned {root}: {listed} directories listed, {skipped} unchanged")
+
+
+def scan_media_folders(db: Session, media_folders: list[str], full: bool = False) -> ScanResult:
+    """Incrementally scan media folders for video files.
+
+    Directories whose mtime did not change since the last scan are not
+    listed again, only their subdirectories are visited. `full` lists
+    every directory, which also catches files rewritten in place. Files
+    that moved, also between media folders, keep their video.
+    """
+    extensions = _extension_set()
+    result = ScanResult([], [], [], [])
+    new_files: list[_NewFile] = []
+
+    try:
+        with BatchWriter(db) as writer:
+            for folder in media_folders:
+                root = normalize_path(folder)
+                if not os.path.isdir(root):
+                    # An unmounted share must not look like every file was deleted
+                    logger.warning(f"Folder not found: {folder}")
+                    continue
+                _scan_folder(db, writer, root, extensions, full, result, new_files)
+            _add_files(db, writer, new_files, result)
+
+        if result.deleted:
+            _delete_videos(db, result.deleted)
+            db.commit()
+            logger.info(f"Removed {len(result.deleted)} deleted videos")
     except Exception as e:
         logger.error(f"Scan failed: {e}")
         raise
+    return result
+
+
+def ingest_paths(db: Session, changed: list[str], deleted: list[str]) -> ScanResult:
+    """Bring the videos at the given paths up to date without scanning any directory.
+
+    `changed` are files that appeared or were written to, `deleted` files
+    or directories that went away; videos under them whose file is gone are
+    removed, unless the file turns up among `changed`.
+    """
+    result = ScanResult([], [], [], [])
+    new_files: list[_NewFile] = []
+    deleted = list(deleted)
 
-def process_video_file(db: Session, file_path: Path):
-    """Process a single video file and update database"""
-
-    # Check if video already exists
-    file_path = str(file_path.absolute())
-    id = Video.id_for_path(file_path)
-    video = db.get(Video, id)
-
-    if video:
-        # Check if something is missing
-        # if not db.query(VideoTagSet).filter(VideoTagSet.video_id == id).first() and not db.query(Task).filter(Task.type == 'tag', Task.payload == id).first():
-        #     task = Task(
-        #         type='tag',
-        #         status='pending',
-        #         payload=id,
-        #     )
-        #     db.add(task)
-        #     db.commit()
-        #     logger.info(f"Missing tags, adding tag job to task queue: {file_path}")
-        return
-    else:
-        # Add new video entry
-        video = Video(
-            path=file_path,
-            filename=os.path.basename(file_path)
-        )
-        db.add(video)
+    with BatchWriter(db) as writer:
+        for path in {normalize_path(p) for p in changed}:
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                deleted.append(path)  # Gone again already
+                continue
+            existing = db.query(Video.id, Video.size, Video.mtime).filter(Video.path == path).first()
+            if existing is None:
+                new_files.append(_NewFile(path, os.path.basename(path), st.st_size, st.st_mtime_ns))
+            elif (existing.size, existing.mtime) != (st.st_size, st.st_mtime_ns):
+                if existing.mtime is None:
+                    writer.update(Video, {"id": existing.id, "size": st.st_size, "mtime": st.st_mtime_ns})
+                else:
+                    _changed_file(db, writer, existing.id, path, st.st_size, st.st_mtime_ns)
+                    result.changed.append(existing.id)
+
+        video_ids = set()
+        for path in {normalize_path(p) for p in deleted}:
+            query = db.query(Video.id, Video.path).filter(or_(Video.path == path, Video.path.startswith(path.rstrip(os.sep) + os.sep, autoescape=True)))
+            video_ids.update(video_id for video_id, video_path in query if not os.path.exists(video_path))
+        result.deleted.extend(sorted(video_ids))
+        _add_files(db, writer, new_files, result)
+
+    if result.deleted:
+        _delete_videos(db, result.deleted)
         db.commit()
-        logger.info(f"Added new video: {file_path}")
\ No newline at end of file
+        logger.info(f"Removed {len(result.deleted)} deleted videos")
+    return result
+
+
+def process_video_file(db: Session, file_path: Path | str) -> int | None:
+    """Process a single video file and update database, returns the id of a new or changed video"""
+    result = ingest_paths(db, [str(file_path)], [])
+    return (result.new or result.changed or [None])[0]
+
+
+def duplicate_groups(db: Session) -> list[list[int]]:
+    """Ids of videos with the same fingerprint, i.e. copies of the same file, grouped."""
+    duplicated = db.query(Video.fingerprint).filter(Video.fingerprint != None).group_by(Video.fingerprint).having(func.count() > 1).subquery()
+    groups: dict[str, list[int]] = {}
+    for video_id, fingerprint in db.query(Video.id, Video.fingerprint).filter(Video.fingerprint.in_(duplicated.select())).order_by(Video.fingerprint, Video.id):
+        groups.setdefault(fingerprint, []).append(video_id)
+    return list(groups.values())
@@ -0,0 +1,72 @@
+from typing import List
+from sqlalchemy.orm import Session, selectinload
+
+from lexical_index import document_hash
+from models import TorrentFile, Video
+
+
+def build_search_document(video: Video) -> str:
+    """Text that represents a video for embedding, reranking and full-text search."""
+    text = "Filename: " + video.filename + "\n\n"
+
+    if video.torrent_tags:
+        text += "Tags: " + ", ".join(video.torrent_tags).replace('.', ' ') + "\n\n"
+
+    # Collect filename metadata tags
+    if video.filename_metadata:
+        if video.filename_metadata.get('actors'):
+            text += "Actors: " + ", ".join(video.filename_metadata['actors']) + "\n\n"
+
+        if video.filename_metadata.get('series'):
+            text += "Series: " + video.filename_metadata['series'] + "\n\n"
+
+        if video.filename_metadata.get('scene_name'):
+            text += "Scene Name: " + video.filename_metadata['scene_name'] + "\n\n"
+
+        if video.filename_metadata.get('tags'):
+            text += "Extra tags: " + ", ".join(video.filename_metadata['tags']) + "\n\n"
+
+    # Collect tags from snapshot classification
+    if video.tag_sets and video.tag_sets[0].tags:
+        text += "Visual tags: " + ', '.join(video.tag_sets[0].tags) + "\n\n"
+
+    if video.torrent_file and video.torrent_file.torrent and video.torrent_file.torrent.description:
+        # Collect tags from torrent metadata
+        text += "Description: " + video.torrent_file.torrent.description[:512] + "\n\n"
+
+    return text
+
+
+def update_search_documents(db: Session, video_ids: List[int] | None = None, missing_only: bool = False) -> List[int]:
+    """Recompute the stored search document of the given videos (all videos if None).
+
+    With `missing_only` only videos that have no document yet are built.
+    Returns the ids of videos whose document changed.
+    """
+    query = db.query(Video).options(
+        selectinload(Video.tag_sets),
+        selectinload(Video.torrent_file).selectinload(TorrentFile.torrent)
+    )
+    if missing_only:
+        query = query.filter(Video.search_document == None)
+
+    if video_ids is None:
+        batches = [query.all()]
+    else:
+        video_ids = list(set(video_ids))
+        # Stay below SQLite's bound parameter limit
+        batches = [query.filter(Video.id.in_(video_ids[start:start + 900])).all() for start in range(0, len(video_ids), 900)]
+
+    changed = []
+    for videos in batches:
+        for video in videos:
+            document = build_search_document(video)
+            doc_hash = document_hash(document)
+            if video.search_document_hash != doc_hash:
+                video.search_document = document
+                video.search_document_hash = doc_hash
+                changed.append(video.id)
+    db.commit()
+    if changed:
+        print(f"Updated search documents of {len(changed)} videos")
+    return changed
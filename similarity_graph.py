@@ -0,0 +1,121 @@
+import time
+import numpy as np
+from sqlalchemy import func
+from sqlalchemy.orm import Session, selectinload
+
+from config import get_config
+from models import Video, VideoEmbedding, VideoNeighbor
+import vector_index
+
+
+def _load_vectors(db: Session) -> tuple[np.ndarray, np.ndarray]:
+    """All indexed video ids and their vectors, in matching order."""
+    indexed = vector_index.faiss_index.ids()
+    rows = [(vid, row) for vid, row in db.query(VideoEmbedding.video_id, VideoEmbedding.row) if vid in indexed]
+    ids = np.asarray([vid for vid, _ in rows], dtype='int64')
+    vectors = vector_index.embedding_store().read([row for _, row in rows])
+    return ids, vectors
+
+
+def _top_neighbors(scores: np.ndarray, n: int) -> tuple[np.ndarray, np.ndarray]:
+    """Column indices and scores of the n best entries of every row, best first."""
+    n = min(n, scores.shape[1])
+    if n == 0:
+        return np.empty((scores.shape[0], 0), dtype='int64'), np.empty((scores.shape[0], 0), dtype='float32')
+    part = np.argpartition(-scores, n - 1, axis=1)[:, :n]
+    part_scores = np.take_along_axis(scores, part, axis=1)
+    order = np.argsort(-part_scores, axis=1)
+    return np.take_along_axis(part, order, axis=1), np.take_along_axis(part_scores, order, axis=1)
+
+
+def _write_neighbors(db: Session, video_ids: list[int], neighbors: dict[int, list[tuple[int, float]]]):
+    for start in range(0, len(video_ids), 900):
+        chunk = video_ids[start:start + 900]
+        db.query(VideoNeighbor).filter(VideoNeighbor.video_id.in_(chunk)).delete(synchronize_session=False)
+    db.bulk_insert_mappings(VideoNeighbor, [
+        {"video_id": vid, "rank": rank, "neighbor_id": neighbor_id, "score": score}
+        for vid, pairs in neighbors.items()
+        for rank, (neighbor_id, score) in enumerate(pairs)
+    ])
+    db.commit()
+
+
+def _compute_rows(ids: np.ndarray, vectors: np.ndarray, positions: np.ndarray, n: int, block_size: int, on_block=None) -> dict[int, list[tuple[int, float]]]:
+    neighbors = {}
+    for start in range(0, len(positions), block_size):
+        block = positions[start:start + block_size]
+        scores = vectors[block] @ vectors.T
+        scores[np.arange(len(block)), block] = -np.inf  # A video is not its own neighbour
+        if on_block is not None:
+            on_block(block, scores)
+        cols, top_scores = _top_neighbors(scores, n)
+        for row, pos in enumerate(block):
+            neighbors[int(ids[pos])] = [
+                (int(ids[col]), float(score))
+                for col, score in zip(cols[row], top_scores[row]) if np.isfinite(score)
+            ]
+    return neighbors
+
+
+def rebuild_similarity_graph(db: Session, changed_ids: list[int] | None = None):
+    """Recompute the precomputed neighbour lists.
+
+    With `changed_ids` only the affected rows are recomputed: the changed
+    videos themselves, videos that currently list one of them as a
+    neighbour, and videos a changed vector now ranks high enough for.
+    """
+    cfg = get_config()['SIMILARITY']
+    n = int(cfg['neighbors'])
+    block_size = int(cfg['block_size'])
+    started = time.monotonic()
+
+    ids, vectors = _load_vectors(db)
+    position = {int(vid): i for i, vid in enumerate(ids)}
+
+    if changed_ids is None:
+        neighbors = _compute_rows(ids, vectors, np.arange(len(ids)), n, block_size)
+        db.query(VideoNeighbor).delete(synchronize_session=False)
+        _write_neighbors(db, [], neighbors)
+        print(f"[similarity] Full graph for {len(ids)} videos in {time.monotonic() - started:.1f}s")
+        return
+
+    changed = set(changed_ids)
+    targets = set(changed)
+    for start in range(0, len(changed_ids), 900):
+        chunk = changed_ids[start:start + 900]
+        targets.update(vid for (vid,) in db.query(VideoNeighbor.video_id).filter(VideoNeighbor.neighbor_id.in_(chunk)).distinct())
+
+    # Score of the n-th neighbour per video, a changed vector beating it enters that list
+    threshold = np.full(len(ids), -np.inf, dtype='float32')
+    for vid, worst, count in db.query(VideoNeighbor.video_id, func.min(VideoNeighbor.score), func.count()).group_by(VideoNeighbor.video_id):
+        if vid in position and count >= n:
+            threshold[position[vid]] = worst
+
+    def collect_promoted(block, scores):
+        # scores[i, j] is symmetric, so row i of a changed video also scores it for video j
+        better = (scores > threshold[np.newaxis, :]).any(axis=0)
+        targets.update(int(vid) for vid in ids[better])
+
+    changed_positions = np.asarray(sorted(position[vid] for vid in changed if vid in position), dtype='int64')
+    neighbors = _compute_rows(ids, vectors, changed_positions, n, block_size, collect_promoted)
+
+    rest = np.asarray(sorted(position[vid] for vid in targets - changed if vid in position), dtype='int64')
+    neighbors.update(_compute_rows(ids, vectors, rest, n, block_size))
+
+    # Videos that left the index lose their list
+    gone = [vid for vid in targets if vid not in position]
+    _write_neighbors(db, list(neighbors.keys()) + gone, neighbors)
+    print(f"[similarity] Updated {len(neighbors)} neighbour lists for {len(changed)} changed videos in {time.monotonic() - started:.1f}s")
+
+
+def similar_videos(db: Session, video_id: int, limit: int) -> list[Video]:
+    """Precomputed neighbours of a video, most similar first (empty if not computed)."""
+    return (
+        db.query(Video)
+        .join(VideoNeighbor, VideoNeighbor.neighbor_id == Video.id)
+        .filter(VideoNeighbor.video_id == video_id)
+        .order_by(VideoNeighbor.rank)
+        .limit(limit)
+        .options(selectinload(Video.thumbnails), selectinload(Video.tag_sets))
+        .all()
+    )
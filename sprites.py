@@ -0,0 +1,80 @@
+import math
+import os
+import ffmpeg
+from datetime import datetime
+from sqlalchemy.orm import Session
+from config import get_config
+from models import Video
+import logging
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+def _vtt_time(seconds: float) -> str:
+    hours, rest = divmod(seconds, 3600)
+    minutes, seconds = divmod(rest, 60)
+    return f"{int(hours):02d}:{int(minutes):02d}:{seconds:06.3f}"
+
+def sprite_layout(duration: float, interval: float, columns: int, max_rows: int) -> tuple[float, int, int, int]:
+    """(interval, tile count, columns, rows): the interval grows for long videos so every tile fits on one sheet,
+    short videos get a sheet narrower than `columns`"""
+    interval = max(interval, duration / (columns * max_rows))
+    count = max(math.ceil(duration / interval), 1)
+    columns = min(columns, count)
+    return interval, count, columns, math.ceil(count / columns)
+
+def build_vtt(image_name: str, duration: float, interval: float, count: int, columns: int, tile_width: int, tile_height: int) -> str:
+    """WebVTT cues mapping each interval to its tile, as a media fragment of the sheet image"""
+    lines = ["WEBVTT", ""]
+    for i in range(count):
+        start = i * interval
+        end = min((i + 1) * interval, duration)
+        x = (i % columns) * tile_width
+        y = (i // columns) * tile_height
+        lines += [f"{_vtt_time(start)} --> {_vtt_time(end)}", f"{image_name}#xywh={x},{y},{tile_width},{tile_height}", ""]
+    return "\n".join(lines)
+
+def generate_sprites(db: Session, video: Video):
+    """Render a scrub preview sheet of frames at fixed intervals and its WebVTT index"""
+    config = get_config()['SPRITES']
+    sprite_dir = config['sprite_dir']
+    os.makedirs(sprite_dir, exist_ok=True)
+
+    tile_width = int(config['tile_width'])
+    # Fixed tile size, so the cue coordinates are known without looking at the image
+    tile_height = max(round(tile_width * video.height / video.width / 2) * 2, 2) if video.width and video.height else tile_width * 9 // 16
+    interval, count, columns, rows = sprite_layout(video.duration, float(config['interval']), int(config['columns']), int(config['max_rows']))
+
+    image_format = config['format']
+    image_path = os.path.join(sprite_dir, f"{video.id}_sprite.{image_format}")
+    vtt_path = os.path.join(sprite_dir, f"{video.id}_sprite.vtt")
+    input_options = {'skip_frame': 'nokey'} if config.getboolean('keyframes_only') else {}
+    output_options = {'vframes': 1}
+    if image_format == 'webp':
+        output_options['quality'] = config['quality']
+    else:
+        output_options['q:v'] = config['jpeg_qscale']
+
+    try:
+        (
+            ffmpeg.input(video.path, **input_options)
+            # fps repeats or drops frames so tile i always shows second i * interval
+            .filter('fps', fps=1 / interval, round='down', eof_action='pass')
+            .filter('scale', tile_width, tile_height)
+            .filter('tile', f"{columns}x{rows}")
+            .output(image_path, **output_options)
+            .overwrite_output()
+            .run(capture_stdout=True, capture_stderr=True)
+        )
+    except ffmpeg.Error as e:
+        logger.error(f"Sprite generation failed: {e.stderr.decode()}")
+        raise
+
+    # Cues point at the image relative to the .vtt, both are served from the same directory
+    with open(vtt_path, 'w') as f:
+        f.write(build_vtt(os.path.basename(image_path), video.duration, interval, count, columns, tile_width, tile_height))
+
+    video.sprite_path = image_path
+    video.sprite_vtt_path = vtt_path
+    video.updated_at = datetime.utcnow()  # Both paths are part of the video's response
+    db.commit()
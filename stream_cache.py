@@ -0,0 +1,184 @@
+import mimetypes
+import os
+import threading
+import time
+from collections import OrderedDict
+from sqlalchemy import select
+from config import get_config
+from database import SessionLocal
+from models import Video
+
+# Positional reads let concurrent streams share one descriptor; without
+# os.pread (Windows) every response opens the file itself
+_SHARE_FDS = hasattr(os, "pread")
+
+
+def sniff_content_type(header: bytes, path: str) -> str:
+    """Content type from the container's magic bytes, the extension as fallback."""
+    if header[4:8] == b"ftyp":
+        return "video/quicktime" if header[8:12] == b"qt  " else "video/mp4"
+    if header.startswith(b"\x1a\x45\xdf\xa3"):  # EBML
+        return "video/webm" if b"webm" in header[:64] else "video/x-matroska"
+    if header.startswith(b"RIFF") and header[8:12] == b"AVI ":
+        return "video/x-msvideo"
+    if header.startswith(b"\x30\x26\xb2\x75\x8e\x66\xcf\x11"):  # ASF
+        return "video/x-ms-wmv"
+    if header.startswith(b"FLV"):
+        return "video/x-flv"
+    if header.startswith(b"OggS"):
+        return "video/ogg"
+    if header.startswith(b"\x00\x00\x01\xba") or header.startswith(b"\x00\x00\x01\xb3"):
+        return "video/mpeg"
+    if len(header) > 188 and header[0] == 0x47 and header[188] == 0x47:
+        return "video/mp2t"
+    return mimetypes.guess_type(path)[0] or "application/octet-stream"
+
+
+def _same_file(a: os.stat_result, b: os.stat_result) -> bool:
+    return (a.st_ino, a.st_dev, a.st_size, a.st_mtime_ns) == (b.st_ino, b.st_dev, b.st_size, b.st_mtime_ns)
+
+
+class StreamHandle:
+    """An open video file shared by the responses streaming it."""
+
+    def __init__(self, video_id: int, path: str, stat_result: os.stat_result, fd: int | None, content_type: str):
+        self.video_id = video_id
+        self.path = path
+        self.stat_result = stat_result
+        self.fd = fd
+        self.content_type = content_type
+        self.checked_at = time.monotonic()
+        self.last_used = self.checked_at
+        self.users = 0
+        self.retired = False
+
+    def _close_if_done(self):
+        if self.retired and self.users == 0 and self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class StreamHandleCache:
+    """LRU of video id -> open file, size, mtime and content type.
+
+    A cached entry answers without a database query or a syscall until it
+    is `revalidate_interval` seconds old; then one stat() checks that the
+    file was not replaced or modified, and a changed file is reopened.
+    Entries unused for `idle_timeout` seconds are closed. A file is only
+    closed once the last response reading it has finished.
+    """
+
+    def __init__(self, max_entries: int, revalidate_interval: float, idle_timeout: float):
+        self.max_entries = max_entries
+        self.revalidate_interval = revalidate_interval
+        self.idle_timeout = idle_timeout
+        self._entries: OrderedDict[int, StreamHandle] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def acquire_cached(self, video_id: int) -> StreamHandle | None:
+        """The handle if it is cached and fresh, without any I/O; release() it when done."""
+        now = time.monotonic()
+        with self._lock:
+            self._evict(now)
+            handle = self._entries.get(video_id)
+            if handle is None or now - handle.checked_at > self.revalidate_interval:
+                return None
+            return self._use(handle, now)
+
+    def acquire(self, video_id: int) -> StreamHandle | None:
+        """The handle for a video, opening or revalidating it as needed; None if there is no such file."""
+        handle = self.acquire_cached(video_id)
+        if handle is not None:
+            return handle
+
+        with self._lock:
+            handle = self._entries.get(video_id)
+        path = handle.path if handle is not None else self._lookup_path(video_id)
+        if path is None:
+            return None
+        try:
+            stat_result = os.stat(path)
+        except OSError:
+            self.invalidate(video_id)
+            if handle is None:
+                return None
+            return self.acquire(video_id)  # The file may have moved, look its path up again
+
+        now = time.monotonic()
+        with self._lock:
+            handle = self._entries.get(video_id)
+            if handle is not None and _same_file(handle.stat_result, stat_result):
+                handle.checked_at = now
+                return self._use(handle, now)
+
+        try:
+            handle = self._open(video_id, path)
+        except OSError:
+            self.invalidate(video_id)
+            return None
+        with self._lock:
+            self._replace(video_id, handle)
+            self._evict(now)
+            return self._use(handle, now)
+
+    def release(self, handle: StreamHandle):
+        with self._lock:
+            handle.users -= 1
+            handle.last_used = time.monotonic()
+            handle._close_if_done()
+
+    def invalidate(self, video_id: int):
+        with self._lock:
+            self._replace(video_id, None)
+
+    @staticmethod
+    def _lookup_path(video_id: int) -> str | None:
+        db = SessionLocal()
+        try:
+            return db.execute(select(Video.path).where(Video.id == video_id)).scalar()
+        finally:
+            db.close()
+
+    @staticmethod
+    def _open(video_id: int, path: str) -> StreamHandle:
+        fd = os.open(path, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+        try:
+            stat_result = os.fstat(fd)
+            with open(fd, "rb", closefd=False) as f:
+                header = f.read(512)
+        except BaseException:
+            os.close(fd)
+            raise
+        if not _SHARE_FDS:
+            os.close(fd)
+            fd = None
+        return StreamHandle(video_id, path, stat_result, fd, sniff_content_type(header, path))
+
+    def _use(self, handle: StreamHandle, now: float) -> StreamHandle:
+        handle.users += 1
+        handle.last_used = now
+        self._entries.move_to_end(handle.video_id)
+        return handle
+
+    def _replace(self, video_id: int, handle: StreamHandle | None):
+        old = self._entries.pop(video_id, None)
+        if old is not None:
+            old.retired = True
+            old._close_if_done()
+        if handle is not None:
+            self._entries[video_id] = handle
+
+    def _evict(self, now: float):
+        for video_id, handle in list(self._entries.items()):
+            if len(self._entries) <= self.max_entries and now - handle.last_used <= self.idle_timeout:
+                break
+            if handle.users == 0 or len(self._entries) > self.max_entries:
+                self._replace(video_id, None)
+
+
+_config = get_config()['STREAMING']
+stream_handles = StreamHandleCache(
+    int(_config['handle_cache_size']),
+    float(_config['revalidate_interval']),
+    float(_config['idle_timeout']),
+)
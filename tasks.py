@@ -2,16 +2,65 @@ import ast
 import asyncio
 from concurrent.futures import ThreadPoolExecutor
 import json
+from datetime import datetime
 from typing import List
 from sqlalchemy.orm import Session
-from models import Task, Video, VideoTagSet
+from models import Task, Video, VideoEmbedding, VideoNeighbor, VideoTagSet
 from database import SessionLocal
-from vector_index import load_faiss_index
+from config import get_config
+from lexical_index import remove_documents, sync_documents, upsert_documents
+from search_document import update_search_documents
+from http_cache import bump_catalog_version
+from vector_index import document_texts, load_faiss_index, remove_videos, upsert_videos
 
 executor = ThreadPoolExecutor(max_workers=1)
 
+def queue_similarity_update(db: Session, video_ids: List[int]):
+    """Refresh the precomputed neighbours of videos whose vectors changed."""
+    if video_ids:
+        db.add(Task(type='similarity_graph', status='pending', payload=json.dumps(video_ids)))
+        db.commit()
+
+def refresh_search_documents(db: Session, video_ids: List[int]):
+    """Recompute the search documents of changed videos and push them into the search indexes."""
+    if not video_ids:
+        return
+    changed = update_search_documents(db, video_ids)
+    if changed:
+        upsert_documents(db, document_texts(db, changed))
+    # A video can start or stop qualifying for the vector index with the same text, e.g. when
+    # its filename metadata or first tag set arrives empty; unchanged vectors are skipped there
+    queue_similarity_update(db, upsert_videos(db, video_ids))
+
+def forget_videos(db: Session, video_ids: List[int]):
+    """Drop deleted videos from the search indexes and the neighbour lists that name them."""
+    if video_ids:
+        remove_documents(db, video_ids)
+        remove_videos(db, video_ids)
+        queue_similarity_update(db, video_ids)
+
+def sync_lexical_index(db: Session):
+    written = sync_documents(db, document_texts(db))
+    print(f"[worker] Full-text index synced, {written} documents updated")
+
 def generate_embedding(db: Session, arg: str):
-    load_faiss_index(db)
+    # Incremental: only new or changed documents are encoded and (re)inserted
+    queue_similarity_update(db, upsert_videos(db))
+
+def similarity_graph(db: Session, arg: str):
+    """Recompute precomputed neighbours, for the given video ids or all videos"""
+    from similarity_graph import rebuild_similarity_graph
+    changed_ids = json.loads(arg) if arg else None
+    rebuild_similarity_graph(db, changed_ids)
+
+def fingerprints(db: Session, arg: str):
+    """Fingerprint a batch of videos from before fingerprints, then queue the next batch behind the other tasks"""
+    from scanner import backfill_fingerprints
+
+    last_id = backfill_fingerprints(db, int(arg or 0), int(get_config()['FINGERPRINTS']['backfill_batch']))
+    if last_id is not None:
+        db.add(Task(type='fingerprints', status='pending', payload=str(last_id)))
+        db.commit()
 
 def filename_metadata(db: Session, arg: str):
     import asyncio
@@ -32,6 +81,7 @@ def filename_metadata(db: Session, arg: str):
         db.commit()  # Commit once, in the main thread
 
     asyncio.run(process_all())
+    refresh_search_documents(db, [video.id for video in videos])
 
 def preview(db: Session, arg: str):
     """Generate a preview for a video."""
@@ -41,6 +91,16 @@ def preview(db: Session, arg: str):
         raise ValueError(f"Video with ID {arg} not found")
     generate_preview(db, video)
 
+def sprites(db: Session, arg: str):
+    """Generate the scrub preview sprite sheet of a video."""
+    from sprites import generate_sprites
+    video = db.get(Video, arg)
+    if not video:
+        raise ValueError(f"Video with ID {arg} not found")
+    if not video.duration:
+        raise ValueError(f"Video with ID {arg} has no duration, cannot generate sprites")
+    generate_sprites(db, video)
+
 def tag(db: Session, arg: str):
     """Generate tags for a video based on its thumbnail."""
     import asyncio
@@ -69,6 +129,7 @@ def tag(db: Session, arg: str):
             tags=result['tags'],
             prompt=result['prompt'],
         )
+        video.updated_at = datetime.utcnow()  # tags is part of the video's response
         return tag_set
             
     async def process_all():
@@ -77,8 +138,10 @@ def tag(db: Session, arg: str):
             if tag_set is not None:
                 db.add(tag_set)
         db.commit()  # Commit once, in the main thread
+        return [tag_set.video_id for tag_set in result if tag_set is not None]
 
-    asyncio.run(process_all())
+    tagged_ids = asyncio.run(process_all())
+    refresh_search_documents(db, tagged_ids)
 
     # for video in videos:
     #     thumbnail = video.thumbnails[0]
@@ -110,19 +173,38 @@ def metadata(db: Session, arg: str):
 
 def torrent_tags(db: Session, arg: str):
     """Scan torrent files in a directory and extract metadata"""
-    from torrent_metadata import scan_torrent_files
+    from torrent_metadata import scan_torrent_files, link_torrent_files
     directory = arg.strip('"')  # Remove quotes if present
     if not directory:
         raise ValueError("Directory path is required")
     scan_torrent_files(db, directory)
+    refresh_search_documents(db, link_torrent_files(db))
+
 
+def ingest(db: Session, arg: str):
+    """Add or refresh the files the media watcher saw change, and drop deleted ones."""
+    from scanner import ingest_paths
+
+    paths = json.loads(arg)
+    result = ingest_paths(db, paths["changed"], paths["deleted"])
+    refresh_search_documents(db, result.new + result.moved)
+    forget_videos(db, result.deleted)
+
+    if (result.new or result.changed) and not db.query(Task).filter(Task.type == 'metadata', Task.status == 'pending').first():
+        db.add(Task(type='metadata', status='pending'))
+        db.commit()
 
 def scan(db: Session, arg: str):
     """Scan media folders for video files and process them."""
     from scanner import scan_media_folders
 
-    media_folders: List[str] = ast.literal_eval(arg)
-    scan_media_folders(db, media_folders)
+    payload = ast.literal_eval(arg)
+    if isinstance(payload, list):  # Queued before scans had options
+        payload = {'media_folders': payload}
+    media_folders: List[str] = payload['media_folders']
+    result = scan_media_folders(db, media_folders, full=payload.get('full', False))
+    refresh_search_documents(db, result.new + result.moved)
+    forget_videos(db, result.deleted)
 
     task = Task(
         type='metadata',
@@ -133,13 +215,17 @@ def scan(db: Session, arg: str):
     
 TASK_TYPE_FUNCTIONS = {
     "scan": scan,
+    "ingest": ingest,
     "metadata": metadata,
     "preview": preview,
     "thumbnail": thumbnail,
+    "sprites": sprites,
+    "fingerprints": fingerprints,
     "filename_metadata": filename_metadata,
     "embedding": generate_embedding,
     "tag": tag,
     "torrent_tags": torrent_tags,
+    "similarity_graph": similarity_graph,
 }
 
 def fetch_next_task(db: Session) -> Task | None: 
@@ -151,7 +237,16 @@ def fetch_next_task(db: Session) -> Task | None:
 
 async def process_queue():
     db: Session = SessionLocal()
+    update_search_documents(db, missing_only=True)  # Backfill videos from before the column existed
+    sync_lexical_index(db)
     load_faiss_index(db)
+    if not db.query(VideoNeighbor).first() and db.query(VideoEmbedding).first():
+        db.add(Task(type='similarity_graph', status='pending'))
+        db.commit()
+    from scanner import needs_fingerprint_backfill
+    if needs_fingerprint_backfill(db) and not db.query(Task).filter(Task.type == 'fingerprints', Task.status == 'pending').first():
+        db.add(Task(type='fingerprints', status='pending'))
+        db.commit()
     db.close()
 
     while True:
@@ -171,7 +266,10 @@ async def process_queue():
                         task.complete(db)
                 except Exception as e:
                     print(f"[worker] Task Error ({task.type} - args: {task.payload}): {e}")
+                    db.rollback()
                     task.fail(db)
+                # Even a failed task may have committed part of its work
+                bump_catalog_version(db)
             else:
                 await asyncio.sleep(1)
         finally:
@@ -0,0 +1,53 @@
+from config import get_config
+from disk_cache import DiskCache
+
+try:
+    from PIL import Image
+except ImportError:  # Only the resizing endpoint needs it
+    Image = None
+
+# format parameter -> (Pillow format, content type, file extension)
+FORMATS = {
+    "jpeg": ("JPEG", "image/jpeg", ".jpg"),
+    "webp": ("WEBP", "image/webp", ".webp"),
+    "avif": ("AVIF", "image/avif", ".avif"),
+}
+
+_config = get_config()['THUMBNAIL_VARIANTS']
+variant_cache = DiskCache(_config['cache_dir'], int(_config['cache_size_mb']) * 1024 * 1024)
+WIDTHS = sorted(int(width) for width in _config['widths'].split(',') if width.strip())
+
+
+def supported_formats() -> list[str]:
+    if Image is None:
+        return []
+    Image.init()
+    return [name for name, (pil_format, _, _) in FORMATS.items() if pil_format in Image.SAVE]
+
+
+def variant_width(width: int | None) -> int | None:
+    """The configured width a request is served at: the smallest one at least as wide, None for the original size.
+
+    Snapping keeps the number of cached variants per thumbnail bounded.
+    """
+    if width is None:
+        return None
+    return next((w for w in WIDTHS if w >= width), None)
+
+
+def get_variant(source_path: str, version: int, width: int | None, format: str) -> str:
+    """Path of a thumbnail scaled down to `width` in `format`, rendered on first use.
+
+    `version` (the source's mtime) keys the cache, a regenerated thumbnail
+    gets new variants and the old ones age out.
+    """
+    pil_format, _, extension = FORMATS[format]
+
+    def create(tmp_path: str):
+        with Image.open(source_path) as image:
+            image = image.convert("RGB")
+            if width is not None and width < image.width:
+                image = image.resize((width, max(round(image.height * width / image.width), 1)), Image.Resampling.LANCZOS)
+            image.save(tmp_path, pil_format, quality=int(_config[f'{format}_quality']))
+
+    return variant_cache.get_or_create(f"thumbnails/{source_path}/{version}/{width or 'original'}{extension}", create)
@@ -1,6 +1,9 @@
 import os
+import shutil
 import ffmpeg
+from datetime import datetime
 from models import Video, Thumbnail
+from sqlalchemy import insert
 from sqlalchemy.orm import Session
 from config import get_config
 import logging
@@ -8,6 +11,84 @@ import logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+def thumbnail_timestamps(duration: float, count: int) -> list[float]:
+    return [duration * (i+1)/(count+1) for i in range(count)]
+
+# Seconds read after each timestamp when looking for the keyframe after it
+KEYFRAME_WINDOW = 10
+
+def nearest_keyframes(path: str, timestamps: list[float]) -> list[float]:
+    """The keyframe nearest to each timestamp, as -ss positions
+
+    Only the packets from the keyframe before each timestamp up to
+    KEYFRAME_WINDOW seconds after it are read, from their flags, without
+    decoding; the keyframe after a timestamp is not considered past that.
+    """
+    start_time = 0.0
+    while True:
+        # Intervals are in packet time, which includes the container's start offset
+        probe = ffmpeg.probe(
+            path,
+            select_streams='v:0',
+            show_entries='packet=pts_time,flags',
+            read_intervals=','.join(f"{start_time + timestamp:.3f}%+{KEYFRAME_WINDOW}" for timestamp in timestamps),
+        )
+        probed_start = float(probe['format'].get('start_time') or 0)
+        if abs(probed_start - start_time) < 0.001:
+            break
+        start_time = probed_start
+    keyframes = sorted(
+        max(float(packet['pts_time']) - start_time, 0.0)
+        for packet in probe.get('packets', [])
+        if 'K' in packet.get('flags', '') and packet.get('pts_time') not in (None, 'N/A')
+    )
+    if not keyframes:
+        raise ValueError(f"No keyframes found in {path}")
+    return [min(keyframes, key=lambda keyframe: abs(keyframe - timestamp)) for timestamp in timestamps]
+
+def render_thumbnails(path: str, timestamps: list[float], output_paths: list[str], width, height, snap_to_keyframe: bool = False) -> list[float]:
+    """Write one scaled frame per timestamp, returns the times of the frames written
+
+    With `snap_to_keyframe` each timestamp moves to the nearest keyframe and
+    all of them come from a single ffmpeg process: the file is opened once
+    per keyframe as a separate input and nothing but keyframes is decoded.
+    Otherwise every thumbnail gets its own process with an accurate seek; a
+    single process decoding up to each timestamp was slower than that.
+    Raises ValueError if ffmpeg wrote no frame for a timestamp.
+    """
+    if snap_to_keyframe:
+        timestamps = nearest_keyframes(path, timestamps)
+        # With long GOPs several timestamps can land on the same keyframe, render it once
+        first_output = {}
+        for timestamp, output_path in zip(timestamps, output_paths):
+            first_output.setdefault(timestamp, output_path)
+        outputs = [
+            # Just before the keyframe: ffmpeg drops frames before -ss, and pts_time is rounded
+            ffmpeg.input(path, ss=max(timestamp - 0.001, 0), skip_frame='nokey')
+            .filter('scale', width, height, force_original_aspect_ratio='decrease')
+            .output(output_path, vframes=1)
+            for timestamp, output_path in first_output.items()
+        ]
+        ffmpeg.merge_outputs(*outputs).overwrite_output().run(capture_stdout=True, capture_stderr=True)
+        for timestamp, output_path in zip(timestamps, output_paths):
+            if output_path != first_output[timestamp] and os.path.exists(first_output[timestamp]):
+                shutil.copyfile(first_output[timestamp], output_path)
+    else:
+        for timestamp, output_path in zip(timestamps, output_paths):
+            (
+                ffmpeg.input(path, ss=timestamp)
+                .filter('scale', width, height, force_original_aspect_ratio='decrease')
+                .output(output_path, vframes=1)
+                .overwrite_output()
+                .run(capture_stdout=True, capture_stderr=True)
+            )
+
+    # ffmpeg exits cleanly when an input ends before its output got a frame
+    for timestamp, output_path in zip(timestamps, output_paths):
+        if not os.path.exists(output_path):
+            raise ValueError(f"No frame at {timestamp:.3f}s in {path}")
+    return timestamps
+
 def generate_thumbnails(db: Session, video: Video):
     """Generate thumbnails"""
 
@@ -21,28 +102,26 @@ def generate_thumbnails(db: Session, video: Video):
     count = int(config['THUMBNAILS']['thumbnail_count'])
     width = config['THUMBNAILS']['thumbnail_width']
     height = config['THUMBNAILS']['thumbnail_height']
-    intervals = [video.duration * (i+1)/(count+1) for i in range(count)]
+    snap = config['THUMBNAILS'].getboolean('snap_to_keyframe')
+    intervals = thumbnail_timestamps(video.duration, count)
+    paths = [os.path.join(thumbnail_dir, f"{video.id}_{i}.jpg") for i in range(count)]
+    # Images of an earlier run must not pass for this one's
+    for thumbnail_path in paths:
+        if os.path.exists(thumbnail_path):
+            os.remove(thumbnail_path)
     try:
-        for i, timestamp in enumerate(intervals):
-            thumbnail_path = os.path.join(thumbnail_dir, f"{video.id}_{i}.jpg")
-            
-            # Static thumbnail
-            (
-                ffmpeg.input(video.path, ss=timestamp)
-                .filter('scale', width, height, force_original_aspect_ratio='decrease')
-                .output(thumbnail_path, vframes=1)
-                .overwrite_output()
-                .run(capture_stdout=True, capture_stderr=True)
-            )
-            
-            # Add to database
-            thumbnail = Thumbnail(
-                video_id=video.id,
-                path=thumbnail_path,
-                timestamp=timestamp,
-            )
-            db.add(thumbnail)
-        db.commit()
-
+        intervals = render_thumbnails(video.path, intervals, paths, width, height, snap)
     except ffmpeg.Error as e:
-        logger.error(f"Thumbnail generation failed: {e.stderr.decode()}")
\ No newline at end of file
+        logger.error(f"Thumbnail generation failed: {e.stderr.decode()}")
+        return
+
+    # Add to database, replacing the rows of an earlier run
+    db.query(Thumbnail).filter(Thumbnail.video_id == video.id).delete(synchronize_session=False)
+    rows = [
+        {"video_id": video.id, "path": thumbnail_path, "timestamp": timestamp}
+        for timestamp, thumbnail_path in zip(intervals, paths)
+    ]
+    if rows:
+        db.execute(insert(Thumbnail), rows)
+    video.updated_at = datetime.utcnow()  # thumbnail_paths is part of the video's response
+    db.commit()
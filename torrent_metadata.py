@@ -2,7 +2,7 @@ import re
 import bencodepy
 from sqlalchemy.orm import Session
 
-from models import Torrent, TorrentFile
+from models import Torrent, TorrentFile, Video
 
 def strip_bbcode(text):
     text = re.sub(r'\[(img|thumb)(=[^\]]+)?\].*?\[/\1\]', '', text, flags=re.IGNORECASE | re.DOTALL)
@@ -22,6 +22,33 @@ def scan_torrent_files(db: Session, directory):
                 torrent_file = os.path.join(root, file)
                 parse_torrent(db, torrent_file)
 
+def link_torrent_files(db: Session) -> list[int]:
+    """Attach torrent files and torrent tags to matching videos.
+
+    Returns the ids of videos whose torrent data changed.
+    """
+    changed = []
+    videos = db.query(Video).filter(Video.torrent_file_id == None).all()
+    for video in videos:
+        torrentfile_search = video.searchpath.replace("\\", "/")  # Ensure search path is in correct format
+        results = db.query(TorrentFile).filter(TorrentFile.path == torrentfile_search).all()
+        if results:
+            if len(results) > 1:
+                print(f"Warning: Multiple torrent files found for video {video.id}: {results}")
+            else:
+                video.torrent_file = results[0]
+                changed.append(video.id)
+                print(f"Updated video {video.id} with torrent file {results[0].id}")
+
+    videos = db.query(Video).filter(Video.torrent_tags == None).all()
+    for video in videos:
+        if video.torrent_file and video.torrent_file.torrent and video.torrent_file.torrent.taglist:
+            video.torrent_tags = video.torrent_file.torrent.taglist
+            changed.append(video.id)
+            print(f"Updated video {video.id} with torrent tags {video.torrent_tags}")
+    db.commit()
+    return changed
+
 def parse_torrent(db: Session, torrent_file):
     with open(torrent_file, 'rb') as f:
         torrent = bencodepy.decode(f.read())
@@ -1,25 +1,17 @@
+import json
+import os
 from typing import List
-import faiss
 import numpy as np
-from sentence_transformers import SentenceTransformer, CrossEncoder
-from sqlalchemy.orm import Session
+from sqlalchemy.orm import Session, selectinload
 from tqdm import tqdm
-from models import TorrentFile, Video  # your updated model
-import torch
-from FlagEmbedding import FlagReranker
-
-
-from functools import lru_cache
-
-# Memoize by video id (not the object itself, to avoid memory leaks)
-_document_text_cache = {}
-
-print("Torch information:")
-print(torch.version.cuda)          # Should print a CUDA version, e.g. '11.8'
-print(torch.cuda.is_available())   # Should be True
-print(torch.cuda.device_count())   # Number of GPUs detected
-print(torch.cuda.get_device_name(0))  # GPU name
-device = "cuda" if torch.cuda.is_available() else "cpu"
+from models import Video, VideoEmbedding  # your updated model
+from config import get_config
+from embedding_store import get_embedding_store
+from ann_index import AnnIndex
+from reranking import CascadeReranker
+from model_manager import model_manager, quantize_for_cpu
+from batching import MicroBatcher
+from search_document import build_search_document
 
 # Model:
 # BAAI/bge-large-en-v1.5
@@ -28,19 +20,60 @@ device = "cuda" if torch.cuda.is_available() else "cpu"
 # 'intfloat/e5-large-v2' -> bad
 
 
-_model = None
+embedding_model_name = "jeonseonjin/embedding_BAAI-bge-m3"
 query_preamble = "Represent this sentence for searching features: "
 embedding_preamble = "Represent this sentence for semantic similarity:\n"
-embedding_dim = 768
-def get_model():
-    global _model
-    if _model is None:
-        _model = SentenceTransformer("jeonseonjin/embedding_BAAI-bge-m3", device=device, model_kwargs={"torch_dtype": "float16"})
-    return _model
 
-# FAISS is rebuilt from scratch each time, so it starts empty
-faiss_index = faiss.IndexFlatIP(embedding_dim)
-sqlite_id_lookup = []
+# Model libraries are imported by the loaders, importing this module stays cheap
+def _load_embedding_model(device: str, backend: str):
+    from sentence_transformers import SentenceTransformer
+    model_kwargs = {"torch_dtype": "float16"} if backend == "fp16" else {}
+    model = SentenceTransformer(embedding_model_name, device=device, model_kwargs=model_kwargs)
+    if backend == "int8":
+        model = quantize_for_cpu(model)
+    return model
+
+model_manager.register("embedding", _load_embedding_model)
+
+def get_model():
+    return model_manager.get("embedding")
+
+_embedding_dim: int | None = None
+
+def _dimensions_path() -> str:
+    return os.path.join(get_config()['EMBEDDINGS']['store_dir'], 'dimensions.json')
+
+def _remembered_dimensions() -> dict[str, int]:
+    try:
+        with open(_dimensions_path()) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def get_embedding_dim() -> int:
+    """Width of the embedding model's vectors.
+
+    Remembered per model next to the embedding store, so the model is only
+    loaded for it once and not on every start.
+    """
+    global _embedding_dim
+    if _embedding_dim is None:
+        dimensions = _remembered_dimensions()
+        if embedding_model_name not in dimensions:
+            with model_manager.use("embedding") as model:
+                dimensions[embedding_model_name] = int(model.get_sentence_embedding_dimension())
+            os.makedirs(os.path.dirname(_dimensions_path()), exist_ok=True)
+            with open(_dimensions_path(), 'w') as f:
+                json.dump(dimensions, f)
+        _embedding_dim = dimensions[embedding_model_name]
+    return _embedding_dim
+
+def embedding_store():
+    return get_embedding_store(get_embedding_dim())
+
+# Starts empty, filled by load_faiss_index and kept current with upsert_videos/remove_videos.
+# Until the model's width is known it is an empty placeholder that upsert_videos replaces
+faiss_index = AnnIndex(_remembered_dimensions().get(embedding_model_name, 0))
 
 def get_preamble():
     return query_preamble
@@ -48,109 +81,198 @@ def get_preamble():
 # Load the reranker model (same as Hugging Face name)
 # reranker = CrossEncoder("BAAI/bge-reranker-base", max_length=1024, model_kwargs={"torch_dtype": "float16"})
 
-reranker = FlagReranker('BAAI/bge-reranker-v2-m3', use_fp16=True)
-# "cross-encoder/ms-marco-MiniLM-L6-v2"
-def rerank(query: str, documents: list[str]) -> list[tuple[str, float]]:
-    pairs = [(query, doc) for doc in documents]
-
-    total_bytes = sum(len(doc.encode('utf-8')) for doc in documents)
-
-    # Get relevance scores
-    # scores = reranker.predict(pairs, show_progress_bar=True)
-    scores = reranker.compute_score(pairs, normalize=True)
-
-    # Zip and sort
-    ranked = sorted(zip(documents, scores), key=lambda x: x[1], reverse=True)
-
-    # Print results
-    for doc, score in ranked[:20]:
-        print(f"{score:.2f}: {doc[:30]}")
-
-    return ranked
+_reranker_config = get_config()['RERANKER']
+
+def _load_reranker(device: str, backend: str):
+    from FlagEmbedding import FlagReranker
+    model = FlagReranker(_reranker_config['model'], use_fp16=backend == "fp16", devices=device)
+    if backend == "int8":
+        model.model = quantize_for_cpu(model.model)
+    return model
+
+def _load_cascade_reranker(device: str, backend: str):
+    from sentence_transformers import CrossEncoder
+    model = CrossEncoder(_reranker_config['cascade_model'], device=device)
+    if backend == "int8":
+        model.model = quantize_for_cpu(model.model)
+    return model
+
+model_manager.register("reranker", _load_reranker)
+model_manager.register("cascade_reranker", _load_cascade_reranker)
+
+def _score_reranker(pairs: list[tuple[str, str]]) -> list[float]:
+    with model_manager.use("reranker") as model:
+        scores = model.compute_score(pairs, normalize=True)
+    return [scores] if isinstance(scores, float) else list(scores)
+
+def _score_cascade(pairs: list[tuple[str, str]]) -> list[float]:
+    with model_manager.use("cascade_reranker") as model:
+        return model.predict(pairs).tolist()
+
+def _encode_query_texts(texts: list[str]) -> list[np.ndarray]:
+    with model_manager.use("embedding") as model:
+        return list(model.encode(texts, normalize_embeddings=True))
+
+# Concurrent searches share forward passes instead of queueing up tiny batches
+_batch_config = get_config()['MICROBATCH']
+_max_wait_ms = float(_batch_config['max_wait_ms'])
+_query_batcher = MicroBatcher("embedding", _encode_query_texts, int(_batch_config['embedding_max_batch']), _max_wait_ms)
+_rerank_batcher = MicroBatcher("reranker", _score_reranker, int(_batch_config['rerank_max_batch']), _max_wait_ms)
+_cascade_batcher = MicroBatcher("cascade_reranker", _score_cascade, int(_batch_config['rerank_max_batch']), _max_wait_ms)
+
+_cascade_reranker = CascadeReranker(
+    _reranker_config['model'],
+    _rerank_batcher.submit,
+    _reranker_config['cascade_model'].strip() or None,
+    _cascade_batcher.submit,
+)
+
+def rerank(query: str, documents: list[str], deadline: float | None = None, k: int | None = None) -> list[tuple[str, float | None]]:
+    """Rerank documents, stopping at `deadline` (time.monotonic()) if given; the top `k` all get the large model."""
+    return _cascade_reranker.rerank(query, documents, deadline, k)
 
 def get_document_text_for_video(video: Video) -> str:
-    if video.id in _document_text_cache:
-        return _document_text_cache[video.id]
-    
-    text = "Filename: " + video.filename + "\n\n"
-
-    if video.torrent_tags:
-        text += "Tags: " + ", ".join(video.torrent_tags).replace('.', ' ') + "\n\n"
-    
-    # Collect filename metadata tags
-    if video.filename_metadata:
-        if video.filename_metadata.get('actors'):
-            text += "Actors: " + ", ".join(video.filename_metadata['actors']) + "\n\n"
-        
-        if video.filename_metadata.get('series'):
-            text += "Series: " + video.filename_metadata['series'] + "\n\n"
-        
-        if video.filename_metadata.get('scene_name'):
-            text += "Scene Name: " + video.filename_metadata['scene_name'] + "\n\n"
-
-        if video.filename_metadata.get('tags'):
-            text += "Extra tags: " + ", ".join(video.filename_metadata['tags']) + "\n\n"
-
-    # Collect tags from snapshot classification
-    if video.tag_sets and video.tag_sets[0].tags:
-            text += "Visual tags: " + ', '.join(video.tag_sets[0].tags) + "\n\n"
-
-    if video.torrent_file and video.torrent_file.torrent and video.torrent_file.torrent.description:
-        # Collect tags from torrent metadata
-        text += "Description: " + video.torrent_file.torrent.description[:512] + "\n\n"
-
-    _document_text_cache[video.id] = text
-    return text
+    # Stored by refresh_search_documents, built on the fly for videos not refreshed yet
+    if video.search_document is not None:
+        return video.search_document
+    return build_search_document(video)
+
+def document_texts(session: Session, video_ids: List[int] | None = None) -> dict[int, str]:
+    """Stored search documents of the given videos (all videos if None)."""
+    query = session.query(Video.id, Video.search_document).filter(Video.search_document != None)
+    if video_ids is None:
+        return dict(query.all())
+
+    texts = {}
+    video_ids = list(video_ids)
+    for start in range(0, len(video_ids), 900):  # Stay below SQLite's bound parameter limit
+        texts.update(query.filter(Video.id.in_(video_ids[start:start + 900])).all())
+    return texts
+
+def encode_documents(texts: list[str]) -> np.ndarray:
+    with model_manager.use("embedding") as model:
+        embeddings = model.encode(texts, normalize_embeddings=True, convert_to_tensor=False, show_progress_bar=len(texts) > 64)
+    return np.asarray(embeddings, dtype='float32')  # Ensure float32 type for FAISS
 
 def generate_embeddings(videos: List[Video]) -> list[np.ndarray]:
     # Flatten all tags into a list of concatenated tag strings, one per VideoTagSet
     texts = [embedding_preamble + get_document_text_for_video(video) for video in tqdm(videos)]
 
     # Encode all tag texts in one batch
-    embeddings = get_model().encode(texts, normalize_embeddings=True, convert_to_tensor=False, show_progress_bar=True)
-    embeddings = [vec.astype('float32') for vec in embeddings]  # Ensure float32 type for FAISS
-    return embeddings
+    return list(encode_documents(texts))
 
-def load_faiss_index(session: Session):
-    global faiss_index, sqlite_id_lookup
-    
-    videos = session.query(Video).filter(
+def _indexable_videos(session: Session):
+    # (id, search document) pairs, no relationships need loading
+    return session.query(Video.id, Video.search_document).filter(
         Video.filename_metadata != None,
-        Video.tag_sets != None
-    ).all()
-    embeddings = generate_embeddings(videos)
-    if not embeddings:
+        Video.tag_sets != None,
+        Video.search_document != None
+    )
+
+def _sync_embeddings(session: Session, videos: list[tuple[int, str]]) -> tuple[dict[int, int], list[int]]:
+    # Only new or changed documents go through the model, the rest come from disk
+    documents = {vid: embedding_preamble + document for vid, document in videos}
+    return embedding_store().sync(session, documents, embedding_model_name, encode_documents)
+
+def load_faiss_index(session: Session):
+    """Build the index from scratch out of the on-disk embedding store."""
+    global faiss_index
+
+    videos = _indexable_videos(session).all()
+    if not videos:
         return
 
-    # Re-initialize the FAISS index and lookup list
-    embedding_dim = embeddings[0].shape[0]
-    faiss_index = faiss.IndexFlatIP(embedding_dim)
-    sqlite_id_lookup = []
-    for video, vec in zip(videos, embeddings):
-        faiss_index.add(np.array([vec]))
-        sqlite_id_lookup.append(video.id)
+    rows, _ = _sync_embeddings(session, videos)
+    video_ids = list(rows.keys())
+    embeddings = embedding_store().read([rows[vid] for vid in video_ids])
+
+    index = AnnIndex(embeddings.shape[1])
+    index.build(video_ids, embeddings)
+    faiss_index = index
+    print(f"Loaded {index.index_type} index with {len(index)} vectors")
+
+def upsert_videos(session: Session, video_ids: List[int] | None = None) -> List[int]:
+    """Bring the index up to date for the given videos (all videos if None).
+
+    Videos whose document text is unchanged and already indexed are left
+    alone, videos that no longer qualify for the index are removed. Returns
+    the ids of videos whose vectors were added, changed or removed.
+    """
+    global faiss_index
+
+    query = _indexable_videos(session)
+    if video_ids is not None:
+        video_ids = list(set(video_ids))
+        if not video_ids:
+            return []
+        query = query.filter(Video.id.in_(video_ids))
+    videos = query.all()
+
+    rows, changed = _sync_embeddings(session, videos)
+    if faiss_index.dim != get_embedding_dim():
+        faiss_index = AnnIndex(get_embedding_dim())
+    index = faiss_index
+    changed = set(changed)
+    targets = [vid for vid in rows if vid in changed or vid not in index]
+    candidates = index.ids() if video_ids is None else set(video_ids)
+    gone = [vid for vid in candidates if vid not in rows and vid in index]
+
+    index.remove(gone)
+    index.upsert(targets, embedding_store().read([rows[vid] for vid in targets]))
+    if targets or gone:
+        print(f"Index updated: {len(targets)} upserted, {len(gone)} removed, {len(index)} total")
+
+    if index.needs_rebuild():
+        # Vectors come from the store, so this costs no model time
+        load_faiss_index(session)
+    return targets + gone
+
+def remove_videos(session: Session, video_ids: List[int]):
+    """Drop videos from the index and the embedding store."""
+    faiss_index.remove(list(video_ids))
+    embedding_store().remove(session, list(video_ids))
 
 def search_similar_from_video(session: Session, video: Video, k: int = 5) -> List[Video]:
-    faiss_id = sqlite_id_lookup.index(video.id)
-    query_vec = faiss_index.reconstruct(faiss_id).reshape(1, -1)
-    return search_similar_from_vector(session, query_vec, k)
+    if video.id not in faiss_index:
+        return []
+    # Read the exact vector from the store, quantized indexes cannot reconstruct it
+    entry = session.get(VideoEmbedding, video.id)
+    if entry is None:
+        return []
+    query_vec = embedding_store().read([entry.row])
+    # One extra result, the video itself comes back as its own nearest neighbour
+    return [v for v in search_similar_from_vector(session, query_vec, k + 1) if v.id != video.id][:k]
 
 def search_similar_from_tags(session: Session, query_tags: list[str], k: int = 5) -> List[Video]:
     text = ', '.join(query_tags)
-    query_vec = get_model().encode([text], normalize_embeddings=True)[0].astype('float32').reshape(1, -1)
+    query_vec = _query_batcher.submit([text])[0].astype('float32').reshape(1, -1)
     return search_similar_from_vector(session, query_vec, k)
 
-def search_similar_from_string(session: Session, queries: list[str], k: int = 5, rerank_enabled: bool = True) -> List[Video]:
-    # Generate query embeddings
+def encode_queries(queries: list[str]) -> np.ndarray:
     search_query_text = [query_preamble + query for query in queries]
-    query_vec = get_model().encode(search_query_text, normalize_embeddings=True) #[0].astype('float32').reshape(1, -1)
-    query_embedding = np.mean(query_vec, axis=0)
-    
+    query_vec = np.stack(_query_batcher.submit(search_query_text)) #[0].astype('float32').reshape(1, -1)
+    return np.mean(query_vec, axis=0)
+
+def candidate_count(k: int, rerank_enabled: bool) -> int:
+    # The reranker gets a wider pool than the number of results returned
+    return max(k * 5, 50) if rerank_enabled else k
+
+def vector_candidate_ids(session: Session, queries: list[str], k: int, allowed_ids: set[int] | None = None) -> list[int]:
+    return search_ids_from_vector(session, encode_queries(queries), k=k, allowed_ids=allowed_ids)
+
+def rerank_videos(query: str, videos: List[Video], deadline: float | None = None, k: int | None = None) -> List[Video]:
+    video_map = {get_document_text_for_video(v): v for v in videos}
+    documents_to_rerank = list(video_map.keys())
+
+    reranked_docs = rerank(query, documents_to_rerank, deadline, k)
+
+    # Map reranked documents back to Video objects
+    return [video_map[doc] for doc, score in reranked_docs if doc in video_map]
+
+def search_similar_from_string(session: Session, queries: list[str], k: int = 5, rerank_enabled: bool = True, allowed_ids: set[int] | None = None, deadline: float | None = None) -> List[Video]:
     # Search for similar videos using FAISS
-    candidate_k = max(k * 5, 50)
-    if not rerank_enabled:
-        candidate_k = k
-    candidate_videos = search_similar_from_vector(session, query_embedding, k=candidate_k)
+    video_ids = vector_candidate_ids(session, queries, candidate_count(k, rerank_enabled), allowed_ids=allowed_ids)
+    candidate_videos = load_videos(session, video_ids, eager=not rerank_enabled)
 
     if not candidate_videos:
         return []
@@ -158,66 +280,99 @@ def search_similar_from_string(session: Session, queries: list[str], k: int = 5,
     if not rerank_enabled:
         return candidate_videos
 
-    video_map = {get_document_text_for_video(v): v for v in candidate_videos}
-    documents_to_rerank = list(video_map.keys())
-
-    # 3. Rerank the documents
-    reranked_docs = rerank(', '.join(queries), documents_to_rerank)
-
-    # 4. Map reranked documents back to Video objects and truncate to original k
-    final_results = [video_map[doc] for doc, score in reranked_docs if doc in video_map]
-    
-    return final_results[:k]
-    # query = "Represent this sentence for searching relevant passages: " + query
-    # query_vec = get_model().encode([query])[0].astype('float32').reshape(1, -1)
-    # return search_similar_from_vector(session, query_vec, k)
-
-def search_similar_from_vector(session: Session, query_vec: np.ndarray, k: int = 5, distance_threshold: float = None) -> List[Video]:
+    return rerank_videos(', '.join(queries), candidate_videos, deadline, k)[:k]
+
+def _search_exact(session: Session, query_vec: np.ndarray, k: int, allowed_ids: set[int]) -> tuple[np.ndarray, np.ndarray]:
+    # Small candidate sets: score every allowed vector straight from the store
+    id_list = list(allowed_ids)
+    rows = {}
+    for start in range(0, len(id_list), 900):
+        chunk = id_list[start:start + 900]
+        rows.update(session.query(VideoEmbedding.video_id, VideoEmbedding.row).filter(VideoEmbedding.video_id.in_(chunk)))
+    video_ids = [vid for vid in rows if vid in faiss_index]
+    if not video_ids:
+        return np.full((1, k), -np.inf, dtype='float32'), np.full((1, k), -1, dtype='int64')
+    vectors = embedding_store().read([rows[vid] for vid in video_ids])
+    scores = vectors @ query_vec[0]
+    top = np.argsort(-scores)[:k]
+    D = np.full((1, k), -np.inf, dtype='float32')
+    I = np.full((1, k), -1, dtype='int64')
+    D[0, :len(top)] = scores[top]
+    I[0, :len(top)] = np.asarray(video_ids, dtype='int64')[top]
+    return D, I
+
+_exact_filter_limit = int(get_config()['VECTOR_INDEX']['exact_filter_limit'])
+
+def _search_filtered(session: Session, query_vec: np.ndarray, k: int, allowed_ids: set[int]) -> tuple[np.ndarray, np.ndarray]:
+    # Videos without a vector can never be found, they must not count towards k
+    allowed_ids = faiss_index.indexed(allowed_ids)
+    if len(allowed_ids) <= _exact_filter_limit:
+        return _search_exact(session, query_vec, k, allowed_ids)
+
+    # Let FAISS skip disallowed ids itself; approximate indexes may still come
+    # back short, so widen nprobe/efSearch until k survivors are found
+    wanted = min(k, len(allowed_ids))
+    allowed = np.fromiter(allowed_ids, dtype='int64', count=len(allowed_ids))
+    probe_scale = 1
+    while True:
+        D, I = faiss_index.search(query_vec, k, allowed_ids=allowed, probe_scale=probe_scale)
+        found = int((I[0] != -1).sum())
+        if found >= wanted or faiss_index.index_type == "flat" or probe_scale >= 64:
+            return D, I
+        probe_scale *= 4
+
+def search_ids_from_vector(session: Session, query_vec: np.ndarray, k: int = 5, distance_threshold: float = None, allowed_ids: set[int] | None = None) -> list[int]:
     # # Normalize the query vector
     # norm = np.linalg.norm(query_vec)
     # if norm > 0:
     #     query_vec = query_vec / norm
 
-    # Ensure query_vec is 2D
+    # Ensure query_vec is 2D float32
+    query_vec = np.asarray(query_vec, dtype='float32')
     if query_vec.ndim == 1:
         query_vec = query_vec.reshape(1, -1)
-    
-    D, I = faiss_index.search(query_vec, k)
+    if not len(faiss_index):
+        return []  # Possibly still the placeholder, sized before the model's width was known
+
+    if allowed_ids is not None:
+        D, I = _search_filtered(session, query_vec, k, allowed_ids)
+    else:
+        D, I = faiss_index.search(query_vec, k)
 
-    results: list[Video] = []
     mindist = float('inf')
     maxdist = float('-inf')
     video_ids = []
-    for dist, faiss_idx in zip(D[0], I[0]):
-        if faiss_idx < len(sqlite_id_lookup):
+    for dist, video_id in zip(D[0], I[0]):
+        if video_id != -1:
             if dist < mindist:
                 mindist = dist
             if dist > maxdist:
                 maxdist = dist
             if distance_threshold is not None and dist < distance_threshold:
                 continue  # Skip results that are too far away
-            video_id = sqlite_id_lookup[faiss_idx]
-            video_ids.append(video_id)
-            # video = session.get(Video, video_id)
-            # if video:
-            #     results.append(video)
-    
-    # Eager-load relationships if needed
-    from sqlalchemy.orm import joinedload
-    videos = (
-        session.query(Video)
-        .filter(Video.id.in_(video_ids))
-        .options(
-            joinedload(Video.torrent_file).joinedload(TorrentFile.torrent),
-            joinedload(Video.tag_sets)
-        )
-        .all()
-    )
+            video_ids.append(int(video_id))
+
+    print(f"Search results: {len(video_ids)} videos found, distances range from {mindist:.4f} to {maxdist:.4f}")
+    return video_ids
+
+def load_videos(session: Session, video_ids: list[int], eager: bool = True) -> List[Video]:
+    """Load videos by id, in the given order, skipping missing ones.
+
+    `eager` loads what VideoSchema reads; ranking only needs the search
+    document, which is a plain column.
+    """
+    if not video_ids:
+        return []
+    query = session.query(Video).filter(Video.id.in_(video_ids))
+    if eager:
+        query = query.options(selectinload(Video.thumbnails), selectinload(Video.tag_sets))
+    videos = query.all()
 
     video_map = {v.id: v for v in videos}
 
     # Preserve order and filter out missing
-    results = [video_map[vid] for vid in video_ids if vid in video_map]
+    return [video_map[vid] for vid in video_ids if vid in video_map]
 
-    print(f"Search results: {len(results)} videos found, distances range from {mindist:.4f} to {maxdist:.4f}")
-    return results
\ No newline at end of file
+def search_similar_from_vector(session: Session, query_vec: np.ndarray, k: int = 5, distance_threshold: float = None, allowed_ids: set[int] | None = None) -> List[Video]:
+    video_ids = search_ids_from_vector(session, query_vec, k=k, distance_threshold=distance_threshold, allowed_ids=allowed_ids)
+    return load_videos(session, video_ids)
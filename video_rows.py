@@ -0,0 +1,96 @@
+from typing import Any, Iterable, List
+from fastapi.responses import Response
+from sqlalchemy import String, literal_column, select, type_coerce
+from sqlalchemy.orm import Session
+from models import Video, VideoSchema
+
+try:
+    import orjson
+
+    def dumps(content: Any) -> bytes:
+        return orjson.dumps(content)
+
+    loads = orjson.loads
+except ImportError:  # orjson is optional, the standard library is just slower
+    import json
+
+    def dumps(content: Any) -> bytes:
+        return json.dumps(content, separators=(',', ':')).encode('utf-8')
+
+    loads = json.loads
+
+# Read path for API responses that skips ORM objects and VideoSchema: one
+# SELECT returns every field as plain values, with thumbnail paths and tags
+# aggregated by SQLite itself, and the rows go straight to the JSON encoder.
+
+_THUMBNAIL_PATHS = literal_column(
+    "(SELECT json_group_array(thumbnails.path) FROM thumbnails"
+    " WHERE thumbnails.video_id = videos.id AND thumbnails.path IS NOT NULL AND thumbnails.path != '')"
+)
+# Same as Video.tags: the distinct tags of all tag sets
+_TAGS = literal_column(
+    "(SELECT json_group_array(DISTINCT tag.value) FROM video_tag_sets, json_each(video_tag_sets.tags) AS tag"
+    " WHERE video_tag_sets.video_id = videos.id)"
+)
+
+# Field -> column expression, JSON valued fields are read as text and decoded here
+_COLUMNS = {
+    "id": Video.id,
+    "path": Video.path,
+    "searchpath": Video.searchpath,
+    "filename": Video.filename,
+    "size": Video.size,
+    "duration": Video.duration,
+    "codec": Video.codec,
+    "width": Video.width,
+    "height": Video.height,
+    "filename_metadata": type_coerce(Video.filename_metadata, String),
+    "preview_path": Video.preview_path,
+    "sprite_path": Video.sprite_path,
+    "sprite_vtt_path": Video.sprite_vtt_path,
+    "thumbnail_paths": _THUMBNAIL_PATHS,
+    "tags": _TAGS,
+    "torrent_tags": type_coerce(Video.torrent_tags, String),
+}
+_JSON_FIELDS = {"filename_metadata", "thumbnail_paths", "tags", "torrent_tags"}
+# Aggregates over no rows give an empty array, not NULL
+_LIST_FIELDS = {"thumbnail_paths", "tags"}
+
+FIELDS = tuple(VideoSchema.model_fields)
+
+
+def select_video_rows(fields: Iterable[str] | None = None, extra: Iterable = ()):
+    """SELECT over videos returning the given response fields (all if None), labelled by name."""
+    names = FIELDS if fields is None else fields
+    return select(*(_COLUMNS[name].label(name) for name in names), *extra)
+
+
+def row_to_dict(row, fields: Iterable[str] | None = None) -> dict:
+    mapping = row._mapping
+    result = {}
+    for name in FIELDS if fields is None else fields:
+        value = mapping[name]
+        if name in _JSON_FIELDS:
+            value = loads(value) if value is not None else ([] if name in _LIST_FIELDS else None)
+        result[name] = value
+    return result
+
+
+def load_video_rows(db: Session, video_ids: List[int], fields: Iterable[str] | None = None) -> List[dict]:
+    """Response dicts for the given videos, in the given order, skipping missing ones."""
+    rows = {}
+    video_ids = list(video_ids)
+    for start in range(0, len(video_ids), 900):  # Stay below SQLite's bound parameter limit
+        chunk = video_ids[start:start + 900]
+        query = select_video_rows(fields, extra=[Video.id.label("_id")]).where(Video.id.in_(chunk))
+        for row in db.execute(query):
+            rows[row._mapping["_id"]] = row_to_dict(row, fields)
+    return [rows[vid] for vid in video_ids if vid in rows]
+
+
+class FastJSONResponse(Response):
+    """JSONResponse that encodes with orjson when it is installed."""
+    media_type = "application/json"
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
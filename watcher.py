@@ -0,0 +1,232 @@
+import json
+import logging
+import os
+import threading
+import time
+from config import get_config, get_media_folders, get_supported_extensions
+from database import SessionLocal
+from models import Task, normalize_path
+
+try:
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:  # The watcher is optional, /scan works without it
+    FileSystemEventHandler = object
+    Observer = None
+
+logger = logging.getLogger(__name__)
+
+
+def _mount_type(path: str) -> str | None:
+    """File system type of the mount a path lives on, from /proc/mounts."""
+    best, fstype = "", None
+    try:
+        with open("/proc/mounts") as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                mount_point = fields[1].replace("\\040", " ")
+                if (path == mount_point or path.startswith(mount_point.rstrip(os.sep) + os.sep)) and len(mount_point) > len(best):
+                    best, fstype = mount_point, fields[2]
+    except OSError:
+        pass
+    return fstype
+
+
+class _Pending:
+    __slots__ = ("deleted", "is_directory", "last_event", "stat", "checked")
+
+    def __init__(self):
+        self.deleted = False
+        self.is_directory = False
+        self.last_event = 0.0
+        self.stat: tuple[int, int] | None = None  # (size, mtime) at the last check
+        self.checked = 0.0
+
+
+class _EventHandler(FileSystemEventHandler):
+    def __init__(self, watcher: "MediaWatcher"):
+        self.watcher = watcher
+
+    def on_any_event(self, event):
+        if event.event_type in ("opened", "closed_no_write"):
+            return
+        if event.event_type == "moved":
+            self.watcher.notify(event.src_path, deleted=True, is_directory=event.is_directory)
+            self.watcher.notify(event.dest_path, deleted=False, is_directory=event.is_directory)
+        elif event.event_type == "deleted":
+            self.watcher.notify(event.src_path, deleted=True, is_directory=event.is_directory)
+        elif not event.is_directory:
+            # created, modified, closed; directories moved in get events for their files
+            self.watcher.notify(event.src_path, deleted=False, is_directory=False)
+
+
+class MediaWatcher:
+    """Feeds file system changes under the media folders into the task queue.
+
+    Local folders are watched with inotify. Network mounts (and folders
+    inotify cannot watch, e.g. when out of watches) are polled by queueing
+    an incremental scan every `poll_interval`, which only lists the
+    directories whose mtime changed. Events are debounced per path, and a
+    file is only handed on once its size and mtime stayed the same for
+    `settle_seconds`, so downloads still being written are not probed half
+    way. Ready paths go to the queue as one `ingest` task.
+    """
+
+    def __init__(self, debounce_seconds: float, settle_seconds: float, poll_interval: float, mode: str, network_filesystems: set[str]):
+        self.debounce_seconds = debounce_seconds
+        self.settle_seconds = settle_seconds
+        self.poll_interval = poll_interval
+        self.mode = mode
+        self.network_filesystems = network_filesystems
+        self._extensions = {ext.lower() for ext in get_supported_extensions()}
+        self._pending: dict[str, _Pending] = {}
+        self._lock = threading.Lock()
+        self._observer = None
+        self._polled_roots: list[str] = []
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def notify(self, path: str, deleted: bool, is_directory: bool):
+        if not is_directory and os.path.splitext(path)[1].lower() not in self._extensions:
+            return
+        path = normalize_path(path)
+        with self._lock:
+            entry = self._pending.get(path)
+            if entry is None:
+                entry = self._pending[path] = _Pending()
+            entry.deleted = deleted
+            entry.is_directory = is_directory
+            entry.last_event = time.monotonic()
+
+    def _use_polling(self, root: str) -> bool:
+        if self.mode == "polling":
+            return True
+        if self.mode == "inotify":
+            return False
+        return _mount_type(root) in self.network_filesystems
+
+    def start(self):
+        if Observer is None:
+            logger.warning("watchdog is not installed, the media folders are not watched")
+            return
+        handler = _EventHandler(self)
+        self._observer = Observer()
+        self._observer.start()
+        for folder in get_media_folders():
+            root = normalize_path(folder)
+            if not os.path.isdir(root):
+                logger.warning(f"Folder not found, not watching: {folder}")
+                continue
+            if not self._use_polling(root):
+                try:
+                    self._observer.schedule(handler, root, recursive=True)
+                    logger.info(f"Watching {root}")
+                    continue
+                except OSError as e:
+                    logger.warning(f"Cannot watch {root} ({e}), polling it instead")
+            self._polled_roots.append(root)
+            logger.info(f"Polling {root} every {self.poll_interval:g}s")
+        self._thread = threading.Thread(target=self._run, name="media-watcher", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._observer is not None:
+            self._observer.stop()
+            self._observer.join()
+            self._observer = None
+
+    def _run(self):
+        last_poll = time.monotonic()
+        while not self._stop.wait(1):
+            try:
+                changed, deleted = self._take_ready()
+                if changed or deleted:
+                    self._queue(changed, deleted)
+                if self._polled_roots and time.monotonic() - last_poll >= self.poll_interval:
+                    last_poll = time.monotonic()
+                    self._queue_scan()
+            except Exception as e:
+                logger.error(f"Media watcher failed: {e}")
+
+    def _take_ready(self) -> tuple[list[str], list[str]]:
+        """Paths whose events have settled, split into changed files and deleted paths."""
+        now = time.monotonic()
+        ready, dropped = [], []
+        with self._lock:
+            candidates = [(path, entry) for path, entry in self._pending.items() if now - entry.last_event >= self.debounce_seconds]
+        for path, entry in candidates:
+            if entry.deleted:
+                continue
+            if entry.is_directory:
+                # A directory moved in, its files get events of their own
+                dropped.append((path, entry))
+                continue
+            try:
+                st = os.stat(path)
+                stat = (st.st_size, st.st_mtime_ns)
+            except FileNotFoundError:
+                entry.deleted = True
+                continue
+            except OSError as e:
+                # Unreadable, e.g. no permission; fixing that sends another event
+                logger.warning(f"Cannot stat {path}: {e}")
+                dropped.append((path, entry))
+                continue
+            if stat != entry.stat:
+                # Still being written, or not checked yet: look again after settle_seconds
+                entry.stat, entry.checked = stat, now
+            elif now - entry.checked >= self.settle_seconds:
+                ready.append((path, entry))
+
+        changed, deleted = [], []
+        with self._lock:
+            for path, entry in ready:
+                # An event that arrived meanwhile starts the wait again
+                if self._pending.get(path) is entry and now - entry.last_event >= self.debounce_seconds:
+                    del self._pending[path]
+                    changed.append(path)
+            for path, entry in dropped:
+                if self._pending.get(path) is entry and not entry.deleted:
+                    del self._pending[path]
+            # A move is a deletion and a creation at the same time. Deletions wait for the files
+            # that appeared with them, so the scanner can recognise the moved file and keep its video
+            waiting = [entry.last_event for entry in self._pending.values() if not entry.deleted]
+            oldest_waiting = min(waiting, default=float("inf"))
+            for path, entry in candidates:
+                if entry.deleted and self._pending.get(path) is entry and entry.last_event + self.debounce_seconds < oldest_waiting:
+                    del self._pending[path]
+                    deleted.append(path)
+        return changed, deleted
+
+    def _queue(self, changed: list[str], deleted: list[str]):
+        db = SessionLocal()
+        try:
+            db.add(Task(type='ingest', status='pending', payload=json.dumps({"changed": changed, "deleted": deleted})))
+            db.commit()
+        finally:
+            db.close()
+        logger.info(f"Queued {len(changed)} changed and {len(deleted)} deleted paths")
+
+    def _queue_scan(self):
+        db = SessionLocal()
+        try:
+            # The last poll may still be running, or a /scan covering every folder be waiting
+            if db.query(Task.id).filter(Task.type == 'scan', Task.status.in_(('pending', 'processing'))).first():
+                return
+            db.add(Task(type='scan', status='pending', payload=str({'media_folders': self._polled_roots, 'full': False})))
+            db.commit()
+        finally:
+            db.close()
+
+
+_config = get_config()['WATCHER']
+media_watcher = MediaWatcher(
+    debounce_seconds=float(_config['debounce_seconds']),
+    settle_seconds=float(_config['settle_seconds']),
+    poll_interval=float(_config['poll_interval']),
+    mode=_config['mode'],
+    network_filesystems={fs.strip() for fs in _config['network_filesystems'].split(',') if fs.strip()},
+)